@@ -0,0 +1,313 @@
+#!/bin/env python
+"""
+Live S-curve analysis of a scan that is still being taken.
+
+The scan file is polled for new entries of scurveTree, which are added to
+per-channel accumulators. A channel is fitted as soon as its transition region
+is covered, i.e. a point below --low of the plateau is followed at a higher
+VCal by --plateau points above --high of it, and refitted when new points fall
+inside that region. After each update the preliminary masks and summary
+numbers are written to <scan>/liveSummary.json; channels not fitted yet are
+reported as pending rather than masked. Once the scan has ended every channel
+that gained points since its last fit is refitted, so that the final results
+are those of a fit of the whole scurve.
+
+The scan is over once every channel of the VFATs found in it has a point at
+--lastVCal (254 by default), or after --entries entries when the size of the
+full scan is known. --idle only stops following a scan that was interrupted
+before reaching either.
+
+Following a scan being taken, stopping after 24*128*254 entries:
+
+    anaLiveScurve.py -i SCurveData.root --entries=780288
+
+Replaying a finished scan one VCal step (24*128 entries) at a time:
+
+    anaLiveScurve.py -i SCurveData.root --replay=3072 --interval=0.5
+
+The final results are saved with saveChamberArray to
+<scan>/liveScurveData.npz. anaUltraScurve.py remains the reference analysis of
+the finished scan.
+"""
+
+import json
+import os
+import time
+import numpy as np
+
+scurveBranches = ['vfatN','vfatCH','vcal','Nhits','Nev','vthr','trimDAC','trimRange']
+
+def readNewEntries(filename, start, treename='scurveTree'):
+    """Returns the entries of treename from entry start on, as a dictionary of
+    branch name to array, or None if the tree can not be read yet (e.g. it
+    was not flushed to disk by the scan)"""
+    import root_numpy as rp
+
+    try:
+        data = rp.root2array(filename, treename=treename, branches=scurveBranches, start=start)
+    except (IOError, ValueError):
+        return None
+    return dict( (branch, data[branch]) for branch in data.dtype.names )
+
+def followScan(filename, interval=2., idle=60.):
+    """Yields the entries added to the scan file, polling it every interval
+    seconds, until none were added for idle seconds"""
+    nRead = 0
+    lastChange = time.time()
+    while True:
+        data = None
+        if os.path.isfile(filename):
+            data = readNewEntries(filename, nRead)
+            pass
+        if data is not None and len(data['vfatN']):
+            nRead += len(data['vfatN'])
+            lastChange = time.time()
+            yield data
+            continue
+        if time.time() - lastChange > idle:
+            return
+        time.sleep(interval)
+        pass
+
+def replayScan(filename, chunkSize, interval=0.):
+    """Yields the entries of a finished scan file in chunks of chunkSize, as
+    followScan would while the scan is taken"""
+    from columnar import readColumns
+
+    data = readColumns(filename, 'scurveTree', scurveBranches)
+    for start in range(0, len(data['vfatN']), chunkSize):
+        if start > 0 and interval > 0:
+            time.sleep(interval)
+            pass
+        yield dict( (branch, column[start:start+chunkSize]) for branch, column in data.iteritems() )
+        pass
+    return
+
+class LiveScurveAnalysis(object):
+    """Accumulates the scurves of a scan chunk by chunk and keeps the fits of
+    the channels whose transition region is covered up to date. Example usage:
+
+        analysis = LiveScurveAnalysis()
+        for chunk in replayScan('SCurveData.root', 3072):
+            analysis.update(chunk)
+            analysis.refit()
+            pass
+        analysis.finish()
+        data, isPending = analysis.results()
+    """
+
+    def __init__(self, low=0.1, high=0.9, ztrim=4.0, zscore=3.5, GEBtype=None, plateau=5):
+        from anautilities import initChamberArray
+        from fitting.fitScanData import ScanDataFitter
+
+        self.low = low
+        self.high = high
+        self.plateau = plateau
+        self.ztrim = ztrim
+        self.zscore = zscore
+        self.fitter = ScanDataFitter()
+        self.hits = np.zeros((24,128,256))
+        self.seen = np.zeros((24,128,256), dtype=bool)
+        #Points in the transition region and points of the scurve at the
+        #last fit, -1 if never fitted
+        self.fittedPoints = -np.ones((24,128), dtype=int)
+        self.fittedSeen = -np.ones((24,128), dtype=int)
+        self.chamberData = initChamberArray()
+        if GEBtype is not None:
+            from mapping.mapFiles import loadChannelMap
+            channelMap = loadChannelMap(GEBtype)
+            self.chamberData['ROBstr'] = channelMap['chanToStrip']
+            self.chamberData['panPin'] = channelMap['chanToPanPin']
+            pass
+        self.entries = 0
+        self.final = False
+
+    def update(self, data):
+        """Adds the entries of data, a dictionary of branch name to array"""
+        from columnar import columnEvents
+
+        for event in columnEvents(data, 'scurveTree'):
+            self.fitter.feed(event)
+            pass
+        index = (data['vfatN'], data['vfatCH'], data['vcal'])
+        np.add.at(self.hits, index, data['Nhits'])
+        self.seen[index] = True
+        for name in ['vthr', 'trimDAC', 'trimRange']:
+            self.chamberData[name][data['vfatN'], data['vfatCH']] = data[name]
+            pass
+        self.entries += len(data['vfatN'])
+
+    def complete(self, lastVCal=254):
+        """Returns whether every channel of the VFATs with entries has a point
+        at lastVCal or above, i.e. the scan has reached its last step"""
+        vfats = self.seen.any(axis=-1).any(axis=-1)
+        reached = self.seen[..., lastVCal:].any(axis=-1).all(axis=-1)
+        return bool(vfats.any() and reached[vfats].all())
+
+    def transitionPoints(self):
+        """Returns the (24,128) array of the number of points seen in the
+        transition region of each channel, 0 where it is not covered yet or
+        fewer than self.plateau points above it were seen"""
+        vcal = np.arange(256)
+        below = self.seen & (self.hits <= self.low * self.fitter.Nev)
+        #Last point below the transition, and first point above it after that
+        lowEdge = np.where(below.any(axis=-1), 255 - np.argmax(below[..., ::-1], axis=-1), 256)
+        above = self.seen & (self.hits >= self.high * self.fitter.Nev) & (vcal > lowEdge[..., np.newaxis])
+        covered = above.sum(axis=-1) >= max(1, self.plateau)
+        highEdge = np.argmax(above, axis=-1)
+        inside = self.seen & (vcal >= lowEdge[..., np.newaxis]) & (vcal <= highEdge[..., np.newaxis])
+        return np.where(covered, inside.sum(axis=-1), 0)
+
+    def refit(self, final=False):
+        """Fits the channels whose transition region is newly covered or has
+        new points. With final, every channel with points seen since its last
+        fit instead, e.g. the plateau following its transition. Returns the
+        number of channels fitted."""
+        points = self.transitionPoints()
+        nSeen = self.seen.sum(axis=-1)
+        if final:
+            toFit = (nSeen > 0) & (nSeen != self.fittedSeen)
+            pass
+        else:
+            toFit = (points > 0) & (points != self.fittedPoints)
+            pass
+        for vfat, ch in zip(*np.nonzero(toFit)):
+            self.fitter.fitChannel(vfat, ch)
+            pass
+        self.fittedPoints[toFit] = points[toFit]
+        self.fittedSeen[toFit] = nSeen[toFit]
+        return np.count_nonzero(toFit)
+
+    def finish(self):
+        """Fits the remaining channels once the scan has ended. Channels
+        without any entry are then dead rather than pending."""
+        nFitted = self.refit(final=True)
+        self.final = True
+        return nFitted
+
+    def results(self):
+        """Returns the chamber array of the current fit results and masks, and
+        the (24,128) boolean array of the channels still pending"""
+        from anautilities import scurveMaskReasons
+
+        if self.final:
+            isDead = np.array(self.fitter.isDead)
+            isPending = np.zeros((24,128), dtype=bool)
+            pass
+        else:
+            isDead = np.zeros((24,128), dtype=bool)
+            isPending = self.fittedPoints < 0
+            pass
+        reasons, effectivePedestals = scurveMaskReasons(self.fitter.scanFits, isDead, self.fitter.fitValid,
+                                                        ztrim=self.ztrim, zscore=self.zscore, isPending=isPending)
+        scanFits = self.fitter.scanFits
+        data = self.chamberData.copy()
+        for name, ipar in [('threshold',0), ('noise',1), ('pedestal',2), ('chi2',3), ('Nhigh',4), ('ndf',5)]:
+            data[name] = [ scanFits[ipar][vfat] for vfat in range(0,24) ]
+            pass
+        data['ped_eff'] = effectivePedestals
+        data['mask'] = reasons != 0
+        data['maskReason'] = reasons
+        return data, isPending
+
+def summarize(data, isPending):
+    """Returns the summary numbers of each VFAT of the chamber array data, with
+    the median threshold and noise of the fitted, unmasked channels"""
+    from anaInfo import MaskReason
+
+    summary = []
+    for vfat in range(0,24):
+        vfatData = data[vfat]
+        reason = vfatData['maskReason']
+        good = np.logical_not(isPending[vfat]) & (vfatData['mask'] == 0)
+        summary.append({
+            "vfat":vfat,
+            "pending":int(np.count_nonzero(isPending[vfat])),
+            "fitted":int(np.count_nonzero(np.logical_not(isPending[vfat]) & ((reason & (MaskReason.DeadChannel | MaskReason.FitFailed)) == 0))),
+            "dead":int(np.count_nonzero(reason & MaskReason.DeadChannel)),
+            "hot":int(np.count_nonzero(reason & MaskReason.HotChannel)),
+            "failed":int(np.count_nonzero(reason & MaskReason.FitFailed)),
+            "highNoise":int(np.count_nonzero(reason & MaskReason.HighNoise)),
+            "highEffPed":int(np.count_nonzero(reason & MaskReason.HighEffPed)),
+            "masked":vfatData['vfatCH'][vfatData['mask'] != 0].tolist(),
+            "threshold":float(np.median(vfatData['threshold'][good])) if np.any(good) else None,
+            "noise":float(np.median(vfatData['noise'][good])) if np.any(good) else None
+            })
+        pass
+    return summary
+
+def writeSummary(filename, analysis, summary):
+    """Writes the summary to filename, replacing it at once so that a reader
+    never sees a partial file"""
+    with open(filename + '.tmp', 'w') as outF:
+        json.dump({"entries":analysis.entries, "final":analysis.final, "time":time.time(), "vfats":summary},
+                  outF, indent=1, sort_keys=True)
+        pass
+    os.rename(filename + '.tmp', filename)
+    return
+
+if __name__ == '__main__':
+    from anaoptions import parser
+
+    parser.add_option("--replay", type="int", dest="replay", default=None,
+                      help="Replay the finished scan file in chunks of this many entries instead of following it", metavar="replay")
+    parser.add_option("--interval", type="float", dest="interval", default=None,
+                      help="Seconds between polls of the scan file (default 2), or between replayed chunks (default 0)", metavar="interval")
+    parser.add_option("--idle", type="float", dest="idle", default=60.,
+                      help="Stop following the scan file once no entries were added for this many seconds, if it was interrupted before its end", metavar="idle")
+    parser.add_option("--lastVCal", type="int", dest="lastVCal", default=254,
+                      help="Last VCal of the scan, which ends once every channel has a point there", metavar="lastVCal")
+    parser.add_option("--entries", type="int", dest="entries", default=None,
+                      help="Stop as soon as this many entries, the size of the full scan, were read", metavar="entries")
+    parser.add_option("--low", type="float", dest="low", default=0.1,
+                      help="Fraction of the plateau below which a point is before the transition", metavar="low")
+    parser.add_option("--high", type="float", dest="high", default=0.9,
+                      help="Fraction of the plateau above which a point is after the transition", metavar="high")
+    parser.add_option("--plateau", type="int", dest="plateau", default=5,
+                      help="Number of points above --high a channel needs before its first fit", metavar="plateau")
+    parser.add_option("--zscore", type="float", dest="zscore", default=3.5,
+                      help="Z-Score for Outlier Identification in MAD Algo", metavar="zscore")
+
+    (options, args) = parser.parse_args()
+    filename = options.filename[:-5]
+    if not os.path.isdir(filename):
+        os.makedirs(filename)
+        pass
+
+    from anautilities import StageTimer, saveChamberArray
+    from anaInfo import MaskReason
+
+    timer = StageTimer(options.timing)
+    timer.start('live')
+    if options.replay is not None:
+        chunks = replayScan(options.filename, options.replay, options.interval or 0.)
+        pass
+    else:
+        chunks = followScan(options.filename, options.interval or 2., options.idle)
+        pass
+
+    analysis = LiveScurveAnalysis(options.low, options.high, options.ztrim, options.zscore, options.GEBtype, options.plateau)
+    for chunk in chunks:
+        analysis.update(chunk)
+        timer.count(len(chunk['vfatN']))
+        nFitted = analysis.refit()
+        data, isPending = analysis.results()
+        writeSummary(filename+'/liveSummary.json', analysis, summarize(data, isPending))
+        print '%i entries read, %i channels (re)fitted, %i pending'%(analysis.entries, nFitted, np.count_nonzero(isPending))
+        if options.entries is not None and analysis.entries >= options.entries:
+            break
+        if analysis.complete(options.lastVCal):
+            break
+        pass
+
+    timer.start('final')
+    nFitted = analysis.finish()
+    data, isPending = analysis.results()
+    summary = summarize(data, isPending)
+    writeSummary(filename+'/liveSummary.json', analysis, summary)
+    saveChamberArray(filename+'/liveScurveData.npz', data)
+    print 'Scan ended after %i entries, %i channels fitted at the end'%(analysis.entries, nFitted)
+    for vfatSummary in summary:
+        print 'VFAT %(vfat)2d: %(dead)d dead, %(hot)d hot channels, %(failed)d failed fits, %(highNoise)d high noise, %(highEffPed)d high eff.ped.'%vfatSummary
+        pass
+    timer.dump()
@@ -11,6 +11,8 @@ import numpy as np
 import os
 
 from anaoptions import parser
+from anautilities import StageTimer
+from columnar import treeEvents
 from array import array
 from gempython.utils.nesteddict import nesteddict as ndict
 
@@ -18,11 +20,16 @@ parser.set_defaults(outfilename="LatencyData.root")
 
 (options, args) = parser.parse_args()
 filename = options.filename[:-5]
-os.system("mkdir " + filename)
+if not os.path.isdir(filename):
+    os.makedirs(filename)
+    pass
 
 print filename
 outputfilename = options.outfilename
 
+timer = StageTimer(options.timing)
+timer.start('read')
+
 import ROOT as r
 r.gROOT.SetBatch(True)
 r.gStyle.SetOptStat(1111111)
@@ -39,7 +46,7 @@ for vfat in range(0,24):
 print 'Filling Histograms'
 latMin = 1000
 latMax = -1
-for event in inF.latTree:
+for event in timer.counted(treeEvents(filename+'.root', 'latTree')):
     dict_hVFATHitsVsLat[int(event.vfatN)].Fill(event.lat,event.Nhits)
     if event.lat < latMin and event.Nhits > 0:
         latMin = event.lat
@@ -50,6 +57,7 @@ for event in inF.latTree:
     pass
 
 from math import sqrt
+timer.start('fit')
 outF = r.TFile(filename+"/"+options.outfilename,"RECREATE")
 dict_grNHitsVFAT = ndict()
 dict_fitNHitsVFAT = ndict()
@@ -102,6 +110,7 @@ for vfat in dict_hVFATHitsVsLat:
     pass
 
 #Store - Summary
+timer.start('render')
 canv_Summary.SaveAs(filename+'/Summary.png')
 
 #Store - Sig Over (Sig + Bkg)
@@ -145,8 +154,11 @@ grMaxLatBinByVFAT.Draw("APE1")
 canv_MaxHitsPerLatByVFAT.SaveAs(filename+'/MaxHitsPerLatByVFAT.png')
 
 #Store - TObjects
+timer.start('write')
 outF.cd()
 grNMaxLatBinByVFAT.Write()
 grMaxLatBinByVFAT.Write()
 grVFATSigOverSigPBkg.Write()
 outF.Close()
+
+timer.dump()
@@ -4,6 +4,7 @@ import numpy as np
 from optparse import OptionParser
 from array import array
 from anautilities import *
+from columnar import treeEvents
 from anaInfo import *
 from fitting.fitScanData import *
 from mapping.channelMaps import *
@@ -20,15 +21,24 @@ parser.add_option("--IsTrimmed", action="store_true", dest="IsTrimmed",
                   help="If the data is from a trimmed scan, plot the value it tried aligning to", metavar="IsTrimmed")
 parser.add_option("--zscore", type="float", dest="zscore", default=3.5,
                   help="Z-Score for Outlier Identification in MAD Algo", metavar="zscore")
+parser.add_option("--fitWindow", type="int", dest="fitWindow", default=None,
+                  help="Fit each scurve only around its transition, extended by this many VCal units on each side", metavar="fitWindow")
+parser.add_option("--checkpoint", type="float", dest="checkpoint", default=60.,
+                  help="Seconds between checkpoints of the fit results to fitCheckpoint.npz, from which a rerun resumes; negative to disable", metavar="checkpoint")
 parser.set_defaults(outfilename="SCurveData.root")
 
 (options, args) = parser.parse_args()
 filename = options.filename[:-5]
-os.system("mkdir " + filename)
+if not os.path.isdir(filename):
+    os.makedirs(filename)
+    pass
 
 print filename
 outfilename = options.outfilename
 
+timer = StageTimer(options.timing)
+timer.start('read')
+
 vToQb = -0.8
 vToQm = 0.05
 
@@ -42,52 +52,27 @@ if options.SaveFile:
     myT = r.TTree('scurveFitTree','Tree Holding FitData')
     pass
 
-#Build the channel to strip mapping from the text file
-chanToStripLUT = []
-stripToChanLUT = []
-chanToPanPinLUT = []
-for vfat in range(0,24):
-    chanToStripLUT.append([])
-    stripToChanLUT.append([])
-    chanToPanPinLUT.append([])
-    for channel in range(0,128):
-        chanToStripLUT[vfat].append(0)
-        stripToChanLUT[vfat].append(0)
-        chanToPanPinLUT[vfat].append(0)
-        pass
-    pass
-
+#Load the channel to strip mapping
 from gempython.utils.wrappers import envCheck
 envCheck('GEM_PLOTTING_PROJECT')
 
-projectHome = os.environ.get('GEM_PLOTTING_PROJECT')
-if GEBtype == 'long':
-    intext = open(projectHome+'/mapping/longChannelMap.txt', 'r')
-    pass
-if GEBtype == 'short':
-    intext = open(projectHome+'/mapping/shortChannelMap.txt', 'r')
-    pass
+from mapping.mapFiles import loadChannelMap
+channelMap = loadChannelMap(GEBtype)
+chanToStripLUT = channelMap['chanToStrip'].tolist()
+stripToChanLUT = channelMap['stripToChan'].tolist()
+chanToPanPinLUT = channelMap['chanToPanPin'].tolist()
 
-for i, line in enumerate(intext):
-    if i == 0: continue
-    mapping = line.rsplit('\t')
-    chanToStripLUT[int(mapping[0])][int(mapping[2]) - 1] = int(mapping[1])
-    stripToChanLUT[int(mapping[0])][int(mapping[1])] = int(mapping[2]) - 1
-    chanToPanPinLUT[int(mapping[0])][int(mapping[2]) -1] = int(mapping[3])
-    pass
+#Per-channel results, indexed by (vfat, channel)
+chamberData = initChamberArray()
+chamberData['ROBstr'] = np.array(chanToStripLUT)
+chamberData['panPin'] = np.array(chanToPanPinLUT)
 
 if options.IsTrimmed:
-    trimmed_text = open('scanInfo.txt', 'r')
-    trimVcal = []
-    for vfat in range(0,24):
-        trimVcal.append(0)
-        pass
-    for n, line in enumerate(trimmed_text):
-        if n == 0: continue
-        print line
-        scanInfo = line.rsplit('  ')
-        trimVcal[int(scanInfo[0])] = float(scanInfo[4])
-        pass
+    from configfiles import readScanInfo
+    scanInfo = readScanInfo('scanInfo.txt')
+    print scanInfo
+    trimVcal = np.zeros(24)
+    trimVcal[scanInfo[:,0].astype(int)] = scanInfo[:,4]
     pass
 
 if options.SaveFile:
@@ -132,18 +117,17 @@ vSummaryPlotsPanPin2 = ndict()
 vSummaryPlotsPruned = ndict()
 vSummaryPlotsPrunedPanPin2 = ndict()
 vScurves = []
-vthr_list = []
-trim_list = []
-trimrange_list = []
 lines = []
+if options.drawbad:
+    from treeindex import TreeIndex, iterIndexed
+    dataIndex = TreeIndex(filename+'.root', 'scurveTree')
+    pass
 def overlay_fit(VFAT, CHAN):
     Scurve = r.TH1D('Scurve','Scurve for VFAT %i channel %i;VCal [DAC units]'%(VFAT, CHAN),255,-0.5,254.5)
     strip = chanToStripLUT[VFAT][CHAN]
     pan_pin = chanToPanPinLUT[VFAT][CHAN]
-    for event in inF.scurveTree:
-        if (event.vfatN == VFAT) and (event.vfatCH == CHAN):
-            Scurve.Fill(event.vcal, event.Nhits)
-            pass
+    for idx, event in iterIndexed(inF.scurveTree, dataIndex, [(VFAT, CHAN)]):
+        Scurve.Fill(event.vcal, event.Nhits)
         pass
     param0 = scanFits[0][VFAT][CHAN]
     param1 = scanFits[1][VFAT][CHAN]
@@ -162,9 +146,6 @@ def overlay_fit(VFAT, CHAN):
 
 for vfat in range(0,24):
     vScurves.append([])
-    vthr_list.append([])
-    trim_list.append([])
-    trimrange_list.append([])
     if options.IsTrimmed:
         lines.append(r.TLine(-0.5, trimVcal[vfat], 127.5, trimVcal[vfat]))
         pass
@@ -192,18 +173,15 @@ for vfat in range(0,24):
         pass
     for chan in range (0,128):
         vScurves[vfat].append(r.TH1D('Scurve_%i_%i'%(vfat,chan),'Scurve_%i_%i;VCal [DAC units]'%(vfat,chan),256,-0.5,255.5))
-        vthr_list[vfat].append(0)
-        trim_list[vfat].append(0)
-        trimrange_list[vfat].append(0)
         pass
     pass
 
 if options.SaveFile:
-    fitter = ScanDataFitter()
+    fitter = ScanDataFitter(options.fitWindow)
     pass
 
 # Fill
-for event in inF.scurveTree:
+for event in timer.counted(treeEvents(filename+'.root', 'scurveTree')):
     strip = chanToStripLUT[event.vfatN][event.vfatCH]
     pan_pin = chanToPanPinLUT[event.vfatN][event.vfatCH]
     if not (options.channels or options.PanPin):
@@ -223,68 +201,63 @@ for event in inF.scurveTree:
     x = vScurves[event.vfatN][event.vfatCH].FindBin(event.vcal)
     vScurves[event.vfatN][event.vfatCH].SetBinContent(x, event.Nhits)
     r.gStyle.SetOptStat(1111111)
-    vthr_list[event.vfatN][event.vfatCH] = event.vthr
-    trim_list[event.vfatN][event.vfatCH] = event.trimDAC
-    trimrange_list[event.vfatN][event.vfatCH] = event.trimRange
+    chamberData['vthr'][event.vfatN, event.vfatCH] = event.vthr
+    chamberData['trimDAC'][event.vfatN, event.vfatCH] = event.trimDAC
+    chamberData['trimRange'][event.vfatN, event.vfatCH] = event.trimRange
     if options.SaveFile:
         fitter.feed(event)
         pass
     pass
 
 if options.SaveFile:
-    scanFits = fitter.fit()
+    timer.start('fit')
+    if options.checkpoint >= 0:
+        from columnar import sourceSignature
+        #The checkpoint is only resumed for the same scan and fit settings
+        scanFits = fitter.fit(filename+'/fitCheckpoint.npz', options.checkpoint,
+                              [sourceSignature(filename+'.root'), options.fitWindow])
+        pass
+    else:
+        scanFits = fitter.fit()
+        pass
     pass
 
 # Determine hot channels
 import numpy as np
 if options.SaveFile:
+    timer.start('mask')
     print 'Determining hot channels'
-    masks = []
-    maskReasons = []
-    effectivePedestals = [ np.zeros(128) for vfat in range(24) ]
+    isDead = np.array(fitter.isDead)
+    maskReasons, effectivePedestals = scurveMaskReasons(scanFits, isDead, fitter.fitValid,
+                                                        ztrim=options.ztrim, zscore=options.zscore)
+    masks = maskReasons != MaskReason.NotMasked
+    fitThresholds = np.array([ scanFits[0][vfat] for vfat in range(0, 24) ])
+    channelNoise = np.array([ scanFits[1][vfat] for vfat in range(0, 24) ])
     for vfat in range(0, 24):
-        trimValue = np.zeros(128)
-        channelNoise = np.zeros(128)
-        fitFailed = np.zeros(128, dtype=bool)
-        for ch in range(0, 128):
-            # Get fit results
-            threshold[0] = scanFits[0][vfat][ch]
-            noise[0] = scanFits[1][vfat][ch]
-            pedestal[0] = scanFits[2][vfat][ch]
-            # Compute values for cuts
-            channelNoise[ch] = noise[0]
-            FittedFunction = r.TF1('myERF','500*TMath::Erf((TMath::Max([2],x)-[0])/(TMath::Sqrt(2)*[1]))+500',1,253)
-            for i in range(3):
-                FittedFunction.SetParameter(i, scanFits[i][vfat][ch])
-                pass
-            effectivePedestals[vfat][ch] = FittedFunction.Eval(0.0)
-            # Compute the value to apply MAD on for each channel
-            trimValue[ch] = threshold[0] - options.ztrim * noise[0]
-            pass
-        fitFailed = np.logical_not(fitter.fitValid[vfat])
-        # Determine outliers
-        hot = isOutlierMADOneSided(trimValue, thresh=options.zscore,
-                                   rejectHighTail=False)
-        # Create reason array
-        reason = np.zeros(128, dtype=int) # Not masked
-        reason[hot] |= MaskReason.HotChannel
-        reason[fitFailed] |= MaskReason.FitFailed
-        reason[fitter.isDead[vfat]] |= MaskReason.DeadChannel
-        reason[channelNoise > 20] |= MaskReason.HighNoise
-        reason[effectivePedestals[vfat] > 50] |= MaskReason.HighEffPed
-        maskReasons.append(reason)
-        masks.append(reason != MaskReason.NotMasked)
+        reason = maskReasons[vfat]
         print 'VFAT %2d: %d dead, %d hot channels, %d failed fits, %d high noise, %d high eff.ped.' % (vfat,
-                np.count_nonzero(fitter.isDead[vfat]),
-                np.count_nonzero(hot),
-                np.count_nonzero(fitFailed),
-                np.count_nonzero(channelNoise > 20),
-                np.count_nonzero(effectivePedestals[vfat] > 50))
+                np.count_nonzero(reason & MaskReason.DeadChannel),
+                np.count_nonzero(reason & MaskReason.HotChannel),
+                np.count_nonzero(reason & MaskReason.FitFailed),
+                np.count_nonzero(reason & MaskReason.HighNoise),
+                np.count_nonzero(reason & MaskReason.HighEffPed))
+        pass
+
+    # Store the fit results and masks
+    chamberData['threshold'] = fitThresholds
+    chamberData['noise'] = channelNoise
+    chamberData['pedestal'] = [ scanFits[2][vfat] for vfat in range(0, 24) ]
+    chamberData['ped_eff'] = effectivePedestals
+    chamberData['chi2'] = [ scanFits[3][vfat] for vfat in range(0, 24) ]
+    chamberData['Nhigh'] = [ scanFits[4][vfat] for vfat in range(0, 24) ]
+    chamberData['ndf'] = [ scanFits[5][vfat] for vfat in range(0, 24) ]
+    chamberData['mask'] = masks
+    chamberData['maskReason'] = maskReasons
 
 # Fill pruned
 if options.SaveFile:
-    for event in inF.scurveTree:
-        if masks[event.vfatN][event.vfatCH]:
+    for event in timer.counted(treeEvents(filename+'.root', 'scurveTree')):
+        if chamberData['mask'][event.vfatN, event.vfatCH]:
             continue
         strip = chanToStripLUT[event.vfatN][event.vfatCH]
         pan_pin = chanToPanPinLUT[event.vfatN][event.vfatCH]
@@ -300,64 +273,56 @@ if options.SaveFile:
 
 # Store values in ROOT file
 if options.SaveFile:
+    timer.start('write')
     fitSums = {}
     for vfat in range (0,24):
-        fitThr = []        
-        fitENC = []
-        stripList = []
-        panList = []
-        chanList = []
+        vfatData = chamberData[vfat]
         for chan in range (0, 128):
-            #Get strip and pan pin
-            strip = chanToStripLUT[vfat][chan]
-            pan_pin = chanToPanPinLUT[vfat][chan]
-            #Store strip, chan and pan pin
-            stripList.append(float(strip))
-            panList.append(float(pan_pin))
-            chanList.append(float(chan))
             #Filling the Branches
-            param0 = scanFits[0][vfat][chan]
-            param1 = scanFits[1][vfat][chan]
-            param2 = scanFits[2][vfat][chan]
-            ped_eff[0] = effectivePedestals[vfat][chan]
+            channelData = vfatData[chan]
             vfatN[0] = vfat
             vfatCH[0] = chan
-            ROBstr[0] = strip
-            panPin[0] = pan_pin
-            trimRange[0] = trimrange_list[vfat][chan] 
-            vthr[0] = vthr_list[vfat][chan]
-            trimDAC[0] = trim_list[vfat][chan]
-            threshold[0] = param0
-            fitThr.append(vToQm*param0+vToQb)
-            noise[0] = param1
-            fitENC.append(vToQm*param1*options.ztrim)
-            pedestal[0] = param2
-            mask[0] = masks[vfat][chan]
-            maskReason[0] = maskReasons[vfat][chan]
-            chi2[0] = scanFits[3][vfat][chan]
-            ndf[0] = int(scanFits[5][vfat][chan])
+            ROBstr[0] = channelData['ROBstr']
+            panPin[0] = channelData['panPin']
+            trimRange[0] = channelData['trimRange']
+            vthr[0] = channelData['vthr']
+            trimDAC[0] = channelData['trimDAC']
+            threshold[0] = channelData['threshold']
+            noise[0] = channelData['noise']
+            pedestal[0] = channelData['pedestal']
+            ped_eff[0] = channelData['ped_eff']
+            mask[0] = channelData['mask']
+            maskReason[0] = channelData['maskReason']
+            chi2[0] = channelData['chi2']
+            ndf[0] = channelData['ndf']
             holder_curve = vScurves[vfat][chan]
             holder_curve.Copy(scurve_h)
-            Nhigh[0] = int(scanFits[4][vfat][chan])
+            Nhigh[0] = channelData['Nhigh']
             #Filling the arrays for plotting later
             if options.drawbad:
-                if (Chi2 > 1000.0 or Chi2 < 1.0):
+                if (chi2[0] > 1000.0 or chi2[0] < 1.0):
                     overlay_fit(vfat, chan)
-                    print "Chi2 is, %d"%(Chi2)
+                    print "Chi2 is, %d"%(chi2[0])
                     pass
                 pass
             myT.Fill()
             pass
+        #Threshold and ENC in fC for the summary graphs
+        fitThr = vToQm*vfatData['threshold'].astype(float)+vToQb
+        fitENC = vToQm*vfatData['noise'].astype(float)*options.ztrim
+        stripList = vfatData['ROBstr'].astype(float)
+        panList = vfatData['panPin'].astype(float)
+        chanList = vfatData['vfatCH'].astype(float)
         if not (options.channels or options.PanPin):
-            fitSums[vfat] = r.TGraphErrors(len(fitThr),np.array(stripList),np.array(fitThr),np.zeros(len(fitThr)),np.array(fitENC))
+            fitSums[vfat] = r.TGraphErrors(len(fitThr),stripList,fitThr,np.zeros(len(fitThr)),fitENC)
             fitSums[vfat].SetTitle("VFAT %i Fit Summary;Strip;Threshold [fC]"%vfat)
             pass
         elif options.channels:
-            fitSums[vfat] = r.TGraphErrors(len(fitThr),np.array(chanList),np.array(fitThr),np.zeros(len(fitThr)),np.array(fitENC))
+            fitSums[vfat] = r.TGraphErrors(len(fitThr),chanList,fitThr,np.zeros(len(fitThr)),fitENC)
             fitSums[vfat].SetTitle("VFAT %i Fit Summary;Channel;Threshold [fC]"%vfat)
             pass
         elif options.PanPin:
-            fitSums[vfat] = r.TGraphErrors(len(fitThr),np.array(panList),np.array(fitThr),np.zeros(len(fitThr)),np.array(fitENC))
+            fitSums[vfat] = r.TGraphErrors(len(fitThr),panList,fitThr,np.zeros(len(fitThr)),fitENC)
             fitSums[vfat].SetTitle("VFAT %i Fit Summary;Panasonic Pin;Threshold [fC]"%vfat)
             pass
         
@@ -375,7 +340,7 @@ def saveSummary(vSummaryPlots, vSummaryPlotsPanPin2, name='Summary'):
             canv.cd(vfat+1)
             if options.IsTrimmed:
                 legend.Clear()
-                legend.AddEntry(line, 'trimVCal is %f'%(trimVcal[vfat]))
+                legend.AddEntry(lines[vfat], 'trimVCal is %f'%(trimVcal[vfat]))
                 legend.Draw('SAME')
                 print trimVcal[vfat]
                 lines[vfat].SetLineColor(1)
@@ -404,6 +369,7 @@ def saveSummary(vSummaryPlots, vSummaryPlotsPanPin2, name='Summary'):
 
     canv.SaveAs(filename+'/%s.png' % name)
 
+timer.start('render')
 saveSummary(vSummaryPlots, vSummaryPlotsPanPin2)
 if options.SaveFile:
     saveSummary(vSummaryPlotsPruned, vSummaryPlotsPrunedPanPin2, name='PrunedSummary')
@@ -415,18 +381,22 @@ if options.SaveFile:
     pass
 
 if options.SaveFile:
-    confF = open(filename+'/chConfig.txt','w')
-    confF.write('vfatN/I:vfatCH/I:trimDAC/I:mask/I\n')
-    for vfat in range (0,24):
-        for chan in range (0, 128):
-            confF.write('%i\t%i\t%i\t%i\n'%(vfat,chan,trim_list[vfat][chan],masks[vfat][chan]))
-            pass
+    timer.start('write')
+    from configfiles import chConfigType, writeConfig
+    chConfig = np.zeros((24,128), dtype=chConfigType)
+    for name in chConfigType.names:
+        chConfig[name] = chamberData[name]
         pass
-    confF.close()
+    writeConfig(filename+'/chConfig.txt', chConfig, binary=True)
     outF.cd()
     for vfat in fitSums.keys():
         fitSums[vfat].Write()
         pass
     myT.Write()
     outF.Close()
+    if os.path.isfile(filename+'/fitCheckpoint.npz'):
+        os.remove(filename+'/fitCheckpoint.npz')
+        pass
     pass
+
+timer.dump()
@@ -5,6 +5,8 @@ from optparse import OptionParser
 from array import array
 from mapping.channelMaps import *
 from mapping.PanChannelMaps import *
+from anautilities import StageTimer
+from columnar import treeEvents
 from gempython.utils.nesteddict import nesteddict as ndict
 
 from anaoptions import parser
@@ -18,11 +20,16 @@ parser.set_defaults(outfilename="VThreshold1Data_Trimmed.root")
 
 (options, args) = parser.parse_args()
 filename = options.filename[:-5]
-os.system("mkdir " + filename)
+if not os.path.isdir(filename):
+    os.makedirs(filename)
+    pass
 
 print filename
 outfilename = options.outfilename
 
+timer = StageTimer(options.timing)
+timer.start('read')
+
 import ROOT as r
 r.gROOT.SetBatch(True)
 GEBtype = options.GEBtype
@@ -31,47 +38,22 @@ outF = r.TFile(filename+'/'+outfilename, 'recreate')
 
 VT1_MAX = 255
 
-#Build the channel to strip mapping from the text file
-lookup_table = []
-pan_lookup = []
-vfatCh_lookup = []
-for vfat in range(0,24):
-    lookup_table.append([])
-    pan_lookup.append([])
-    vfatCh_lookup.append([])
-    for channel in range(0,128):
-        lookup_table[vfat].append(0)
-        pan_lookup[vfat].append(0)
-        vfatCh_lookup[vfat].append(0)
-        pass
-    pass
-
+#Load the channel to strip mapping
 from gempython.utils.wrappers import envCheck
 envCheck('GEM_PLOTTING_PROJECT')
 
-projectHome = os.environ.get('GEM_PLOTTING_PROJECT')
-if GEBtype == 'long':
-    intext = open(projectHome+'/mapping/longChannelMap.txt', 'r')
+from mapping.mapFiles import loadChannelMap
+channelMap = loadChannelMap(GEBtype)
+lookup_table = channelMap['chanToStrip'].tolist()
+pan_lookup = channelMap['chanToPanPin'].tolist()
+if not (options.channels or options.PanPin):     #Readout Strips
+    vfatCh_lookup = channelMap['stripToChan'].tolist()
     pass
-if GEBtype == 'short':
-    intext = open(projectHome+'/mapping/shortChannelMap.txt', 'r')
+elif options.channels:                #VFAT Channels
+    vfatCh_lookup = [ range(0,128) for vfat in range(0,24) ]
     pass
-
-for i, line in enumerate(intext):
-    if i == 0: continue
-    mapping = line.rsplit('\t')
-    lookup_table[int(mapping[0])][int(mapping[2]) -1] = int(mapping[1])
-    pan_lookup[int(mapping[0])][int(mapping[2]) -1] = int(mapping[3])
-    
-    if not (options.channels or options.PanPin):     #Readout Strips
-        vfatCh_lookup[int(mapping[0])][int(mapping[1])]=int(mapping[2]) - 1
-        pass
-    elif options.channels:                #VFAT Channels
-        vfatCh_lookup[int(mapping[0])][int(mapping[2]) -1]=int(mapping[2]) - 1
-        pass
-    elif options.PanPin:                #Panasonic Connector Pins
-        vfatCh_lookup[int(mapping[0])][int(mapping[3])]=int(mapping[2]) - 1
-        pass
+elif options.PanPin:                #Panasonic Connector Pins
+    vfatCh_lookup = channelMap['panPinToChan'].tolist()
     pass
 
 print 'Initializing Histograms'
@@ -95,7 +77,7 @@ for vfat in range(0,24):
 
 print 'Filling Histograms'
 trimRange = dict((vfat,0) for vfat in range(0,24))
-for event in inF.thrTree :
+for event in timer.counted(treeEvents(filename+'.root', 'thrTree')):
     strip = lookup_table[event.vfatN][event.vfatCH]
     pan_pin = pan_lookup[event.vfatN][event.vfatCH]
     trimRange[int(event.vfatN)] = int(event.trimRange)
@@ -112,18 +94,19 @@ for event in inF.thrTree :
     pass
 
 #Determine Hot Channels
+timer.start('mask')
 print 'Determining hot channels'
 from anautilities import *
 import numpy as np
-import root_numpy as rp #note need root_numpy-4.7.2 (may need to run 'pip install root_numpy --upgrade')
 dict_hMaxVT1 = {}
 dict_hMaxVT1_NoOutlier = {}
+allChanMaxVT1 = np.zeros((24,2,vSum[0].GetNbinsX()))
 for vfat in range(0,24):
     dict_hMaxVT1[vfat]          = r.TH1F('vfat%iChanMaxVT1'%vfat,"vfat%i"%vfat,256,-0.5,255.5)
     dict_hMaxVT1_NoOutlier[vfat]= r.TH1F('vfat%iChanMaxVT1_NoOutlier'%vfat,"vfat%i - No Outliers"%vfat,256,-0.5,255.5)
 
     #For each channel determine the maximum thresholds
-    chanMaxVT1 = np.zeros((2,vSum[vfat].GetNbinsX()))
+    chanMaxVT1 = allChanMaxVT1[vfat]
     for chan in range(0,vSum[vfat].GetNbinsX()):
         for thresh in range(vSum[vfat].ProjectionY("projY",chan,chan,"").GetMaximumBin(),VT1_MAX+1):
             if(vSum[vfat].ProjectionY("projY",chan,chan,"").GetBinContent(thresh) == 0):
@@ -133,9 +116,13 @@ for vfat in range(0,24):
                 break
             pass
         pass
+    pass
 
-    #Determine Outliers (e.g. "hot" channels)
-    chanOutliers = isOutlierMADOneSided(chanMaxVT1[1,:], thresh=options.zscore)
+#Determine Outliers (e.g. "hot" channels) for all VFATs at once
+allChanOutliers = isOutlierMADOneSided(allChanMaxVT1[:,1,:], thresh=options.zscore)
+for vfat in range(0,24):
+    chanMaxVT1 = allChanMaxVT1[vfat]
+    chanOutliers = allChanOutliers[vfat]
     for chan in range(0,len(chanOutliers)):
         hot_channels[vfat][chan] = chanOutliers[chan]
         
@@ -154,29 +141,24 @@ for vfat in range(0,24):
         pass
     pass
 
-# Fetch trimDAC & chMask from scurveFitTree
-dict_vfatTrimMaskData = {}
+# Fetch trimDAC & chMask from scurveFitTree, nothing masked if it can not be read
+vfatTrimMaskData = initChamberArray()
 if options.chConfigKnown:
-    list_bNames = ["vfatN"]
+    #Index the records as the x-axis of vSum
     if not (options.channels or options.PanPin):
-        list_bNames.append("ROBstr")
+        indexKey = "ROBstr"
         pass
     elif options.channels:
-        list_bNames.append("vfatCh")
+        indexKey = "vfatCH"
         pass
     elif options.PanPin:
-        list_bNames.append("panPin")
+        indexKey = "panPin"
         pass
-    list_bNames.append("mask")
-    list_bNames.append("trimDAC")
 
     try:
-        array_VFATSCurveData = rp.root2array(options.fileScurveFitTree,treename="scurveFitTree",branches=list_bNames)
-        dict_vfatTrimMaskData = dict((idx,initVFATArray(array_VFATSCurveData.dtype)) for idx in np.unique(array_VFATSCurveData[list_bNames[0]]))
-        for dataPt in array_VFATSCurveData:
-            dict_vfatTrimMaskData[dataPt['vfatN']][dataPt[list_bNames[1]]]['mask'] =  dataPt['mask']
-            dict_vfatTrimMaskData[dataPt['vfatN']][dataPt[list_bNames[1]]]['trimDAC'] =  dataPt['trimDAC']
-            pass
+        #The last entry of a channel wins if the file holds several scans
+        scurveFitData = chamberArrayFromTree(options.fileScurveFitTree,branches=["ROBstr","panPin","mask","trimDAC"])[-1]
+        vfatTrimMaskData = reindexChamberArray(scurveFitData, indexKey)
         pass
     except Exception as e:
         print '%s does not seem to exist'%options.fileScurveFitTree
@@ -185,6 +167,7 @@ if options.chConfigKnown:
     pass
 
 #Save Output
+timer.start('render')
 outF.cd()
 canv = r.TCanvas('canv','canv',500*8,500*3)
 canv.Divide(8,3)
@@ -231,7 +214,7 @@ for vfat in range(0,24):
         isHotChan = hot_channels[vfat][chan]
        
         if options.chConfigKnown:
-            isHotChan = (isHotChan or dict_vfatTrimMaskData[vfat][chan]['mask'])
+            isHotChan = (isHotChan or vfatTrimMaskData[vfat][chan]['mask'])
             pass
 
         if isHotChan:
@@ -281,40 +264,35 @@ for vfat in range(0,24):
         pass
     pass
 outF.Close()
-txt_vfat = open(filename+"/vfatConfig.txt", 'w')
+timer.start('write')
+from configfiles import chConfigType, vfatConfigType, formatConfigText, writeConfig
 
 print "trimRange:"
 print trimRange
 print "vt1:"
 print vt1
 
-txt_vfat.write("vfatN/I:vt1/I:trimRange/I\n")
-for vfat in range(0,24):
-    txt_vfat.write('%i\t%i\t%i\n'%(vfat, vt1[vfat],trimRange[vfat]))
-    pass
-txt_vfat.close()
+vfatConfig = np.zeros(24, dtype=vfatConfigType)
+vfatConfig['vfatN'] = range(0,24)
+vfatConfig['vt1'] = [ vt1[vfat] for vfat in range(0,24) ]
+vfatConfig['trimRange'] = [ trimRange[vfat] for vfat in range(0,24) ]
+writeConfig(filename+"/vfatConfig.txt", vfatConfig, binary=True)
 
 #Update channel registers configuration file
 if options.chConfigKnown:
-    confF = open(filename+'/chConfig_MasksUpdated.txt','w')
-    confF.write('vfatN/I:vfatCH/I:trimDAC/I:mask/I\n')
+    #Rows are ordered as the x-axis of vSum
+    chConfig = np.zeros((24,128), dtype=chConfigType)
+    chConfig['vfatN'] = np.arange(24).reshape(-1,1)
+    chConfig['vfatCH'] = vfatCh_lookup
+    chConfig['trimDAC'] = vfatTrimMaskData['trimDAC']
+    chConfig['mask'] = np.logical_or(hot_channels, vfatTrimMaskData['mask'])
 
     if options.debug:
-        print 'vfatN/I:vfatCH/I:trimDAC/I:mask/I\n'
-        pass
-
-    for vfat in range (0,24):
-        for j in range (0, 128):
-            chan = vfatCh_lookup[vfat][j]
-            if options.debug:
-                print '%i\t%i\t%i\t%i\n'%(vfat,chan,dict_vfatTrimMaskData[vfat][j]['trimDAC'],int(hot_channels[vfat][j] or dict_vfatTrimMaskData[vfat][j]['mask']))
-                pass
-
-            confF.write('%i\t%i\t%i\t%i\n'%(vfat,chan,dict_vfatTrimMaskData[vfat][j]['trimDAC'],int(hot_channels[vfat][j] or dict_vfatTrimMaskData[vfat][j]['mask'])))
-            pass
+        print formatConfigText(chConfig)
         pass
 
-    confF.close()
+    writeConfig(filename+'/chConfig_MasksUpdated.txt', chConfig, binary=True)
     pass
 
+timer.dump()
 print 'Analysis Completed Successfully'
@@ -2,7 +2,6 @@
 
 import sys, re
 import time, datetime, os
-import ROOT as r
 
 sys.path.append('${GEM_PYTHON_PATH}')
 
@@ -21,6 +20,8 @@ if __name__ == "__main__":
                       help="Minimum value of scan parameter range to look at", metavar="scanmin")
     parser.add_option("--scanmax", type="int", dest="scanmax", default=256,
                       help="Maximum value of scan parameter range to look at", metavar="scanmax")
+    parser.add_option("--timing", type="string", dest="timing", default=None,
+                      help="Write the wall/CPU time, entries and memory of each stage as JSON to this file (default is $GEM_ANA_STAGE_TIMING)", metavar="timing")
     
     (options, args) = parser.parse_args()
     
@@ -32,6 +33,12 @@ if __name__ == "__main__":
         print "Please specify a valid AMC [0,1]"
         exit(0)
 
+    import ROOT as r
+    from anautilities import StageTimer
+
+    timer = StageTimer(options.timing)
+    timer.start('read')
+
     infilename = "%s"%(options.infile)
     
     latencyMean = r.TH1D("latencyMean", "Latency spread across all VFATs", (options.scanmax-options.scanmin)*10, options.scanmin, options.scanmax)
@@ -54,7 +61,7 @@ if __name__ == "__main__":
     latCan = r.TCanvas("latCan","latCan", 1000,1000)
     latCan.Divide(5,5)
 
-    for i,vfat in enumerate(vfatDirs):
+    for i,vfat in enumerate(timer.counted(vfatDirs)):
         inHist = infile.Get(baseDir+vfat+"/latencyScan")
         print inHist
         if inHist:
@@ -81,6 +88,7 @@ if __name__ == "__main__":
             pass
         pass
     
+    timer.start('render')
     latCan.cd(25)
     allVFATsLatency.GetXaxis().SetRangeUser(options.scanmin,options.scanmax)
     allVFATsLatency.Draw()
@@ -97,4 +105,5 @@ if __name__ == "__main__":
     latencyRMS.Draw("ep0")
     outCan.SaveAs("~/latency_scan_AMC13%02d_AMC%02d_OH%02d_%s.pdf"%(options.amc13,options.slot,options.gtx,outname))
     outCan.SaveAs("~/latency_scan_AMC13%02d_AMC%02d_OH%02d_%s.png"%(options.amc13,options.slot,options.gtx,outname))
+    timer.dump()
     raw_input("press enter to quit")
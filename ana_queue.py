@@ -0,0 +1,380 @@
+#!/bin/env python
+"""
+Distributes ana_scans.py jobs over several analysis nodes.
+
+A coordinator holds the (anaType, scandate, chamber) jobs of a campaign and
+serves them through a multiprocessing manager. Workers on any node connect to
+it, take one job at a time, send heartbeats while they run it and report its
+record back. Jobs held by a worker that stops sending heartbeats are put back
+in the queue. A worker that only stalled may still finish its attempt, which
+writes the same outputs, so the campaign also waits for every such attempt to
+report or to miss heartbeats for another timeout. Once every job is done the
+coordinator publishes the outputs and writes the run report and the chamber
+arrays of the scurve and trim analyses exactly as ana_scans.py does, the
+workers send these arrays back with the records.
+
+Example, with four local workers started by the coordinator and four more on
+another node:
+
+    ana_queue.py --coordinator --anaType=scurve,trim --address=node1:50000 --nworkers=4
+    ana_queue.py --worker --address=node1:50000 --nworkers=4
+
+DATA_PATH and ELOG_PATH must point to the same shared area on every node.
+The coordinator runs the calls of anyone holding the key, so a secret key
+must be given with --authkey or $GEM_ANA_QUEUE_AUTHKEY unless it listens on
+localhost only, where a random key readable by the user alone is used.
+"""
+
+import binascii
+import collections
+import errno
+import os
+import socket
+import threading
+import time
+from multiprocessing.managers import BaseManager
+#Imported before the manager threads unpickle the chamber arrays of the
+#records, which would otherwise import it from several threads at once
+import numpy
+
+class JobBoard(object):
+    """Holds the pending jobs, the jobs leased to workers and the records of
+    the finished ones. Served to the workers by QueueManager."""
+
+    def __init__(self, jobs, leaseTimeout=60., maxAttempts=3):
+        self.jobs = list(jobs)
+        self.leaseTimeout = leaseTimeout
+        self.maxAttempts = maxAttempts
+        self.lock = threading.Lock()
+        self.pending = collections.deque(range(len(self.jobs)))
+        self.leases = {} # (jobId, workerId) -> time of last heartbeat
+        self.superseded = set() # leases whose job was requeued or given up
+        self.attempts = [ 0 for job in self.jobs ]
+        self.records = {}
+
+    def take(self, workerId):
+        """Returns (jobId, job) for the next pending job, or None if there is
+        none at the moment"""
+        with self.lock:
+            if not self.pending:
+                return None
+            jobId = self.pending.popleft()
+            self.leases[(jobId, workerId)] = time.time()
+            self.attempts[jobId] += 1
+            return (jobId, self.jobs[jobId])
+
+    def heartbeat(self, workerId):
+        """Extends the leases of all jobs held by workerId"""
+        now = time.time()
+        with self.lock:
+            for lease in self.leases.keys():
+                if lease[1] == workerId:
+                    self.leases[lease] = now
+
+    def report(self, workerId, jobId, record):
+        """Stores the record of jobId and ends the lease of workerId on it.
+        Only the first report of a job counts, a late one from a worker
+        considered dead is ignored."""
+        with self.lock:
+            self.leases.pop((jobId, workerId), None)
+            self.superseded.discard((jobId, workerId))
+            if jobId in self.records:
+                return
+            self.records[jobId] = record
+            if jobId in self.pending:
+                self.pending.remove(jobId)
+
+    def requeueExpired(self):
+        """Puts the jobs whose lease expired back in the queue, or gives them
+        up after maxAttempts. The expired lease is kept as superseded, as
+        its worker may only have stalled, and dropped once it also missed
+        heartbeats for another leaseTimeout. Returns the list of requeued
+        job ids."""
+        from ana_scans import jobRecord
+
+        now = time.time()
+        requeued = []
+        with self.lock:
+            for lease, lastBeat in self.leases.items():
+                jobId, workerId = lease
+                if now - lastBeat < self.leaseTimeout:
+                    continue
+                if lease in self.superseded:
+                    if now - lastBeat >= 2*self.leaseTimeout:
+                        print "Worker %s lost, no longer waiting for its attempt of job %i"%(workerId, jobId)
+                        del self.leases[lease]
+                        self.superseded.discard(lease)
+                    continue
+                self.superseded.add(lease)
+                if jobId in self.records:
+                    continue
+                if self.attempts[jobId] < self.maxAttempts:
+                    print "Worker %s lost, requeuing job %i"%(workerId, jobId)
+                    self.pending.append(jobId)
+                    requeued.append(jobId)
+                else:
+                    print "Worker %s lost, giving up job %i after %i attempts"%(workerId, jobId, self.attempts[jobId])
+                    job = self.jobs[jobId]
+                    self.records[jobId] = jobRecord(job[0], job[1], job[3])
+                    self.records[jobId]["status"] = "lost"
+        return requeued
+
+    def finished(self):
+        """True once every job has a record and no attempt of a job, even
+        superseded, may still write its outputs"""
+        with self.lock:
+            return len(self.records) == len(self.jobs) and not self.leases
+
+    def status(self):
+        """Returns the number of pending, running and finished jobs"""
+        with self.lock:
+            return (len(self.pending), len(self.leases) - len(self.superseded), len(self.records))
+
+    def allRecords(self):
+        """Returns the records in job order"""
+        with self.lock:
+            return [ self.records.get(jobId) for jobId in range(len(self.jobs)) ]
+
+class QueueManager(BaseManager):
+    pass
+
+def parseAddress(address):
+    """Converts 'host:port' to (host, port)"""
+    host, port = address.rsplit(':', 1)
+    return (host, int(port))
+
+def isLocalAddress(address):
+    """Returns True if the (host, port) address is only reachable from this node"""
+    return address[0] in ['localhost', '127.0.0.1', '::1']
+
+def localAuthkey(keyFile='~/.gem_ana_queue_authkey'):
+    """Returns the key of this user for a coordinator and workers on
+    localhost, stored in keyFile with user only permissions and created at
+    random on first use"""
+    keyFile = os.path.expanduser(keyFile)
+    try:
+        fd = os.open(keyFile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        os.write(fd, binascii.hexlify(os.urandom(16)))
+        os.close(fd)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        pass
+    with open(keyFile, 'r') as inF:
+        return inF.read().strip()
+
+def launchAnaReturning(job):
+    """Runs job as ana_scans.launchAna does, returning the chamber array the
+    analysis leaves, if any, in record["chamberData"] as the coordinator does
+    not share the memory of the workers (see ana_scans.writeChamberResults)"""
+    import ana_scans
+    from sharedresults import SharedResults
+
+    slots, nSlots = ana_scans.sharedSlots([job])
+    if nSlots == 0:
+        return ana_scans.launchAnaArgs(*job)
+    #One slot reused by every job of this worker
+    if ana_scans.sharedResults is None:
+        ana_scans.sharedResults = SharedResults(1)
+        pass
+    record = ana_scans.launchAnaArgs(*job, slot=0)
+    if record["slot"] is not None:
+        record["chamberData"] = ana_scans.sharedResults.slot(0).copy()
+        record["slot"] = None
+        pass
+    return record
+
+def serveBoard(board, address, authkey):
+    """Serves board at address from a daemon thread of this process"""
+    QueueManager.register('board', callable=lambda: board)
+    manager = QueueManager(address=address, authkey=authkey)
+    server = manager.get_server()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def runWorker(address, authkey, heartbeat=10., target=None):
+    """Takes jobs from the coordinator at address until all are done.
+    target is called with each job and returns its record, by default
+    launchAnaReturning."""
+    from ana_scans import jobRecord
+
+    if target is None:
+        target = launchAnaReturning
+        pass
+
+    QueueManager.register('board')
+    manager = QueueManager(address=address, authkey=authkey)
+    manager.connect()
+    board = manager.board()
+    workerId = "%s:%i"%(socket.gethostname(), os.getpid())
+
+    # Heartbeats are sent from a thread so that they continue while a job runs
+    stop = threading.Event()
+    def beat():
+        while not stop.wait(heartbeat):
+            try:
+                board.heartbeat(workerId)
+            except (EOFError, IOError, socket.error):
+                return
+    beatThread = threading.Thread(target=beat)
+    beatThread.daemon = True
+    beatThread.start()
+
+    nJobs = 0
+    try:
+        while True:
+            taken = board.take(workerId)
+            if taken is None:
+                if board.finished():
+                    break
+                # Other jobs may still be requeued
+                time.sleep(heartbeat)
+                continue
+            jobId, job = taken
+            try:
+                record = target(job)
+            except Exception as e:
+                print "Worker %s: job %i raised %s"%(workerId, jobId, e)
+                record = jobRecord(job[0], job[1], job[3])
+                record["status"] = "failed"
+                record["error"] = str(e)
+                pass
+            board.report(workerId, jobId, record)
+            nJobs += 1
+            pass
+    except (EOFError, IOError, socket.error):
+        print "Worker %s: lost connection to the coordinator"%(workerId)
+        pass
+    finally:
+        stop.set()
+        pass
+    print "Worker %s: done after %i jobs"%(workerId, nJobs)
+    return nJobs
+
+def startWorkers(nworkers, address, authkey, heartbeat=10., target=None, warm=True):
+    """Starts nworkers local worker processes. With warm=True the analysis
+    modules are loaded once here so that the forked workers inherit them,
+    unless there are none to start, e.g. for a coordinator alone."""
+    from multiprocessing import Process
+
+    if warm and target is None and nworkers > 0:
+        from ana_scans import initAnaWorker
+        initAnaWorker()
+        pass
+    workers = []
+    for idx in range(nworkers):
+        worker = Process(target=runWorker, args=(address, authkey, heartbeat, target))
+        worker.start()
+        workers.append(worker)
+        pass
+    return workers
+
+def runCoordinator(jobs, address, authkey, heartbeat=10., nworkers=0, target=None):
+    """Serves jobs at address until every one is done, then returns the
+    list of records. nworkers local workers are started as well."""
+    board = JobBoard(jobs, leaseTimeout=3*heartbeat)
+    serveBoard(board, address, authkey)
+    print "Serving %i jobs at %s:%i"%(len(jobs), address[0], address[1])
+
+    workers = startWorkers(nworkers, address, authkey, heartbeat, target)
+    lastStatus = None
+    while not board.finished():
+        time.sleep(heartbeat)
+        board.requeueExpired()
+        status = board.status()
+        if status != lastStatus:
+            print "Jobs pending: %i, running: %i, done: %i"%status
+            lastStatus = status
+            pass
+        pass
+
+    # Give the remote workers a chance to see that the campaign is over
+    time.sleep(heartbeat)
+    for worker in workers:
+        worker.join()
+        pass
+    return board.allRecords()
+
+if __name__ == '__main__':
+    from anaInfo import ana_config
+    from gempython.utils.wrappers import envCheck
+
+    from anaoptions import parser
+
+    parser.add_option("--anaType", type="string", dest="anaType",
+                      help="Comma separated analysis types to be executed, from list {'latency','scurve','threshold','trim'}", metavar="anaType")
+    parser.add_option("--coordinator", action="store_true", dest="coordinator",
+                      help="Serve the jobs of the campaign to the workers", metavar="coordinator")
+    parser.add_option("--worker", action="store_true", dest="worker",
+                      help="Take jobs from the coordinator", metavar="worker")
+    parser.add_option("--address", type="string", dest="address", default="localhost:50000",
+                      help="host:port the coordinator listens on", metavar="address")
+    parser.add_option("--authkey", type="string", dest="authkey", default=os.getenv('GEM_ANA_QUEUE_AUTHKEY'),
+                      help="Secret key shared by the coordinator and the workers (default is $GEM_ANA_QUEUE_AUTHKEY), required unless the address is localhost", metavar="authkey")
+    parser.add_option("--nworkers", type="int", dest="nworkers", default=0,
+                      help="Number of worker processes to start on this node", metavar="nworkers")
+    parser.add_option("--heartbeat", type="float", dest="heartbeat", default=10.,
+                      help="Seconds between worker heartbeats, jobs are requeued after three missed ones", metavar="heartbeat")
+    parser.add_option("--subprocess", action="store_true", dest="subprocess",
+                      help="Launch each analysis in a new interpreter instead of running it in a warm worker", metavar="subprocess")
+    parser.add_option("--force", action="store_true", dest="force",
+                      help="Rerun analyses even if their outputs are up to date", metavar="force")
+    parser.add_option("--report", type="string", dest="report", default=None,
+                      help="Basename of the JSON/CSV run report (default is $ELOG_PATH/<scandate>/anaReport_<anaType>)", metavar="report")
+
+    (options, args) = parser.parse_args()
+
+    if options.coordinator == options.worker:
+        print "Please specify exactly one of --coordinator or --worker"
+        exit(1)
+        pass
+
+    envCheck('BUILD_HOME')
+    envCheck('DATA_PATH')
+    envCheck('ELOG_PATH')
+
+    address = parseAddress(options.address)
+    if not options.authkey:
+        if not isLocalAddress(address):
+            print "Please give a secret key with --authkey or $GEM_ANA_QUEUE_AUTHKEY, anyone with the key can run code on the coordinator"
+            exit(1)
+            pass
+        options.authkey = localAuthkey()
+        pass
+    if options.worker:
+        workers = startWorkers(max(options.nworkers, 1), address, options.authkey, options.heartbeat)
+        for worker in workers:
+            worker.join()
+            pass
+        exit(0)
+        pass
+
+    from ana_scans import anaJobs, publishOutputs, writeChamberResults, writeReport
+
+    if options.anaType is None:
+        print "Please specify the analysis types with --anaType"
+        exit(1)
+        pass
+    anaTypes = options.anaType.split(',')
+    scandates = options.scandate.split(',')
+    for anaType in anaTypes:
+        if anaType not in ana_config.keys():
+            print "Invalid analysis specificed, please select only from the list:"
+            print ana_config.keys()
+            exit(1)
+            pass
+        pass
+
+    jobs = anaJobs(options, anaTypes, scandates)
+    records = runCoordinator(jobs, address, options.authkey, options.heartbeat, options.nworkers)
+
+    publishOutputs([ pair for record in records for pair in record["publish"] ])
+    if options.report is None:
+        options.report = "%s/%s/anaReport_%s"%(os.getenv('ELOG_PATH'),scandates[0],'_'.join(anaTypes))
+        pass
+    #The chamber arrays go to <report>_chambers.npz, not to the JSON report
+    writeReport([ dict( (key, value) for key, value in record.iteritems() if key != "chamberData" )
+                  for record in records if record is not None ], options.report)
+    writeChamberResults(records, options.report)
@@ -4,15 +4,450 @@
          Brian Dorney (brian.l.dorney@cern.ch)
 
 """
+#SharedResults receiving the per-channel results of the jobs, created by the
+#parent before the Pool so that the workers inherit it, see launchAnaShared
+sharedResults = None
+
+#Analyses leaving a chamber array in their chamberData global
+chamberResultTypes = ["scurve","trim"]
+
+def initAnaWorker():
+  """Imports everything the analysis scripts need so that it is paid once per
+  worker and not once per job. When called in the parent before the Pool is
+  created the forked workers inherit the loaded ROOT dictionaries."""
+  import ROOT as r
+  r.gROOT.SetBatch(True)
+  import numpy
+  try:
+    import root_numpy
+  except ImportError:
+    pass
+  import anautilities
+  import fitting.fitScanData
+  import mapping.channelMaps
+  import mapping.PanChannelMaps
+  import mapping.mapFiles
+  from gempython.utils.nesteddict import nesteddict
+  from gempython.utils.wrappers import envCheck
+  return
+
+def runAnaInProcess(cmd, results=None):
+  """Runs the analysis script cmd[0] with arguments cmd[1:] inside the current
+  interpreter, raising CalledProcessError on failure like runCommand does.
+  The keys of the dictionary results are set to the global variables of the
+  same name left by the script, e.g. {"chamberData":None}."""
+  import gc
+  import os
+  import runpy
+  import sys
+  from subprocess import CalledProcessError
+
+  script = cmd[0]
+  if not os.path.isfile(script):
+    projectHome = os.getenv('GEM_PLOTTING_PROJECT', os.path.dirname(os.path.abspath(__file__)))
+    script = os.path.join(projectHome, script)
+    pass
+
+  # The scripts add their own options to the shared anaoptions parser on
+  # import, so each run needs a fresh copy of it
+  sys.modules.pop('anaoptions', None)
+  oldArgv = sys.argv
+  sys.argv = [script] + list(cmd[1:])
+  returncode = 0
+  try:
+    scriptGlobals = runpy.run_path(script, run_name='__main__')
+    if results is not None:
+      for name in results.keys():
+        results[name] = scriptGlobals.get(name)
+        pass
+      pass
+    del scriptGlobals
+  except SystemExit as e:
+    if e.code not in (None, 0):
+      returncode = e.code if isinstance(e.code, int) else 1
+      pass
+    pass
+  except Exception as e:
+    print "Caught exception running %s: %s"%(cmd[0], e)
+    returncode = 1
+    pass
+  finally:
+    # Write the timing of a script that stopped early now, rather than when
+    # the worker exits
+    from anautilities import dumpStageTimers
+    dumpStageTimers()
+    sys.argv = oldArgv
+    sys.modules.pop('anaoptions', None)
+    # Release the ROOT objects held by the script globals before the next job
+    gc.collect()
+    pass
+
+  if returncode != 0:
+    raise CalledProcessError(returncode, cmd)
+  return
+
+def fileSignature(filename, withHash=True):
+  """Returns a dictionary describing the current state of filename"""
+  import hashlib
+  import os
+
+  stat = os.stat(filename)
+  signature = { "size":stat.st_size, "mtime":stat.st_mtime }
+  if withHash:
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as inF:
+      for block in iter(lambda: inF.read(1<<20), b''):
+        sha1.update(block)
+        pass
+      pass
+    signature["sha1"] = sha1.hexdigest()
+    pass
+  return signature
+
+def anaToolVersion(script):
+  """Returns a hash of the analysis script and of the modules it relies on,
+  so that a change of the analysis code invalidates previous outputs"""
+  import hashlib
+  import os
+
+  projectHome = os.getenv('GEM_PLOTTING_PROJECT', os.path.dirname(os.path.abspath(__file__)))
+  sha1 = hashlib.sha1()
+  for module in [script, "anaoptions.py", "anautilities.py", "anaInfo.py",
+                 "fitting/fitScanData.py", "mapping/channelMaps.py", "mapping/PanChannelMaps.py",
+                 "mapping/mapFiles.py", "treeindex.py", "columnar.py", "configfiles.py"]:
+    path = os.path.join(projectHome, module)
+    if os.path.isfile(path):
+      with open(path, 'rb') as inF:
+        sha1.update(inF.read())
+        pass
+      pass
+    pass
+  return sha1.hexdigest()
+
+def isUpToDate(manifestFile, inputs, cmd, outputs):
+  """Checks whether the manifest written by a previous run of cmd matches the
+  current inputs, options and tool version, and all outputs still exist"""
+  import json
+  import os
+
+  if not os.path.isfile(manifestFile):
+    return False
+  try:
+    with open(manifestFile, 'r') as inF:
+      manifest = json.load(inF)
+      pass
+  except ValueError:
+    return False
+
+  if manifest.get("cmd") != cmd[1:]:
+    return False
+  if manifest.get("version") != anaToolVersion(cmd[0]):
+    return False
+  for output in outputs:
+    if not os.path.isfile(output):
+      return False
+    pass
+
+  storedInputs = manifest.get("inputs", {})
+  if sorted(storedInputs.keys()) != sorted(inputs):
+    return False
+  for filename in inputs:
+    if not os.path.isfile(filename):
+      return False
+    stored = storedInputs[filename]
+    current = fileSignature(filename, withHash=False)
+    if current["size"] != stored["size"]:
+      return False
+    # Only rehash when the file has been touched
+    if current["mtime"] != stored["mtime"] and fileSignature(filename)["sha1"] != stored["sha1"]:
+      return False
+    pass
+  return True
+
+def writeManifest(manifestFile, inputs, cmd, outputs):
+  """Records the state of a successful analysis run, see isUpToDate"""
+  import json
+
+  manifest = {
+      "cmd":cmd[1:],
+      "version":anaToolVersion(cmd[0]),
+      "inputs":dict((filename, fileSignature(filename)) for filename in inputs),
+      "outputs":outputs
+      }
+  with open(manifestFile, 'w') as outF:
+    json.dump(manifest, outF, indent=2, sort_keys=True)
+    pass
+  return
+
+def runAnaMeasured(cmd, inProcess=False, cwd=None, env=None, results=None):
+  """Runs the analysis cmd and returns its exit status together with the wall
+  time, CPU time (user+sys, seconds) and peak RSS (kB) it used. For in-process
+  runs the peak RSS is the one of the worker over its lifetime, and results
+  is filled as by runAnaInProcess. cwd and env are those of the subprocess,
+  they are ignored for in-process runs."""
+  import os
+  import resource
+  import subprocess
+  import time
+  from subprocess import CalledProcessError
+
+  usage = { "returncode":0 }
+  start = time.time()
+  if inProcess:
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    try:
+      runAnaInProcess(cmd, results)
+    except CalledProcessError as e:
+      usage["returncode"] = e.returncode
+      pass
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    usage["cpu"] = (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime)
+    usage["maxrss"] = after.ru_maxrss
+    pass
+  else:
+    # wait4 gives the resources used by this child only
+    proc = subprocess.Popen(cmd, cwd=cwd, env=env)
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    if os.WIFEXITED(status):
+      proc.returncode = os.WEXITSTATUS(status)
+      pass
+    else:
+      proc.returncode = -os.WTERMSIG(status)
+      pass
+    usage["returncode"] = proc.returncode
+    usage["cpu"] = rusage.ru_utime + rusage.ru_stime
+    usage["maxrss"] = rusage.ru_maxrss
+    pass
+  usage["wall"] = time.time() - start
+  return usage
+
+def writeReport(records, basename):
+  """Writes the job records returned by launchAnaArgs to basename.json and
+  basename.csv, the latter with one wall time column per analysis stage, and
+  the totals of each stage of each analysis type to basename_stages.csv"""
+  import csv
+  import json
+  import os
+
+  reportDir = os.path.dirname(basename)
+  if reportDir and not os.path.isdir(reportDir):
+    os.makedirs(reportDir)
+    pass
+  records = [ record for record in records if record is not None ]
+  with open("%s.json"%(basename), 'w') as outF:
+    json.dump(records, outF, indent=2, sort_keys=True)
+    pass
+
+  stageNames = []
+  for record in records:
+    for stage in record["stages"]:
+      if stage["name"] not in stageNames:
+        stageNames.append(stage["name"])
+        pass
+      pass
+    pass
+
+  columns = ["chamber","anaType","scandate","status","returncode","wall","cpu","maxrss","outputBytes"]
+  with open("%s.csv"%(basename), 'wb') as outF:
+    writer = csv.writer(outF)
+    writer.writerow(columns + [ "wall_%s"%(name) for name in stageNames ])
+    for record in records:
+      stageWall = dict((name, 0.) for name in stageNames)
+      for stage in record["stages"]:
+        stageWall[stage["name"]] += stage["wall"]
+        pass
+      row = [ record[column] for column in columns[:-1] ]
+      row.append(sum(record["outputs"].values()))
+      row += [ "%f"%(stageWall[name]) for name in stageNames ]
+      writer.writerow(row)
+      pass
+    pass
+
+  stageTotals = {}
+  for record in records:
+    for stage in record["stages"]:
+      totals = stageTotals.setdefault((record["anaType"], stage["name"]), {"jobs":0, "wall":0., "cpu":0., "entries":0, "rssDelta":0})
+      totals["jobs"] += 1
+      for key in ["wall","cpu","entries","rssDelta"]:
+        totals[key] += stage.get(key, 0)
+        pass
+      pass
+    pass
+  with open("%s_stages.csv"%(basename), 'wb') as outF:
+    writer = csv.writer(outF)
+    writer.writerow(["anaType","stage","jobs","wall","cpu","entries","rssDelta"])
+    for (anaType, name), totals in sorted(stageTotals.iteritems()):
+      writer.writerow([anaType, name, totals["jobs"], "%f"%(totals["wall"]), "%f"%(totals["cpu"]), totals["entries"], totals["rssDelta"]])
+      pass
+    pass
+  print "Run report written to %s.json, %s.csv and %s_stages.csv"%(basename, basename, basename)
+  return
+
+def publishOutputs(pairs):
+  """Publishes each (src, dst) pair of files, e.g. to the elog area, in one
+  batch. src is copied to a temporary file next to dst, checked against src
+  and renamed to dst, so that dst is replaced at once and does not change
+  when src is rewritten later. Returns the list of pairs that could not be
+  published."""
+  import errno
+  import os
+  import shutil
+  import tempfile
+
+  failed = []
+  for src, dst in pairs:
+    try:
+      if not os.path.isfile(src):
+        print "Unable to publish %s: file does not exist"%(src)
+        failed.append((src, dst))
+        continue
+      dstDir = os.path.dirname(dst)
+      if dstDir and not os.path.isdir(dstDir):
+        try:
+          os.makedirs(dstDir)
+        except OSError as e:
+          # Another job of the batch may have created it meanwhile
+          if e.errno != errno.EEXIST:
+            raise
+          pass
+        pass
+      fd, tmpDst = tempfile.mkstemp(prefix=".%s."%(os.path.basename(dst)), dir=dstDir or ".")
+      os.close(fd)
+      try:
+        shutil.copy2(src, tmpDst)
+
+        # Integrity check
+        if fileSignature(src)["sha1"] != fileSignature(tmpDst)["sha1"]:
+          print "Unable to publish %s: %s differs from source"%(src, dst)
+          failed.append((src, dst))
+          continue
+        os.rename(tmpDst, dst)
+      finally:
+        if os.path.exists(tmpDst):
+          os.remove(tmpDst)
+          pass
+        pass
+      pass
+    except (IOError, OSError) as e:
+      print "Unable to publish %s to %s: %s"%(src, dst, e)
+      failed.append((src, dst))
+      pass
+    pass
+  print "Published %i of %i files"%(len(pairs) - len(failed), len(pairs))
+  return failed
+
+def anaJobs(options, anaTypes, scandates):
+  """Returns the launchAna arguments of every (anaType, scandate, chamber)
+  combination, the other arguments being taken from options"""
+  from mapping.chamberInfo import chamber_config, GEBtype
+
+  return [ (anaType,
+            chamber_config[link],
+            GEBtype[link],
+            scandate,
+            options.scandatetrim,
+            options.ztrim,
+            options.chConfigKnown,
+            options.channels,
+            options.PanPin,
+            not options.subprocess,
+            options.force) for anaType in anaTypes for scandate in scandates for link in chamber_config.keys() ]
+
+def jobRecord(anaType, cName, scandate):
+  """Returns the record of a job before it is run, see launchAnaArgs"""
+  return {
+      "chamber":cName, "anaType":anaType, "scandate":scandate,
+      "status":"missing", "returncode":None,
+      "wall":0., "cpu":0., "maxrss":0,
+      "outputs":{}, "stages":[], "publish":[], "slot":None
+      }
+
 def launchAna(args):
   return launchAnaArgs(*args)
 
-def launchAnaArgs(anaType, cName, cType, scandate, scandatetrim=None, ztrim=4.0, chConfigKnown=False, channels=False, panasonic=False):
+def launchAnaShared(args):
+  """Runs the job of launchAna args=(slot, job), storing its per-channel results
+  to that slot of sharedResults; only the slot number and the small record
+  returned go through the Pool. slot is None for jobs without such results.
+  Any exception of the job is caught and it is reported as failed, so that
+  the other jobs and the run report go on."""
+  slot, job = args
+  try:
+    return launchAnaArgs(*job, slot=slot)
+  except Exception as e:
+    print "Caught exception in %s %s %s: %s"%(job[1], job[0], job[3], e)
+    record = jobRecord(job[0], job[1], job[3])
+    record["status"] = "failed"
+    record["error"] = str(e)
+    return record
+
+def sharedSlots(jobs):
+  """Returns the slot of each launchAna job, None for the jobs that leave no
+  chamber array (other analyses, or analyses run in a subprocess), and the
+  number of slots"""
+  slots = []
+  nSlots = 0
+  for job in jobs:
+    anaType, inProcess = job[0], job[9]
+    if inProcess and anaType in chamberResultTypes:
+      slots.append(nSlots)
+      nSlots += 1
+      pass
+    else:
+      slots.append(None)
+      pass
+    pass
+  return slots, nSlots
+
+def storeChamberResults(slot, results):
+  """Stores the chamber array left by an analysis run in-process to the slot
+  of sharedResults. Returns True if there was one to store."""
+  if sharedResults is None or results.get("chamberData") is None:
+    return False
+  sharedResults.store(slot, results["chamberData"])
+  return True
+
+def writeChamberResults(records, basename):
+  """Writes the chamber arrays of the records to basename_chambers.npz
+  together with the chamber, anaType and scandate of each of them. They are
+  read in place from the slot of sharedResults of each record, or taken from
+  record["chamberData"] for records that carry their own (see ana_queue.py)"""
+  import numpy as np
+
+  labels = []
+  data = []
+  for record in records:
+    if record is None:
+      continue
+    if record.get("chamberData") is not None:
+      data.append(record["chamberData"])
+      pass
+    elif record.get("slot") is not None and sharedResults is not None:
+      data.append(sharedResults.slot(record["slot"]))
+      pass
+    else:
+      continue
+    labels.append(record)
+    pass
+  if len(data) == 0:
+    return
+  np.savez_compressed("%s_chambers.npz"%(basename), chamberData=np.array(data),
+                      chamber=[ record["chamber"] for record in labels ],
+                      anaType=[ record["anaType"] for record in labels ],
+                      scandate=[ record["scandate"] for record in labels ])
+  for record, chamberData in zip(labels, data):
+    print "%s %s %s: %i channels masked"%(record["chamber"], record["anaType"], record["scandate"],
+                                         np.count_nonzero(chamberData['mask']))
+    pass
+  print "Chamber results written to %s_chambers.npz"%(basename)
+  return
+
+def launchAnaArgs(anaType, cName, cType, scandate, scandatetrim=None, ztrim=4.0, chConfigKnown=False, channels=False, panasonic=False, inProcess=False, force=False, slot=None):
+  import json
   import os
   import subprocess
   from subprocess import CalledProcessError
   from anaInfo import ana_config
-  from gempython.utils.wrappers import runCommand
 
   dataPath  = os.getenv('DATA_PATH')
   dirPath   = ""
@@ -20,26 +455,30 @@ def launchAnaArgs(anaType, cName, cType, scandate, scandatetrim=None, ztrim=4.0,
     
   print "Analysis Requested: %s"%(anaType)
 
+  #Telemetry of the job, returned to the caller
+  record = jobRecord(anaType, cName, scandate)
+
   #Build Commands
   cmd = [ana_config[anaType]]
-  postCmds = []
-  postCmds.append(["mkdir","-p","%s"%(elogPath)])
+  inputs = []
+  publish = []
   if anaType == "latency":
     dirPath = "%s/%s/%s/trk/%s/"%(dataPath,cName,anaType,scandate)
     filename = dirPath + "LatencyScanData.root"
     if not os.path.isfile(filename):
       print "No file to analyze. %s does not exist"%(filename)
-      return
+      return record
     
+    inputs.append(filename)
     cmd.append("--infilename=%s"%(filename))
     cmd.append("--outfilename=%s"%("latencyAna.root"))
     
-    postCmds.append(["cp","%s/LatencyScanData/Summary.png"%(dirPath),
-                 "%s/LatencySumary_%s.png"%(elogPath,cName)])
-    postCmds.append(["cp","%s/LatencyScanData/MaxHitsPerLatByVFAT.png"%(dirPath),
-                 "%s/MaxHitsPerLatByVFAT_%s.png"%(elogPath,cName)])
-    postCmds.append(["cp","%s/LatencyScanData/SignalOverSigPBkg.png"%(dirPath),
-                 "%s/SignalOverSigPBkg_%s.png"%(elogPath,cName)])
+    publish.append(("%s/LatencyScanData/Summary.png"%(dirPath),
+                 "%s/LatencySumary_%s.png"%(elogPath,cName)))
+    publish.append(("%s/LatencyScanData/MaxHitsPerLatByVFAT.png"%(dirPath),
+                 "%s/MaxHitsPerLatByVFAT_%s.png"%(elogPath,cName)))
+    publish.append(("%s/LatencyScanData/SignalOverSigPBkg.png"%(dirPath),
+                 "%s/SignalOverSigPBkg_%s.png"%(elogPath,cName)))
     
     pass
   elif anaType == "scurve":
@@ -47,8 +486,9 @@ def launchAnaArgs(anaType, cName, cType, scandate, scandatetrim=None, ztrim=4.0,
     filename = dirPath + "SCurveData.root"
     if not os.path.isfile(filename):
       print "No file to analyze. %s does not exist"%(filename)
-      return
+      return record
 
+    inputs.append(filename)
     cmd.append("--infilename=%s"%(filename))
     cmd.append("--outfilename=%s"%("SCurveFitData.root"))
     cmd.append("--fit")
@@ -60,18 +500,19 @@ def launchAnaArgs(anaType, cName, cType, scandate, scandatetrim=None, ztrim=4.0,
         cmd.append("--panasonic")
         pass
 
-    postCmds.append(["cp","%s/SCurveData/Summary.png"%(dirPath),
-                 "%s/SCurveSummary_%s_ztrim%2.2f.png"%(elogPath,cName,ztrim)])
-    postCmds.append(["cp","%s/SCurveData/chConfig.txt"%(dirPath),
-                 "%s/chConfig_%s_ztrim%2.2f.txt"%(elogPath,cName,ztrim)])
+    publish.append(("%s/SCurveData/Summary.png"%(dirPath),
+                 "%s/SCurveSummary_%s_ztrim%2.2f.png"%(elogPath,cName,ztrim)))
+    publish.append(("%s/SCurveData/chConfig.txt"%(dirPath),
+                 "%s/chConfig_%s_ztrim%2.2f.txt"%(elogPath,cName,ztrim)))
     pass
   elif anaType == "threshold":
     dirPath = "%s/%s/%s/channel/%s/"%(dataPath,cName,anaType,scandate)
     filename = dirPath + "ThresholdScanData.root"
     if not os.path.isfile(filename):
       print "No threshold file to analyze. %s does not exist"%(filename)
-      return
+      return record
 
+    inputs.append(filename)
     cmd.append("--infilename=%s"%(filename))
     cmd.append("--outfilename=%s"%("ThresholdPlots.root"))
    
@@ -81,20 +522,21 @@ def launchAnaArgs(anaType, cName, cType, scandate, scandatetrim=None, ztrim=4.0,
       filename_Trim = dirPath_Trim + "SCurveFitData.root"
       if not os.path.isfile(filename_Trim):
         print "No scurve fit data file to analyze. %s does not exist"%(filename_Trim)
-        return
+        return record
       
+      inputs.append(filename_Trim)
       cmd.append("--fileScurveFitTree=%s"%(filename_Trim))
       pass
 
-    postCmds.append(["cp","%s/ThresholdScanData/ThreshSummary.png"%(dirPath),
-                   "%s/ThreshSummary_%s.png"%(elogPath,cName)])
-    postCmds.append(["cp","%s/ThresholdScanData/ThreshPrunedSummary.png"%(dirPath),
-                   "%s/ThreshPrunedSummary_%s.png"%(elogPath,cName)])
-    postCmds.append(["cp","%s/ThresholdScanData/vfatConfig.txt"%(dirPath),
-                   "%s/vfatConfig_%s.txt"%(elogPath,cName)])
+    publish.append(("%s/ThresholdScanData/ThreshSummary.png"%(dirPath),
+                   "%s/ThreshSummary_%s.png"%(elogPath,cName)))
+    publish.append(("%s/ThresholdScanData/ThreshPrunedSummary.png"%(dirPath),
+                   "%s/ThreshPrunedSummary_%s.png"%(elogPath,cName)))
+    publish.append(("%s/ThresholdScanData/vfatConfig.txt"%(dirPath),
+                   "%s/vfatConfig_%s.txt"%(elogPath,cName)))
     if chConfigKnown:
-      postCmds.append(["cp","%s/ThresholdScanData/chConfig_MasksUpdated.txt"%(dirPath),
-                     "%s/chConfig_MasksUpdated_%s.txt"%(elogPath,cName)])
+      publish.append(("%s/ThresholdScanData/chConfig_MasksUpdated.txt"%(dirPath),
+                     "%s/chConfig_MasksUpdated_%s.txt"%(elogPath,cName)))
       pass
     pass
   elif anaType == "trim":
@@ -102,8 +544,9 @@ def launchAnaArgs(anaType, cName, cType, scandate, scandatetrim=None, ztrim=4.0,
     filename = dirPath + "SCurveData_Trimmed.root"
     if not os.path.isfile(filename):
       print "No file to analyze. %s does not exist"%(filename)
-      return
+      return record
 
+    inputs.append(filename)
     cmd.append("--infilename=%s"%(filename))
     cmd.append("--outfilename=%s"%("SCurveFitData.root"))
     cmd.append("--fit")
@@ -115,32 +558,89 @@ def launchAnaArgs(anaType, cName, cType, scandate, scandatetrim=None, ztrim=4.0,
         cmd.append("--panasonic")
         pass
         
-    postCmds.append(["cp","%s/SCurveData_Trimmed/Summary.png"%(dirPath),
-                 "%s/SCurveSummaryTrimmed_%s_ztrim%2.2f.png"%(elogPath,cName,ztrim)])
-    postCmds.append(["cp","%s/SCurveData_Trimmed/chConfig.txt"%(dirPath),
-                 "%s/chConfigTrimmed_%s_ztrim%2.2f.txt"%(elogPath,cName,ztrim)])
+    publish.append(("%s/SCurveData_Trimmed/Summary.png"%(dirPath),
+                 "%s/SCurveSummaryTrimmed_%s_ztrim%2.2f.png"%(elogPath,cName,ztrim)))
+    publish.append(("%s/SCurveData_Trimmed/chConfig.txt"%(dirPath),
+                 "%s/chConfigTrimmed_%s_ztrim%2.2f.txt"%(elogPath,cName,ztrim)))
     pass
 
+  #Outputs of the analysis, those published to the elog plus the ROOT file
+  outDir = filename[:-5]
+  outputs = [ src for src, dst in publish ]
+  outputs += [ "%s/%s"%(outDir,arg.split("=",1)[1]) for arg in cmd if arg.startswith("--outfilename=") ]
+  manifestFile = "%s/anaManifest.json"%(outDir)
+  stageFile = "%s/anaStages.json"%(outDir)
+
+  #Global variables of the script kept by in-process runs
+  results = { "chamberData":None }
+
   #Execute Commands
+  log = file("%s/anaLog.log"%(dirPath),"w")
   try:
-    log = file("%s/anaLog.log"%(dirPath),"w")
- 
-    #runCommand(cmd,log)
-    runCommand(cmd)
-    for item in postCmds:
-      runCommand(item)
+    if not force and isUpToDate(manifestFile, inputs, cmd, outputs):
+      print "Outputs in %s are up to date, skipping analysis (use --force to rerun)"%(outDir)
+      record["status"] = "skipped"
+      record["returncode"] = 0
       pass
+    else:
+      if os.path.isfile(stageFile):
+        os.remove(stageFile)
+        pass
+      # Picked up by anautilities.StageTimer in the analysis
+      os.environ['GEM_ANA_STAGE_TIMING'] = stageFile
+      try:
+        record.update(runAnaMeasured(cmd, inProcess, results=results))
+      finally:
+        del os.environ['GEM_ANA_STAGE_TIMING']
+        pass
+      if os.path.isfile(stageFile):
+        with open(stageFile, 'r') as stageF:
+          record["stages"] = json.load(stageF)
+          pass
+        pass
+      if record["returncode"] != 0:
+        record["status"] = "failed"
+        raise CalledProcessError(record["returncode"], cmd)
+      record["status"] = "ok"
+      writeManifest(manifestFile, inputs, cmd, outputs)
+      pass
+    #Publishing is done in one batch by the caller, see publishOutputs
+    record["publish"] = publish
+    pass
   except CalledProcessError as e:
     print "Caught exception",e
     pass
-  return
+  except Exception as e:
+    print "Caught exception running %s: %s"%(cmd[0], e)
+    record["status"] = "failed"
+    record["error"] = str(e)
+    pass
+
+  for output in outputs:
+    if os.path.isfile(output):
+      record["outputs"][output] = os.path.getsize(output)
+      pass
+    pass
+  if slot is not None and record["status"] == "ok":
+    try:
+      if storeChamberResults(slot, results):
+        record["slot"] = slot
+        pass
+      pass
+    except Exception as e:
+      print "Could not store the chamber results of %s: %s"%(outDir, e)
+      record["sharedError"] = str(e)
+      pass
+    pass
+  json.dump(record, log, indent=2, sort_keys=True)
+  log.close()
+  return record
 
 if __name__ == '__main__':
   import sys,os,signal
   import subprocess
   import itertools
   from multiprocessing import Pool, freeze_support
-  from mapping.chamberInfo import chamber_config, GEBtype
   from anaInfo import ana_config
   from gempython.utils.wrappers import envCheck
 
@@ -150,6 +650,14 @@ if __name__ == '__main__':
                     help="Run tests in series (default is false)", metavar="series")
   parser.add_option("--anaType", type="string", dest="anaType",
                      help="Analysis type to be executed, from list {'latency','scurve','threshold','trim'}", metavar="anaType")
+  parser.add_option("--subprocess", action="store_true", dest="subprocess",
+                    help="Launch each analysis in a new interpreter instead of running it in a warm worker", metavar="subprocess")
+  parser.add_option("--maxtasksperchild", type="int", dest="maxtasksperchild", default=None,
+                    help="Number of analyses a warm worker runs before being replaced (default is no limit)", metavar="maxtasksperchild")
+  parser.add_option("--force", action="store_true", dest="force",
+                    help="Rerun analyses even if their outputs are up to date", metavar="force")
+  parser.add_option("--report", type="string", dest="report", default=None,
+                    help="Basename of the JSON/CSV run report (default is $ELOG_PATH/<scandate>/anaReport_<anaType>)", metavar="report")
 
   (options, args) = parser.parse_args()
 
@@ -163,60 +671,58 @@ if __name__ == '__main__':
     exit(1)
     pass
 
+  jobs = anaJobs(options, [options.anaType], [options.scandate])
+
   if options.debug:
-    print list(itertools.izip([options.anaType for x in range(len(chamber_config))],
-                         chamber_config.values(),
-                         [GEBtype[x]        for x in chamber_config.keys()],
-                         [options.scandate  for x in range(len(chamber_config))],
-                         [options.scandatetrim  for x in range(len(chamber_config))],
-                         [options.ztrim   for x in range(len(chamber_config))],
-                         [options.chConfigKnown   for x in range(len(chamber_config))],
-                         [options.channels   for x in range(len(chamber_config))],
-                         [options.PanPin   for x in range(len(chamber_config))]
-                         )
-              )
+    print jobs
+    pass
+
+  if not options.subprocess:
+    # Load ROOT once here, forked workers inherit it
+    initAnaWorker()
+    pass
+
+  if options.report is None:
+    options.report = "%s/%s/anaReport_%s"%(os.getenv('ELOG_PATH'),options.scandate,options.anaType)
+    pass
+
+  # Before the Pool, so that the forked workers share it
+  from sharedresults import SharedResults
+  slots, nSlots = sharedSlots(jobs)
+  sharedResults = SharedResults(nSlots)
 
   if options.series:
     print "Running jobs in serial mode"
-    for link in chamber_config.keys():
-      chamber = chamber_config[link]
-      launchAna([options.anaType for x in range(len(chamber_config))],
-                 chamber_config.values(),
-                 [GEBtype[x]        for x in chamber_config.keys()],
-                 [options.scandate  for x in range(len(chamber_config))],
-                 [options.scandatetrim  for x in range(len(chamber_config))],
-                 [options.ztrim   for x in range(len(chamber_config))],
-                 [options.chConfigKnown   for x in range(len(chamber_config))],
-                 [options.channels   for x in range(len(chamber_config))],
-                 [options.PanPin   for x in range(len(chamber_config))]
-               )
+    records = []
+    for slot, job in zip(slots, jobs):
+      records.append(launchAnaShared((slot, job)))
       pass
+    publishOutputs([ pair for record in records for pair in record["publish"] ])
+    writeReport(records, options.report)
+    writeChamberResults(records, options.report)
     pass
   else:
     print "Running jobs in parallel mode (using Pool(12))"
     freeze_support()
     # from: https://stackoverflow.com/questions/11312525/catch-ctrlc-sigint-and-exit-multiprocesses-gracefully-in-python
     original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
-    pool = Pool(12)
+    if options.subprocess:
+      pool = Pool(12)
+      pass
+    else:
+      pool = Pool(12, initializer=initAnaWorker, maxtasksperchild=options.maxtasksperchild)
+      pass
     signal.signal(signal.SIGINT, original_sigint_handler)
     try:
-      res = pool.map_async(launchAna,
-                           itertools.izip([options.anaType for x in range(len(chamber_config))],
-                                          chamber_config.values(),
-                                          [GEBtype[x]        for x in chamber_config.keys()],
-                                          [options.scandate  for x in range(len(chamber_config))],
-                                          [options.scandatetrim  for x in range(len(chamber_config))],
-                                          [options.ztrim   for x in range(len(chamber_config))],
-                                          [options.chConfigKnown   for x in range(len(chamber_config))],
-                                          [options.channels   for x in range(len(chamber_config))],
-                                          [options.PanPin   for x in range(len(chamber_config))]
-                                          )
-                           )
+      res = pool.map_async(launchAnaShared, zip(slots, jobs))
       # timeout must be properly set, otherwise tasks will crash
-      print res.get(999999999)
+      records = res.get(999999999)
       print("Normal termination")
       pool.close()
       pool.join()
+      publishOutputs([ pair for record in records for pair in record["publish"] ])
+      writeReport(records, options.report)
+      writeChamberResults(records, options.report)
     except KeyboardInterrupt:
       print("Caught KeyboardInterrupt, terminating workers")
       pool.terminate()
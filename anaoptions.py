@@ -21,3 +21,5 @@ parser.add_option("-t", "--type", type="string", dest="GEBtype", default="long",
                   help="Specify GEB (long/short)", metavar="GEBtype")
 parser.add_option("--ztrim", type="float", dest="ztrim", default=4.0,
                   help="Specify the p value of the trim", metavar="ztrim")
+parser.add_option("--timing", type="string", dest="timing", default=None,
+                  help="Write the wall/CPU time, entries and memory of each stage as JSON to this file (default is $GEM_ANA_STAGE_TIMING)", metavar="timing")
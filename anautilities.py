@@ -7,8 +7,11 @@ By: Brian Dorney (brian.l.dorney@cern.ch)
 
 # Imports
 import sys, os
+import json
+import resource
+import time
+import warnings
 import numpy as np
-import ROOT as r
 #import root_numpy as rp
 
 def filePathExists(searchPath, subPath):
@@ -42,12 +45,274 @@ def initVFATArray(array_dtype, nstrips=128):
 
     return np.zeros(nstrips, dtype=list_dtypeTuple)
 
+#Per-channel data of a chamber, one record per (vfat, channel). The field names
+#and types match the branches of scurveFitTree.
+chamberDataType = np.dtype([
+    ('vfatN',       'i4'),
+    ('vfatCH',      'i4'),
+    ('ROBstr',      'i4'),
+    ('panPin',      'i4'),
+    ('trimDAC',     'i4'),
+    ('trimRange',   'i4'),
+    ('vthr',        'i4'),
+    ('threshold',   'f4'),
+    ('noise',       'f4'),
+    ('pedestal',    'f4'),
+    ('ped_eff',     'f4'),
+    ('chi2',        'f4'),
+    ('ndf',         'i4'),
+    ('Nhigh',       'i4'),
+    ('mask',        'i4'),
+    ('maskReason',  'i4')
+    ])
+
+def initChamberArray(shape=(24,128)):
+    """Returns a zeroed array of chamberDataType records of the given shape,
+    whose last two axes are (vfat, channel). The vfatN and vfatCH fields are
+    set to the position of each record.
+
+    Being a structured NumPy array it supports vectorized access, e.g.
+    data['noise'][vfat], data[data['mask'] == 0] or data[vfat, 64:]."""
+    data = np.zeros(shape, dtype=chamberDataType)
+    data['vfatN'] = np.arange(shape[-2]).reshape(-1, 1)
+    data['vfatCH'] = np.arange(shape[-1])
+    return data
+
+def reindexChamberArray(data, key):
+    """Returns a copy of data where the records of each VFAT are ordered by
+    the field key (e.g. 'ROBstr' or 'panPin') instead of by channel, so that
+    result[vfat][strip] is the record of that strip. Positions no record maps
+    to, e.g. when channels are missing from a fit file or key has duplicate
+    values, are zeroed apart from their vfatN and key, and masked."""
+    flat = data.reshape(-1, data.shape[-1])
+    rows = np.arange(len(flat)).reshape(-1, 1)
+    result = np.zeros_like(flat)
+    result[rows, flat[key]] = flat
+    missing = np.ones(flat.shape, dtype=bool)
+    missing[rows, flat[key]] = False
+    if np.any(missing):
+        missingRows, missingColumns = np.nonzero(missing)
+        result[key][missing] = missingColumns
+        if 'vfatN' in flat.dtype.names:
+            result['vfatN'][missing] = flat['vfatN'][missingRows, 0]
+            pass
+        if 'mask' in flat.dtype.names:
+            result['mask'][missing] = 1
+            pass
+        pass
+    return result.reshape(data.shape)
+
+def saveChamberArray(filename, data):
+    """Saves data to the .npz file filename"""
+    np.savez_compressed(filename, chamberData=data)
+
+def loadChamberArray(filename):
+    """Loads the array saved by saveChamberArray"""
+    with np.load(filename) as inF:
+        return inF['chamberData']
+
+def occurrenceIndex(key):
+    """Returns, for each element of key, the number of elements with the same
+    value before it, e.g. the scan of each entry of a tree merged with hadd
+    when key identifies the channel"""
+    order = np.argsort(key, kind='mergesort')
+    isFirst = np.concatenate(([True], np.diff(key[order]) != 0))
+    position = np.arange(len(key))
+    occurrence = np.empty(len(key), dtype=int)
+    occurrence[order] = position - np.maximum.accumulate(np.where(isFirst, position, 0))
+    return occurrence
+
+def chamberArrayFromTree(filename, treename="scurveFitTree", branches=None):
+    """Reads the branches of chamberDataType found in treename into an array
+    of shape (nScans, 24, 128). nScans is the largest number of entries with
+    the same (vfatN, vfatCH), e.g. the number of fit files merged with hadd;
+    the n-th entry of a channel goes to scan n."""
+    from columnar import listBranches, readColumns
+
+    available = listBranches(filename, treename)
+    if branches is None:
+        branches = chamberDataType.names
+    branches = [ name for name in branches if name in available ]
+    for required in ['vfatN', 'vfatCH']:
+        if required not in branches:
+            branches.append(required)
+
+    entries = readColumns(filename, treename, branches)
+    key = entries['vfatN'] * 128 + entries['vfatCH']
+
+    occurrence = occurrenceIndex(key)
+
+    nScans = occurrence.max() + 1 if len(key) else 0
+    data = initChamberArray((nScans, 24, 128))
+    for name in branches:
+        data[name][occurrence, entries['vfatN'], entries['vfatCH']] = entries[name]
+    return data
+
+def chamberArrayToTree(data, filename, treename="scurveFitTree", mode="update"):
+    """Writes data, of any shape, as the tree treename in filename with one
+    entry per record"""
+    import root_numpy as rp
+
+    rp.array2root(data.ravel(), filename, treename=treename, mode=mode)
+
+def currentRSS():
+    """Returns the resident set size of this process in kB, or its peak RSS
+    where /proc is not available"""
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+#Enabled StageTimers not dumped yet, written by dumpStageTimers at exit
+pendingStageTimers = []
+
+def dumpStageTimers():
+    """Dumps the StageTimers not dumped yet, e.g. those of an analysis run in
+    process (see ana_scans.runAnaInProcess) that stopped early"""
+    while pendingStageTimers:
+        pendingStageTimers[0].dump()
+        pass
+    return
+
+class StageTimer(object):
+    """Records the wall and CPU time spent in the consecutive stages of an
+    analysis (read, fit, mask, write, render...), the number of entries each
+    processed, the change of the RSS (kB) over each and the peak RSS at its
+    end. Example usage:
+
+        timer = StageTimer(options.timing)
+        timer.start('read')
+        for event in timer.counted(inF.scurveTree):
+            ...
+        timer.start('fit')
+        ...
+        timer.dump()
+
+    The stages are written as JSON to filename, by default the file named by
+    the GEM_ANA_STAGE_TIMING environment variable which ana_scans.py sets for
+    each job. If neither is given the timer is disabled and all its methods
+    return immediately. An enabled timer not dumped is written by
+    dumpStageTimers, called at exit, so that the trace is kept when the
+    analysis stops early."""
+
+    atexitRegistered = False
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.getenv('GEM_ANA_STAGE_TIMING')
+        self.filename = filename
+        self.enabled = bool(filename)
+        self.stages = []
+        self.current = None
+        if self.enabled:
+            if not StageTimer.atexitRegistered:
+                import atexit
+                atexit.register(dumpStageTimers)
+                StageTimer.atexitRegistered = True
+                pass
+            pendingStageTimers.append(self)
+
+    def start(self, name):
+        """Ends the current stage, if any, and starts the stage name"""
+        if not self.enabled:
+            return
+        self.stop()
+        times = os.times()
+        self.current = {"name":name, "entries":0, "wall":time.time(), "cpu":times[0] + times[1], "rss":currentRSS()}
+
+    def count(self, entries):
+        """Adds entries to the number of entries processed by the current stage"""
+        if self.current is not None:
+            self.current["entries"] += entries
+
+    def counted(self, iterable):
+        """Returns iterable, counting its items as entries of the current stage"""
+        if not self.enabled:
+            return iterable
+        return self._counted(iterable)
+
+    def _counted(self, iterable):
+        for item in iterable:
+            if self.current is not None:
+                self.current["entries"] += 1
+            yield item
+
+    def stop(self):
+        """Ends the current stage"""
+        if self.current is None:
+            return
+        times = os.times()
+        stage = self.current
+        self.stages.append({
+            "name":stage["name"],
+            "entries":stage["entries"],
+            "wall":time.time() - stage["wall"],
+            "cpu":times[0] + times[1] - stage["cpu"],
+            "rssDelta":currentRSS() - stage["rss"],
+            "maxrss":resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            })
+        self.current = None
+
+    def dump(self):
+        """Ends the current stage and writes all stages to self.filename"""
+        if not self.enabled:
+            return
+        self.stop()
+        if self in pendingStageTimers:
+            pendingStageTimers.remove(self)
+            pass
+        with open(self.filename, 'w') as outF:
+            json.dump(self.stages, outF, indent=2)
+
+def scurveMaskReasons(scanFits, isDead, fitValid, ztrim=4.0, zscore=3.5, isPending=None):
+    """Returns the (24,128) arrays of the MaskReason bits and of the effective
+    pedestal of each channel, from the fit results of ScanDataFitter.fit.
+    Hot channels are the low tail outliers of threshold - ztrim * noise of
+    each VFAT. Channels in isPending, e.g. not yet fitted during the scan,
+    are left out of the medians and are not masked."""
+    import math
+    from anaInfo import MaskReason
+
+    fitThresholds = np.array([ scanFits[0][vfat] for vfat in range(0, 24) ])
+    channelNoise = np.array([ scanFits[1][vfat] for vfat in range(0, 24) ])
+    fitPedestals = np.array([ scanFits[2][vfat] for vfat in range(0, 24) ])
+    isDead = np.asarray(isDead, dtype=bool)
+    fitFailed = np.logical_not(np.asarray(fitValid, dtype=bool))
+    if isPending is None:
+        isPending = np.zeros(isDead.shape, dtype=bool)
+        pass
+
+    # Value of the fitted scurve, 500*Erf((max(pedestal,0)-threshold)/(sqrt(2)*noise))+500, at VCal 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        erfArgs = (np.maximum(fitPedestals, 0) - fitThresholds) / (math.sqrt(2) * channelNoise)
+        pass
+    effectivePedestals = 500 * np.vectorize(math.erf, otypes=[float])(erfArgs) + 500
+
+    # Dead and pending channels are left out of the medians
+    trimValue = fitThresholds - ztrim * channelNoise
+    trimValue[isDead | isPending] = np.nan
+    hotChannels = isOutlierMADOneSided(trimValue, thresh=zscore, rejectHighTail=False)
+
+    reasons = np.zeros(isDead.shape, dtype=int)
+    reasons[hotChannels] |= MaskReason.HotChannel
+    reasons[fitFailed] |= MaskReason.FitFailed
+    reasons[isDead] |= MaskReason.DeadChannel
+    reasons[channelNoise > 20] |= MaskReason.HighNoise
+    with np.errstate(invalid='ignore'):
+        reasons[effectivePedestals > 50] |= MaskReason.HighEffPed
+        pass
+    reasons[isPending] = MaskReason.NotMasked
+    return reasons, effectivePedestals
+
 def make3x8Canvas(name, initialContent = None, drawOption = ''):
     """Creates a 3x8 canvas for summary plots.
 
     initialContent should be None or an array of 24 (one per VFAT) TObject that
     will be drawn on the canvas. drawOption will be passed to the Draw
     function."""
+    import ROOT as r
+
     canv = r.TCanvas(name,name,500*8,500*3)
     canv.Divide(8,3)
     if initialContent != None:
@@ -70,59 +335,139 @@ def rejectOutliersMADOneSided(arrayData, thresh=3.5, rejectHighTail=True):
     arrayOutliers = isOutlierMADOneSided(arrayData, thresh, rejectHighTail)
     return arrayData[arrayOutliers != True]
 
+#The outlier tests below work along one axis of arrayData, by default the last
+#one, so that e.g. a (nVFAT, nChan) or (nChamber, nVFAT, nChan) array is tested
+#channel by channel for every VFAT in one call. NaN entries (e.g. dead
+#channels) are ignored when computing the medians and quantiles and are never
+#reported as outliers.
+
+#Computes the first and third quartiles of arrayData along axis, keeping the
+#reduced axis so that the result broadcasts against arrayData.
+def quartiles(arrayData, axis=-1):
+    with warnings.catch_warnings():
+        # All-NaN rows give NaN quartiles
+        warnings.simplefilter("ignore", RuntimeWarning)
+        q1,q3 = np.nanpercentile(arrayData, [25,75], axis=axis, keepdims=True)
+    return q1, q3
+
+#Computes the median of arrayData along axis and the median absolute deviation
+#from it, both keeping the reduced axis.
+def medianAndMAD(arrayData, axis=-1):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        median = np.nanmedian(arrayData, axis=axis, keepdims=True)
+        med_abs_deviation = np.nanmedian(np.abs(arrayData - median), axis=axis, keepdims=True)
+    return median, med_abs_deviation
+
 #Use inter-quartile range (IQR) to reject outliers
 #Returns a boolean array with True if points are outliers and False otherwise.
-def isOutlierIQR(arrayData):
-    dMin    = np.min(arrayData,     axis=0)
-    dMax    = np.max(arrayData,     axis=0)
-    median  = np.median(arrayData,  axis=0)
-
-    q1,q3   = np.percentile(arrayData, [25,75], axis=0)
+def isOutlierIQR(arrayData, axis=-1):
+    arrayData = np.asarray(arrayData, dtype=float)
+    q1,q3   = quartiles(arrayData, axis)
     IQR     = q3 - q1
 
-    return (arrayData < (q1 - 1.5 * IQR)) | (arrayData > (q3 + 1.5 * IQR))
+    with np.errstate(invalid='ignore'):
+        return (arrayData < (q1 - 1.5 * IQR)) | (arrayData > (q3 + 1.5 * IQR))
 
 #Use inter-quartile range (IQR) to reject outliers, but consider only high or low tail
 #Returns a boolean array with True if points are outliers and False otherwise.
-def isOutlierIQROneSided(arrayData, rejectHighTail=True):
-    dMin    = np.min(arrayData,     axis=0)
-    dMax    = np.max(arrayData,     axis=0)
-    median  = np.median(arrayData,  axis=0)
-
-    q1,q3   = np.percentile(arrayData, [25,75], axis=0)
+def isOutlierIQROneSided(arrayData, rejectHighTail=True, axis=-1):
+    arrayData = np.asarray(arrayData, dtype=float)
+    q1,q3   = quartiles(arrayData, axis)
     IQR     = q3 - q1
 
-    if rejectHighTail:
-        return arrayData > (q3 + 1.5 * IQR)
-    else:
-        return arrayData < (q1 - 1.5 * IQR)
+    with np.errstate(invalid='ignore'):
+        if rejectHighTail:
+            return arrayData > (q3 + 1.5 * IQR)
+        else:
+            return arrayData < (q1 - 1.5 * IQR)
 
 #Use Median absolute deviation (MAD) to reject outliers
 #See: https://github.com/joferkington/oost_paper_code/blob/master/utilities.py
+#Rows with a MAD of zero fall back to the IQR test.
 #Returns a boolean array with True if points are outliers and False otherwise.
-def isOutlierMAD(arrayData, thresh=3.5):
-    median = np.median(arrayData, axis=0)
+def isOutlierMAD(arrayData, thresh=3.5, axis=-1):
+    arrayData = np.asarray(arrayData, dtype=float)
+    median, med_abs_deviation = medianAndMAD(arrayData, axis)
     diff = np.abs(arrayData - median)
-    med_abs_deviation = np.median(diff)
 
-    if med_abs_deviation == 0:
-        return isOutlierIQR(arrayData)
-    else:
+    with np.errstate(divide='ignore', invalid='ignore'):
         modified_z_score = 0.6745 * diff / med_abs_deviation
-        return modified_z_score > thresh
+        outliers = modified_z_score > thresh
+    noMAD = (med_abs_deviation == 0)
+    if np.any(noMAD):
+        outliers = np.where(noMAD, isOutlierIQR(arrayData, axis), outliers)
+    return outliers
 
 #Use MAD to reject outliers, but consider only high or low tail
+#Rows with a MAD of zero fall back to the IQR test.
 #Returns a boolean array with True if points are outliers and False otherwise.
-def isOutlierMADOneSided(arrayData, thresh=3.5, rejectHighTail=True):
-    median = np.median(arrayData, axis=0)
+def isOutlierMADOneSided(arrayData, thresh=3.5, rejectHighTail=True, axis=-1):
+    arrayData = np.asarray(arrayData, dtype=float)
+    median, med_abs_deviation = medianAndMAD(arrayData, axis)
     diff = arrayData - median
-    med_abs_deviation = np.median(np.abs(diff))
 
-    if med_abs_deviation == 0:
-        return isOutlierIQROneSided(arrayData, rejectHighTail)
-    else:
+    with np.errstate(divide='ignore', invalid='ignore'):
         modified_z_score = 0.6745 * diff / med_abs_deviation
+        if rejectHighTail:
+            outliers = modified_z_score > thresh
+        else:
+            outliers = modified_z_score < -1.0 * thresh
+    noMAD = (med_abs_deviation == 0)
+    if np.any(noMAD):
+        outliers = np.where(noMAD, isOutlierIQROneSided(arrayData, rejectHighTail, axis), outliers)
+    return outliers
 
+#The reference variants below test arrayData against the median, MAD and
+#quartiles of a reference distribution instead of those of arrayData itself.
+#reference is any object with median(), mad() and quantile() methods, e.g. a
+#quantilesketch.TDigest accumulated over many scans.
+
+#Use IQR of the reference to reject outliers
+#Returns a boolean array with True if points are outliers and False otherwise.
+def isOutlierIQRReference(arrayData, reference):
+    arrayData = np.asarray(arrayData, dtype=float)
+    q1,q3   = reference.quantile([0.25,0.75])
+    IQR     = q3 - q1
+
+    with np.errstate(invalid='ignore'):
+        return (arrayData < (q1 - 1.5 * IQR)) | (arrayData > (q3 + 1.5 * IQR))
+
+#Use IQR of the reference to reject outliers, but consider only high or low tail
+#Returns a boolean array with True if points are outliers and False otherwise.
+def isOutlierIQROneSidedReference(arrayData, reference, rejectHighTail=True):
+    arrayData = np.asarray(arrayData, dtype=float)
+    q1,q3   = reference.quantile([0.25,0.75])
+    IQR     = q3 - q1
+
+    with np.errstate(invalid='ignore'):
+        if rejectHighTail:
+            return arrayData > (q3 + 1.5 * IQR)
+        else:
+            return arrayData < (q1 - 1.5 * IQR)
+
+#Use MAD of the reference to reject outliers
+#Returns a boolean array with True if points are outliers and False otherwise.
+def isOutlierMADReference(arrayData, reference, thresh=3.5):
+    arrayData = np.asarray(arrayData, dtype=float)
+    med_abs_deviation = reference.mad()
+
+    if med_abs_deviation == 0:
+        return isOutlierIQRReference(arrayData, reference)
+    with np.errstate(invalid='ignore'):
+        modified_z_score = 0.6745 * np.abs(arrayData - reference.median()) / med_abs_deviation
+        return modified_z_score > thresh
+
+#Use MAD of the reference to reject outliers, but consider only high or low tail
+#Returns a boolean array with True if points are outliers and False otherwise.
+def isOutlierMADOneSidedReference(arrayData, reference, thresh=3.5, rejectHighTail=True):
+    arrayData = np.asarray(arrayData, dtype=float)
+    med_abs_deviation = reference.mad()
+
+    if med_abs_deviation == 0:
+        return isOutlierIQROneSidedReference(arrayData, reference, rejectHighTail)
+    with np.errstate(invalid='ignore'):
+        modified_z_score = 0.6745 * (arrayData - reference.median()) / med_abs_deviation
         if rejectHighTail:
             return modified_z_score > thresh
         else:
@@ -0,0 +1,270 @@
+#!/bin/env python
+"""
+End-to-end benchmark of anaUltraScurve.py, anaUltraThreshold.py and
+anaUltraLatency.py on synthetic scans.
+
+The scans have the size of a full chamber (24 VFATs x 128 channels, every
+VCal/VThreshold1/latency value) and contain dead channels, hot channels,
+noisy channels and a dead VFAT. Each analysis is run in a subprocess; its
+wall time, CPU time and peak RSS are recorded in total and per stage (from
+the StageTimer trace), and written as JSON.
+
+Benchmarking this checkout:
+
+    python benchmarks/benchAnalyses.py --output=bench.json
+
+Comparing two revisions in one command, on the same synthetic scans:
+
+    python benchmarks/benchAnalyses.py --compare=HEAD~5,HEAD
+
+Comparing two earlier results:
+
+    python benchmarks/benchAnalyses.py --diff=before.json,after.json
+
+GEM_PLOTTING_PROJECT is set to the tree being benchmarked, gempython, ROOT
+and root_numpy must be available.
+"""
+
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import numpy as np
+
+projectHome = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, projectHome)
+
+analyses = ["scurve", "threshold", "latency"]
+
+erf = np.frompyfunc(math.erf, 1, 1)
+
+def channelPathologies(rng, deadFraction, hotFraction, noisyFraction, deadVFATs):
+    """Returns (24,128) boolean arrays flagging the dead, hot and noisy
+    channels; every channel of the deadVFATs is dead"""
+    dead = rng.uniform(size=(24,128)) < deadFraction
+    dead[list(deadVFATs)] = True
+    hot = np.logical_and(rng.uniform(size=(24,128)) < hotFraction, np.logical_not(dead))
+    noisy = np.logical_and(rng.uniform(size=(24,128)) < noisyFraction, np.logical_not(dead | hot))
+    return dead, hot, noisy
+
+def scanRecords(rng, values, nEvents, efficiency, dead, branches):
+    """Returns the entries of a scan over values, one per (vfat, channel,
+    value) of the channels not dead, with Nhits drawn from efficiency of
+    shape (24,nChannels,len(values))"""
+    nHits = rng.binomial(nEvents, np.clip(efficiency, 0., 1.))
+    vfat, channel, point = np.indices(efficiency.shape)
+    alive = np.logical_not(dead)[vfat, channel]
+    records = np.zeros(np.count_nonzero(alive), dtype=[ (name, 'i4') for name in branches ])
+    records['vfatN'] = vfat[alive]
+    if 'vfatCH' in records.dtype.names:
+        records['vfatCH'] = channel[alive]
+        pass
+    records[branches[2]] = values[point[alive]]
+    records['Nhits'] = nHits[alive]
+    records['Nev'] = nEvents
+    return records
+
+def makeScurveScan(rng, nEvents, vcalStep, pathologies):
+    dead, hot, noisy = pathologies
+    vcal = np.arange(0, 255, vcalStep)
+    threshold = rng.normal(30., 3., (24,128))
+    threshold[hot] = rng.uniform(0., 5., np.count_nonzero(hot))
+    noise = np.clip(rng.normal(2., 0.3, (24,128)), 0.5, None)
+    noise[noisy] *= 5.
+    efficiency = 0.5 * (1. + erf((vcal - threshold[..., np.newaxis]) / (math.sqrt(2.) * noise[..., np.newaxis])).astype(float))
+    records = scanRecords(rng, vcal, nEvents, efficiency, dead, ['vfatN', 'vfatCH', 'vcal', 'Nhits', 'Nev', 'vthr', 'trimDAC', 'trimRange'])
+    records['vthr'] = 50
+    records['trimDAC'] = rng.randint(0, 32, len(records))
+    return records
+
+def makeThresholdScan(rng, nEvents, pathologies):
+    dead, hot, noisy = pathologies
+    vth1 = np.arange(0, 256)
+    noiseFloor = rng.normal(20., 3., (24,128))
+    noiseFloor[hot] = rng.normal(80., 10., np.count_nonzero(hot))
+    width = np.where(noisy, 10., 2.)
+    efficiency = 0.5 * (1. - erf((vth1 - noiseFloor[..., np.newaxis]) / (math.sqrt(2.) * width[..., np.newaxis])).astype(float))
+    return scanRecords(rng, vth1, nEvents, efficiency, dead, ['vfatN', 'vfatCH', 'vth1', 'Nhits', 'Nev', 'trimRange'])
+
+def makeLatencyScan(rng, nEvents, pathologies):
+    dead, hot, noisy = pathologies
+    lat = np.arange(0, 256)
+    peak = rng.normal(97., 1., 24)
+    efficiency = 0.9 * np.exp(-0.5 * ((lat - peak[:, np.newaxis]) / 1.5)**2) + 0.01
+    #One entry per (vfat, latency), a VFAT is dead if all its channels are
+    deadVFAT = np.all(dead, axis=1)
+    return scanRecords(rng, lat, nEvents, efficiency[:, np.newaxis, :], deadVFAT[:, np.newaxis], ['vfatN', 'Nhits', 'lat', 'Nev'])
+
+def makeScans(workDir, seed=42, nEvents=1000, vcalStep=1):
+    """Writes the three synthetic scans to workDir and returns their file names"""
+    import root_numpy as rp
+
+    rng = np.random.RandomState(seed)
+    pathologies = channelPathologies(rng, deadFraction=0.01, hotFraction=0.01, noisyFraction=0.01, deadVFATs=[23])
+    scans = {
+        "scurve":("SCurveData.root", "scurveTree", makeScurveScan(rng, nEvents, vcalStep, pathologies)),
+        "threshold":("ThresholdScanData.root", "thrTree", makeThresholdScan(rng, nEvents, pathologies)),
+        "latency":("LatencyScanData.root", "latTree", makeLatencyScan(rng, nEvents, pathologies))
+        }
+    filenames = {}
+    for anaType, (filename, treename, records) in scans.iteritems():
+        filenames[anaType] = os.path.join(workDir, filename)
+        rp.array2root(records, filenames[anaType], treename=treename, mode='recreate')
+        print "Wrote %i entries of %s to %s"%(len(records), treename, filenames[anaType])
+        pass
+    return filenames
+
+def analysisCommand(anaType, project, filename):
+    scripts = {
+        "scurve":["anaUltraScurve.py", "-f", "--type=long"],
+        "threshold":["anaUltraThreshold.py", "--type=long"],
+        "latency":["anaUltraLatency.py"]
+        }
+    script = scripts[anaType]
+    return [sys.executable, os.path.join(project, script[0]), "-i", filename] + script[1:]
+
+def runSuite(project, filenames, workDir, anaTypes, repeat=1):
+    """Runs the analyses of project on the scans and returns their
+    measurements, keeping the fastest of repeat runs"""
+    from ana_scans import runAnaMeasured
+
+    env = dict(os.environ)
+    env["GEM_PLOTTING_PROJECT"] = project
+    env["PYTHONPATH"] = os.pathsep.join([project, env.get("PYTHONPATH", "")])
+    results = {}
+    for anaType in anaTypes:
+        stageFile = os.path.join(workDir, "stages_%s.json"%(anaType))
+        env["GEM_ANA_STAGE_TIMING"] = stageFile
+        for idx in range(repeat):
+            if os.path.isfile(stageFile):
+                os.remove(stageFile)
+                pass
+            usage = runAnaMeasured(analysisCommand(anaType, project, filenames[anaType]), cwd=workDir, env=env)
+            usage["stages"] = []
+            if os.path.isfile(stageFile):
+                with open(stageFile, 'r') as inF:
+                    usage["stages"] = json.load(inF)
+                    pass
+                pass
+            if anaType not in results or usage["wall"] < results[anaType]["wall"]:
+                results[anaType] = usage
+                pass
+            pass
+        print "%-10s %8.2f s wall %8.2f s CPU %8i kB RSS (exit code %i)"%(
+                anaType, results[anaType]["wall"], results[anaType]["cpu"], results[anaType]["maxrss"], results[anaType]["returncode"])
+        pass
+    return results
+
+def exportRevision(revision, workDir):
+    """Extracts revision of this repository to workDir and builds its
+    channel maps, returns the directory"""
+    target = os.path.join(workDir, "rev_%s"%(revision.replace('/', '_').replace('~', '_').replace('^', '_')))
+    if not os.path.isdir(target):
+        os.makedirs(target)
+        pass
+    archive = subprocess.Popen(["git", "-C", projectHome, "archive", revision], stdout=subprocess.PIPE)
+    subprocess.check_call(["tar", "-x", "-C", target], stdin=archive.stdout)
+    if archive.wait() != 0:
+        raise RuntimeError("git archive %s failed"%(revision))
+    env = dict(os.environ)
+    env["GEM_PLOTTING_PROJECT"] = target
+    env["PYTHONPATH"] = os.pathsep.join([target, env.get("PYTHONPATH", "")])
+    subprocess.check_call([sys.executable, os.path.join(target, "mapping", "buildMapFiles.py")], env=env)
+    return target
+
+def printComparison(before, after, labels):
+    """Prints the totals and stages of two benchmark results side by side"""
+    print "%-24s %8s %12s %12s %8s"%("", "", labels[0][-12:], labels[1][-12:], "ratio")
+    for anaType in analyses:
+        if anaType not in before["analyses"] or anaType not in after["analyses"]:
+            continue
+        old = before["analyses"][anaType]
+        new = after["analyses"][anaType]
+        rows = [ ("%s total"%(anaType), metric, old[metric], new[metric]) for metric in ["wall", "cpu", "maxrss"] ]
+        oldStages = dict( (stage["name"], stage) for stage in old["stages"] )
+        for stage in new["stages"]:
+            if stage["name"] in oldStages:
+                rows.append(("  %s"%(stage["name"]), "wall", oldStages[stage["name"]]["wall"], stage["wall"]))
+                pass
+            pass
+        for name, metric, vOld, vNew in rows:
+            ratio = vNew / float(vOld) if vOld else float('nan')
+            print "%-24s %8s %12.2f %12.2f %8.2f"%(name, metric, vOld, vNew, ratio)
+            pass
+        pass
+    return
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--anaType", type="string", dest="anaType", default=','.join(analyses),
+                      help="Comma separated analyses to run, from {'scurve','threshold','latency'}", metavar="anaType")
+    parser.add_option("--workdir", type="string", dest="workdir", default=None,
+                      help="Directory for the synthetic scans and the outputs, default is a new temporary directory", metavar="workdir")
+    parser.add_option("--nevents", type="int", dest="nevents", default=1000,
+                      help="Number of events per scan point", metavar="nevents")
+    parser.add_option("--vcalStep", type="int", dest="vcalStep", default=1,
+                      help="Step of the VCal scan, larger values give smaller scurve scans", metavar="vcalStep")
+    parser.add_option("--seed", type="int", dest="seed", default=42,
+                      help="Random seed of the synthetic scans", metavar="seed")
+    parser.add_option("--repeat", type="int", dest="repeat", default=1,
+                      help="Number of runs of each analysis, the fastest is kept", metavar="repeat")
+    parser.add_option("--output", type="string", dest="output", default=None,
+                      help="Write the results to this JSON file", metavar="output")
+    parser.add_option("--compare", type="string", dest="compare", default=None,
+                      help="Two comma separated git revisions to benchmark and compare", metavar="compare")
+    parser.add_option("--diff", type="string", dest="diff", default=None,
+                      help="Two comma separated JSON results to compare, nothing is run", metavar="diff")
+    (options, args) = parser.parse_args()
+
+    if options.diff is not None:
+        labels = options.diff.split(',')
+        results = []
+        for filename in labels:
+            with open(filename, 'r') as inF:
+                results.append(json.load(inF))
+                pass
+            pass
+        printComparison(results[0], results[1], labels)
+        exit(0)
+        pass
+
+    workDir = options.workdir
+    if workDir is None:
+        workDir = tempfile.mkdtemp(prefix="gemBench")
+        pass
+    elif not os.path.isdir(workDir):
+        os.makedirs(workDir)
+        pass
+    anaTypes = options.anaType.split(',')
+    filenames = makeScans(workDir, options.seed, options.nevents, options.vcalStep)
+    settings = {"nevents":options.nevents, "vcalStep":options.vcalStep, "seed":options.seed}
+
+    if options.compare is None:
+        revision = subprocess.check_output(["git", "-C", projectHome, "describe", "--always", "--dirty"]).strip()
+        results = {"revision":revision, "settings":settings,
+                   "analyses":runSuite(projectHome, filenames, workDir, anaTypes, options.repeat)}
+        if options.output is not None:
+            with open(options.output, 'w') as outF:
+                json.dump(results, outF, indent=1, sort_keys=True)
+                pass
+            pass
+        exit(0)
+        pass
+
+    labels = options.compare.split(',')
+    results = []
+    for revision in labels:
+        print "Benchmarking %s"%(revision)
+        project = exportRevision(revision, workDir)
+        results.append({"revision":revision, "settings":settings,
+                        "analyses":runSuite(project, filenames, workDir, anaTypes, options.repeat)})
+        pass
+    printComparison(results[0], results[1], labels)
+    if options.output is not None:
+        with open(options.output, 'w') as outF:
+            json.dump(results, outF, indent=1, sort_keys=True)
+            pass
+        pass
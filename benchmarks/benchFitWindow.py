@@ -0,0 +1,180 @@
+#!/bin/env python
+"""
+Compares the full range scurve fit of ScanDataFitter with the fit restricted
+to a window around the transition (--fitWindow of anaUltraScurve.py), in
+speed, in the agreement of the fitted threshold, noise and effective pedestal,
+and in the masks derived from them, on the same synthetic scan (see
+benchAnalyses.py, hot, noisy and dead channels included).
+
+    python benchmarks/benchFitWindow.py --nvfats=4 --fitWindow=5
+
+The exit code is 1 if fewer than --minAgreement of the channels fitted by
+both agree within the tolerances, or if more than --maxMaskChanges channels
+are masked by one fit only. Three known categories are left out of both
+counts and reported apart:
+
+- the hot channels of the scan, whose transition is below the first scanned
+  points, so that neither fit constrains their pedestal (HighEffPed);
+- the channels whose full range fit settled on a step (noise below
+  --stepNoise), which the bins weighted by their contents allow and the
+  window fit avoids;
+- the channels whose full range fit put the pedestal on the rise, above the
+  last scanned point without hits, to follow its first points of a few hits
+  (weighted by their contents as well), where the window fit fixes it to 0.
+
+ROOT and gempython must be available.
+"""
+
+import json
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from benchAnalyses import channelPathologies, makeScurveScan
+
+def fitScan(records, fitWindow):
+    """Returns the fitter after fitting records, and the time of the fit"""
+    from columnar import columnEvents
+    from fitting.fitScanData import ScanDataFitter
+
+    fitter = ScanDataFitter(fitWindow)
+    for event in columnEvents(dict( (name, records[name]) for name in records.dtype.names ), 'scurveTree'):
+        fitter.feed(event)
+        pass
+    start = time.time()
+    fitter.fit()
+    return fitter, time.time() - start
+
+def maskChanges(fullReasons, windowReasons):
+    """Returns the number of channels gaining (window only) and losing (full
+    range only) each mask reason"""
+    from anaInfo import MaskReason
+
+    changes = {}
+    for name in ['HotChannel', 'FitFailed', 'HighNoise', 'HighEffPed']:
+        bit = getattr(MaskReason, name)
+        inFull = (fullReasons & bit) != 0
+        inWindow = (windowReasons & bit) != 0
+        changes[name] = {"added":int(np.count_nonzero(inWindow & ~inFull)), "dropped":int(np.count_nonzero(inFull & ~inWindow))}
+        pass
+    return changes
+
+def lastEmptyPoints(records, low=0.1):
+    """Returns the (24,128) array of the last scanned VCal without hits below
+    the first point above low of the plateau of each channel, 0 if none"""
+    hits = np.full((24,128,256), -1)
+    hits[records['vfatN'], records['vfatCH'], records['vcal']] = records['Nhits']
+    vcal = np.arange(256)
+    rising = hits > low * records['Nev'][0]
+    firstRise = np.where(rising.any(axis=-1), np.argmax(rising, axis=-1), 256)
+    empty = (hits == 0) & (vcal >= 1) & (vcal < firstRise[..., np.newaxis])
+    return np.where(empty.any(axis=-1), 255 - np.argmax(empty[..., ::-1], axis=-1), 0)
+
+def percentiles(values):
+    if len(values) == 0:
+        return [ float('nan') ] * 3
+    return [ float(x) for x in np.percentile(values, [50, 95, 100]) ]
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--nvfats", type="int", dest="nvfats", default=4,
+                      help="Number of VFATs with data, the others are dead", metavar="nvfats")
+    parser.add_option("--fitWindow", type="int", dest="fitWindow", default=5,
+                      help="VCal units kept on each side of the transition", metavar="fitWindow")
+    parser.add_option("--nevents", type="int", dest="nevents", default=1000,
+                      help="Number of events per VCal point", metavar="nevents")
+    parser.add_option("--vcalStep", type="int", dest="vcalStep", default=1,
+                      help="Step of the VCal scan", metavar="vcalStep")
+    parser.add_option("--thrTolerance", type="float", dest="thrTolerance", default=0.5,
+                      help="Largest threshold difference [DAC units] counted as agreement", metavar="thrTolerance")
+    parser.add_option("--noiseTolerance", type="float", dest="noiseTolerance", default=0.2,
+                      help="Largest noise difference [DAC units] counted as agreement", metavar="noiseTolerance")
+    parser.add_option("--pedEffTolerance", type="float", dest="pedEffTolerance", default=5.,
+                      help="Largest effective pedestal difference (out of 1000) counted as agreement", metavar="pedEffTolerance")
+    parser.add_option("--stepNoise", type="float", dest="stepNoise", default=0.25,
+                      help="Full range fits with a noise below this [DAC units] are steps, excluded from the agreement", metavar="stepNoise")
+    parser.add_option("--minAgreement", type="float", dest="minAgreement", default=0.99,
+                      help="Smallest fraction of agreeing channels for a successful run", metavar="minAgreement")
+    parser.add_option("--maxMaskChanges", type="int", dest="maxMaskChanges", default=0,
+                      help="Largest number of channels masked by one fit only for a successful run", metavar="maxMaskChanges")
+    parser.add_option("--seed", type="int", dest="seed", default=42,
+                      help="Random seed", metavar="seed")
+    parser.add_option("--output", type="string", dest="output", default=None,
+                      help="Write the measurements to this JSON file", metavar="output")
+    (options, args) = parser.parse_args()
+
+    rng = np.random.RandomState(options.seed)
+    pathologies = channelPathologies(rng, deadFraction=0.01, hotFraction=0.01, noisyFraction=0.01,
+                                     deadVFATs=range(options.nvfats, 24))
+    records = makeScurveScan(rng, options.nevents, options.vcalStep, pathologies)
+
+    from anautilities import scurveMaskReasons
+
+    full, fullTime = fitScan(records, None)
+    windowed, windowTime = fitScan(records, options.fitWindow)
+    fullReasons, fullPedEff = scurveMaskReasons(full.scanFits, full.isDead, full.fitValid)
+    windowReasons, windowPedEff = scurveMaskReasons(windowed.scanFits, windowed.isDead, windowed.fitValid)
+
+    #Known disagreements, see the module docstring
+    isHot = pathologies[1]
+    isStep = np.array([ full.scanFits[1][vfat] for vfat in range(0,24) ]) < options.stepNoise
+    isStep &= np.array(full.fitValid) & np.logical_not(isHot)
+    lastEmpty = lastEmptyPoints(records)
+    isPedOnRise = (lastEmpty > 0) & (np.array([ full.scanFits[2][vfat] for vfat in range(0,24) ]) > lastEmpty)
+    isPedOnRise &= np.array(full.fitValid) & np.logical_not(isHot | isStep)
+    excluded = isHot | isStep | isPedOnRise
+
+    bothValid = np.array(full.fitValid) & np.array(windowed.fitValid)
+    compared = bothValid & np.logical_not(excluded)
+    results = {"fitWindow":options.fitWindow, "channels":int(np.count_nonzero(np.logical_not(full.isDead))),
+               "time":{"full":fullTime, "window":windowTime}, "valid":{}, "agreement":{}, "excluded":{}}
+    results["valid"]["full"] = int(np.count_nonzero(full.fitValid))
+    results["valid"]["window"] = int(np.count_nonzero(windowed.fitValid))
+    results["valid"]["both"] = int(np.count_nonzero(bothValid))
+    results["valid"]["compared"] = int(np.count_nonzero(compared))
+    results["excluded"]["hot"] = int(np.count_nonzero(isHot & np.logical_not(np.array(full.isDead))))
+    results["excluded"]["step"] = int(np.count_nonzero(isStep))
+    results["excluded"]["pedestalOnRise"] = int(np.count_nonzero(isPedOnRise))
+
+    print "%i channels fitted over the full range in %.2f s, in a window of +-%i in %.2f s (x%.1f)"%(
+            results["channels"], fullTime, options.fitWindow, windowTime, fullTime / windowTime)
+    print "Valid fits: %(full)i full range, %(window)i window, %(both)i both, %(compared)i compared"%(results["valid"])
+    print "Excluded: %(hot)i hot channels, %(step)i full range fits on a step, %(pedestalOnRise)i with the pedestal on the rise"%(results["excluded"])
+    print "%-10s %10s %10s %10s %10s"%("|diff|", "median", "95%", "max", "agree")
+    agree = compared.copy()
+    diffs = {"ped_eff":np.abs(windowPedEff - fullPedEff)}
+    for name, ipar in [("threshold", 0), ("noise", 1)]:
+        diffs[name] = np.abs(np.array([ windowed.scanFits[ipar][vfat] for vfat in range(0,24) ]) -
+                             np.array([ full.scanFits[ipar][vfat] for vfat in range(0,24) ]))
+        pass
+    for name, tolerance in [("threshold", options.thrTolerance), ("noise", options.noiseTolerance), ("ped_eff", options.pedEffTolerance)]:
+        diff = diffs[name]
+        agree &= diff <= tolerance
+        median, p95, maximum = percentiles(diff[compared])
+        fraction = np.count_nonzero(compared & (diff <= tolerance)) / float(max(1, results["valid"]["compared"]))
+        results["agreement"][name] = {"median":median, "p95":p95, "max":maximum, "tolerance":tolerance, "fraction":fraction}
+        print "%-10s %10.4f %10.4f %10.4f %9.2f%%"%(name, median, p95, maximum, 100. * fraction)
+        pass
+    fraction = np.count_nonzero(agree) / float(max(1, results["valid"]["compared"]))
+    results["agreement"]["both"] = fraction
+    print "%.2f%% of the channels agree in threshold, noise and effective pedestal"%(100. * fraction)
+
+    kept = np.logical_not(excluded)
+    results["masks"] = maskChanges(fullReasons[kept], windowReasons[kept])
+    results["masks"]["channels"] = int(np.count_nonzero(fullReasons[kept] != windowReasons[kept]))
+    results["masks"]["masked"] = int(np.count_nonzero((fullReasons[kept] != 0) != (windowReasons[kept] != 0)))
+    print "%-10s %10s %10s"%("mask", "added", "dropped")
+    for name in ['HotChannel', 'FitFailed', 'HighNoise', 'HighEffPed']:
+        print "%-10s %10i %10i"%(name, results["masks"][name]["added"], results["masks"][name]["dropped"])
+        pass
+    print "%i channels have a different mask reason, %i are masked by one fit only (excluded channels left out)"%(results["masks"]["channels"], results["masks"]["masked"])
+
+    if options.output is not None:
+        with open(options.output, 'w') as outF:
+            json.dump(results, outF, indent=1, sort_keys=True)
+            pass
+        pass
+    sys.exit(0 if fraction >= options.minAgreement and results["masks"]["masked"] <= options.maxMaskChanges else 1)
@@ -0,0 +1,84 @@
+#!/bin/env python
+"""
+Compares the streaming TDigest reference with the exact NumPy computation of
+median, MAD and IQR, in accuracy and speed, on synthetic per-channel values
+(a Gaussian bulk with a tail of hot channels).
+
+    python benchmarks/benchQuantileSketch.py --nscans=1000
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from quantilesketch import TDigest
+
+def syntheticScan(rng, nChambers=10, hotFraction=0.01):
+    """Per-channel values of one scan of nChambers chambers"""
+    values = rng.normal(30., 3., (nChambers, 24, 128))
+    hot = rng.uniform(size=values.shape) < hotFraction
+    values[hot] -= rng.exponential(15., np.count_nonzero(hot))
+    return values
+
+def exactStats(values):
+    median = np.median(values)
+    mad = np.median(np.abs(values - median))
+    q1, q3 = np.percentile(values, [25, 75])
+    return median, mad, q3 - q1
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--nscans", type="int", dest="nscans", default=500,
+                      help="Number of synthetic scans to accumulate", metavar="nscans")
+    parser.add_option("--compression", type="float", dest="compression", default=200.,
+                      help="Compression of the sketch", metavar="compression")
+    parser.add_option("--seed", type="int", dest="seed", default=42,
+                      help="Random seed", metavar="seed")
+    (options, args) = parser.parse_args()
+
+    rng = np.random.RandomState(options.seed)
+    scans = [ syntheticScan(rng) for scan in range(options.nscans) ]
+
+    # Streaming: one update per scan
+    start = time.time()
+    sketch = TDigest(options.compression)
+    for scan in scans:
+        sketch.update(scan)
+        pass
+    sketchStats = (sketch.median(), sketch.mad(), sketch.iqr())
+    sketchTime = time.time() - start
+
+    # Exact: needs all the values in memory at once
+    start = time.time()
+    allValues = np.concatenate([ scan.ravel() for scan in scans ])
+    exact = exactStats(allValues)
+    exactTime = time.time() - start
+
+    print "%i values from %i scans, %i centroids"%(len(allValues), options.nscans, len(sketch.means))
+    print "%-8s %12s %12s %12s"%("", "exact", "sketch", "rel. error")
+    for name, vExact, vSketch in zip(["median", "MAD", "IQR"], exact, sketchStats):
+        print "%-8s %12.5f %12.5f %12.2e"%(name, vExact, vSketch, abs(vSketch - vExact) / abs(vExact))
+        pass
+
+    sortedValues = np.sort(allValues)
+    print "%-8s %12s %12s"%("quantile", "rank error", "")
+    for q in [0.001, 0.01, 0.25, 0.5, 0.75, 0.99, 0.999]:
+        rank = np.searchsorted(sortedValues, sketch.quantile(q)) / float(len(sortedValues))
+        print "%-8g %12.2e"%(q, abs(rank - q))
+        pass
+
+    # Agreement of the hot channel flags on a new scan
+    from anautilities import isOutlierMADOneSidedReference
+    testScan = syntheticScan(rng)
+    median, mad, iqr = exact
+    exactFlags = (0.6745 * (testScan - median) / mad) < -3.5
+    sketchFlags = isOutlierMADOneSidedReference(testScan, sketch, rejectHighTail=False)
+    print "Hot channel flags: %i exact, %i sketch, %i disagreements out of %i channels"%(
+            np.count_nonzero(exactFlags), np.count_nonzero(sketchFlags),
+            np.count_nonzero(exactFlags != sketchFlags), testScan.size)
+
+    print "Time: exact %.3f s (%.1f MB in memory), sketch %.3f s (%.1f kB on disk)"%(
+            exactTime, allValues.nbytes / 1e6, sketchTime, 3 * 8 * len(sketch.means) / 1e3)
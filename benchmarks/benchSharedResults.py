@@ -0,0 +1,70 @@
+#!/bin/env python
+"""
+Compares returning the per-channel results of Pool jobs pickled, as
+Pool.map does, with storing them to the slots of a SharedResults (see
+ana_scans.launchAnaShared), in time and in bytes sent back per job. Each job
+fills a chamber array of random values, standing for one analysis.
+
+    python benchmarks/benchSharedResults.py --njobs=200 --nprocs=12
+"""
+
+import cPickle
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from anautilities import initChamberArray
+from sharedresults import SharedResults
+
+#Created before the Pool, see SharedResults
+results = None
+
+def chamberResults(job):
+    data = initChamberArray()
+    rng = np.random.RandomState(job)
+    for name in ['threshold', 'noise', 'pedestal', 'ped_eff', 'chi2']:
+        data[name] = rng.uniform(0., 100., data.shape)
+        pass
+    data['mask'] = rng.uniform(size=data.shape) < 0.01
+    return data
+
+def returnPickled(job):
+    return chamberResults(job)
+
+def returnShared(args):
+    slot, job = args
+    results.store(slot, chamberResults(job))
+    return slot
+
+if __name__ == '__main__':
+    from multiprocessing import Pool
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--njobs", type="int", dest="njobs", default=200,
+                      help="Number of jobs", metavar="njobs")
+    parser.add_option("--nprocs", type="int", dest="nprocs", default=4,
+                      help="Number of Pool workers", metavar="nprocs")
+    (options, args) = parser.parse_args()
+
+    jobs = range(options.njobs)
+    results = SharedResults(len(jobs))
+    pool = Pool(options.nprocs)
+
+    start = time.time()
+    pickled = np.array(pool.map(returnPickled, jobs))
+    pickledTime = time.time() - start
+
+    start = time.time()
+    slots = pool.map(returnShared, list(enumerate(jobs)))
+    shared = results.array()
+    sharedTime = time.time() - start
+    pool.close()
+    pool.join()
+
+    assert results.filled().all() and (shared == pickled).all(), 'Shared results differ from the pickled ones'
+    print "%i jobs, %i workers"%(options.njobs, options.nprocs)
+    print "%-8s %10s %14s"%("", "time [s]", "bytes per job")
+    print "%-8s %10.3f %14i"%("pickled", pickledTime, len(cPickle.dumps(pickled[0], cPickle.HIGHEST_PROTOCOL)))
+    print "%-8s %10.3f %14i"%("shared", sharedTime, len(cPickle.dumps(slots[0], cPickle.HIGHEST_PROTOCOL)))
@@ -0,0 +1,99 @@
+#!/bin/env python
+"""
+Measures the startup cost of the entry points and helper modules, each in a
+fresh interpreter:
+
+    - the wall time of "<script> --help" for every analysis script and macro
+    - the import time of the helper modules, and whether they load ROOT
+
+    python benchmarks/benchStartup.py --repeat=5 --output=startup.json
+
+Python 2 has no "-X importtime", so the time of each import is taken around
+the import statement itself.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+projectHome = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+entryPoints = [
+    "anaUltraScurve.py", "anaUltraThreshold.py", "anaUltraLatency.py", "anaXDAQLatency.py",
+    "anaLiveScurve.py", "ana_scans.py", "ana_queue.py", "calibhistory.py", "columnar.py", "quantilesketch.py",
+    "macros/summary_plots.py", "macros/plot_vfat_summary.py", "macros/plot_scurves_by_thresh.py",
+    "macros/plot_vfat_and_channel_Scurve.py", "macros/plot_noise_vs_trim.py", "macros/noise_vs_trim_table.py"
+    ]
+
+helperModules = [
+    "anautilities", "fitting.fitScanData", "mapping.channelMaps", "mapping.PanChannelMaps",
+    "mapping.mapFiles", "columnar", "treeindex", "quantilesketch"
+    ]
+
+importSnippet = "import sys, time; start = time.time(); import %s; print time.time() - start, 'ROOT' in sys.modules"
+
+def environment():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([projectHome, env.get("PYTHONPATH", "")])
+    return env
+
+def timeCommand(cmd, repeat):
+    """Returns the wall times of repeat runs of cmd and its last return code"""
+    times = []
+    returncode = None
+    for idx in range(repeat):
+        start = time.time()
+        with open(os.devnull, 'w') as devnull:
+            returncode = subprocess.call(cmd, cwd=projectHome, env=environment(), stdout=devnull, stderr=devnull)
+        times.append(time.time() - start)
+        pass
+    return times, returncode
+
+def timeImport(module, repeat):
+    """Returns the import times of module and whether it loaded ROOT"""
+    times = []
+    loadsROOT = None
+    for idx in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c", importSnippet%(module)], cwd=projectHome, env=environment())
+        importTime, loadsROOT = output.split()
+        times.append(float(importTime))
+        pass
+    return times, loadsROOT == "True"
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--repeat", type="int", dest="repeat", default=3,
+                      help="Number of runs of each measurement, the minimum is reported", metavar="repeat")
+    parser.add_option("--output", type="string", dest="output", default=None,
+                      help="Write the measurements to this JSON file", metavar="output")
+    (options, args) = parser.parse_args()
+
+    results = {"python":sys.version.split()[0], "entryPoints":{}, "modules":{}}
+
+    # Baseline: the interpreter alone
+    times, returncode = timeCommand([sys.executable, "-c", "pass"], options.repeat)
+    results["interpreter"] = min(times)
+    print "%-42s %8.3f s"%("python -c pass", min(times))
+
+    print "%-42s %8s %s"%("--help", "wall", "")
+    for script in entryPoints:
+        times, returncode = timeCommand([sys.executable, script, "--help"], options.repeat)
+        results["entryPoints"][script] = {"wall":min(times), "returncode":returncode}
+        print "%-42s %8.3f s %s"%(script, min(times), "" if returncode == 0 else "(exit code %i)"%returncode)
+        pass
+
+    print "%-42s %8s %s"%("import", "time", "ROOT")
+    for module in helperModules:
+        times, loadsROOT = timeImport(module, options.repeat)
+        results["modules"][module] = {"import":min(times), "loadsROOT":loadsROOT}
+        print "%-42s %8.3f s %s"%(module, min(times), "yes" if loadsROOT else "no")
+        pass
+
+    if options.output is not None:
+        with open(options.output, 'w') as outF:
+            json.dump(results, outF, indent=1, sort_keys=True)
+            pass
+        pass
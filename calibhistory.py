@@ -0,0 +1,316 @@
+#!/bin/env python
+"""
+Historical store of the per-channel calibration results of many scans.
+
+The fit results, masks, trimDAC and vthr of every SCurveFitData.root, the
+chConfig.txt and chConfig_MasksUpdated.txt files and the vt1 and trimRange of
+every vfatConfig.txt found under $DATA_PATH are loaded into one SQLite database, indexed by (chamber,
+scandate, vfat, channel). Ingestion is incremental: files already loaded, with
+the same size and modification time, are skipped.
+
+Loading everything new under $DATA_PATH:
+
+    calibhistory.py --db=calibHistory.sqlite --ingest
+
+Noise and threshold of VFAT 7 channel 42 over the last 50 scurve scans:
+
+    calibhistory.py --db=calibHistory.sqlite --chamber=GEMINIm01L1 --vfat=7 --channel=42 --fields=noise,threshold --last=50
+
+or from Python, as a structured NumPy array ordered by scandate:
+
+    history = CalibrationHistory('calibHistory.sqlite')
+    data = history.channels(['noise','threshold'], chamber='GEMINIm01L1', vfat=7, channel=42, last=50)
+"""
+
+import glob
+import os
+import sqlite3
+import numpy as np
+from anautilities import chamberDataType
+
+#Files of each analysis type, as glob patterns relative to $DATA_PATH/<chamber>/<anaType>;
+#the scandate is the directory holding the analysis output directory. Each
+#kind matches at most one file per scan, so that its rows can be told apart.
+scanFiles = {
+    "scurve":[ ("fit", "*/SCurveData/SCurveFitData.root"), ("chConfig", "*/SCurveData/chConfig.txt") ],
+    "trim":[ ("fit", "z*/*/SCurveData_Trimmed/SCurveFitData.root"), ("chConfig", "z*/*/SCurveData_Trimmed/chConfig.txt") ],
+    "threshold":[ ("vfatConfig", "channel/*/ThresholdScanData/vfatConfig.txt"),
+                  ("chConfig", "channel/*/ThresholdScanData/chConfig.txt"),
+                  ("chConfigMasksUpdated", "channel/*/ThresholdScanData/chConfig_MasksUpdated.txt") ]
+    }
+
+channelFields = [ name for name in chamberDataType.names if name not in ['vfatN', 'vfatCH'] ]
+vfatFields = ['vt1', 'trimRange']
+
+schema = """
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    size INTEGER,
+    mtime REAL,
+    kind TEXT,
+    chamber TEXT,
+    anaType TEXT,
+    scandate TEXT
+    );
+CREATE TABLE IF NOT EXISTS channels (
+    scan INTEGER REFERENCES scans(id),
+    chamber TEXT,
+    scandate TEXT,
+    vfatN INTEGER,
+    vfatCH INTEGER,
+    %s
+    );
+CREATE TABLE IF NOT EXISTS vfats (
+    scan INTEGER REFERENCES scans(id),
+    chamber TEXT,
+    scandate TEXT,
+    vfatN INTEGER,
+    %s
+    );
+CREATE INDEX IF NOT EXISTS channelsByScandate ON channels (chamber, scandate, vfatN, vfatCH);
+CREATE INDEX IF NOT EXISTS channelsByChannel ON channels (chamber, vfatN, vfatCH, scandate);
+CREATE INDEX IF NOT EXISTS channelsByScan ON channels (scan);
+CREATE INDEX IF NOT EXISTS vfatsByScandate ON vfats (chamber, scandate, vfatN);
+CREATE INDEX IF NOT EXISTS vfatsByScan ON vfats (scan);
+"""%(",\n    ".join("%s %s"%(name, "REAL" if chamberDataType[name].kind == 'f' else "INTEGER") for name in channelFields),
+     ",\n    ".join("%s INTEGER"%(name) for name in vfatFields))
+
+def findScanFiles(dataPath, chambers=None, anaTypes=None):
+    """Returns the (kind, chamber, anaType, scandate, path) of the analysis
+    files found under dataPath"""
+    if chambers is None:
+        chambers = sorted(name for name in os.listdir(dataPath) if os.path.isdir(os.path.join(dataPath, name)))
+        pass
+    if anaTypes is None:
+        anaTypes = sorted(scanFiles.keys())
+        pass
+
+    found = []
+    for chamber in chambers:
+        for anaType in anaTypes:
+            for kind, pattern in scanFiles[anaType]:
+                for path in sorted(glob.glob(os.path.join(dataPath, chamber, anaType, pattern))):
+                    scandate = path.split(os.sep)[-3]
+                    found.append((kind, chamber, anaType, scandate, path))
+                    pass
+                pass
+            pass
+        pass
+    return found
+
+class CalibrationHistory(object):
+    """SQLite database of the per-channel and per-VFAT results of many scans"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    def isLoaded(self, path, kind=None):
+        """Returns True if path is loaded, as kind if given, and unchanged since"""
+        stat = os.stat(path)
+        row = self.db.execute("SELECT size, mtime, kind FROM scans WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        return row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime and kind in (None, row[2])
+
+    def ingestFile(self, kind, chamber, anaType, scandate, path):
+        """Loads one analysis file, replacing what was loaded from it before"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        if kind == "fit":
+            from anautilities import chamberArrayFromTree
+            #With several scans in the fit file the last one is used
+            data = chamberArrayFromTree(path)[-1].ravel()
+            columns = dict( (name, data[name]) for name in chamberDataType.names )
+            pass
+        else:
+            from configfiles import readConfig
+            data = readConfig(path)
+            columns = dict( (name, data[name]) for name in data.dtype.names )
+            pass
+
+        with self.db:
+            self.removeFile(path)
+            scan = self.db.execute("INSERT INTO scans (path, size, mtime, kind, chamber, anaType, scandate) VALUES (?,?,?,?,?,?,?)",
+                                   (path, stat.st_size, stat.st_mtime, kind, chamber, anaType, scandate)).lastrowid
+            if kind == "vfatConfig":
+                table, keys, fields = "vfats", ["vfatN"], vfatFields
+                pass
+            else:
+                table, keys, fields = "channels", ["vfatN", "vfatCH"], channelFields
+                pass
+            #Columns missing from the file (e.g. noise in chConfig.txt) are left NULL
+            names = keys + [ name for name in fields if name in columns ]
+            rows = zip(*([ [scan] * len(columns["vfatN"]), [chamber] * len(columns["vfatN"]), [scandate] * len(columns["vfatN"]) ] +
+                         [ columns[name].tolist() for name in names ]))
+            self.db.executemany("INSERT INTO %s (scan, chamber, scandate, %s) VALUES (%s)"%(table, ", ".join(names), ",".join("?" * (len(names) + 3))),
+                                rows)
+            pass
+        return len(rows)
+
+    def removeFile(self, path):
+        """Removes what was loaded from path"""
+        for (scan,) in self.db.execute("SELECT id FROM scans WHERE path = ?", (path,)).fetchall():
+            self.db.execute("DELETE FROM channels WHERE scan = ?", (scan,))
+            self.db.execute("DELETE FROM vfats WHERE scan = ?", (scan,))
+            self.db.execute("DELETE FROM scans WHERE id = ?", (scan,))
+            pass
+        return
+
+    def ingest(self, dataPath, chambers=None, anaTypes=None, force=False):
+        """Loads the analysis files under dataPath not loaded yet, or changed
+        since. Returns the number of files loaded and skipped."""
+        nLoaded = 0
+        nSkipped = 0
+        for kind, chamber, anaType, scandate, path in findScanFiles(dataPath, chambers, anaTypes):
+            if not force and self.isLoaded(path, kind):
+                nSkipped += 1
+                continue
+            try:
+                nRows = self.ingestFile(kind, chamber, anaType, scandate, path)
+            except Exception as e:
+                print "Unable to load %s: %s"%(path, e)
+                continue
+            print "Loaded %i rows from %s"%(nRows, path)
+            nLoaded += 1
+            pass
+        return nLoaded, nSkipped
+
+    def scans(self, chamber=None, anaType=None, kind=None):
+        """Returns the (chamber, anaType, scandate, kind, path) of the loaded
+        files, ordered by scandate"""
+        where, args = self._where([ ("chamber", chamber), ("anaType", anaType), ("kind", kind) ])
+        return self.db.execute("SELECT chamber, anaType, scandate, kind, path FROM scans %s ORDER BY scandate, chamber"%(where), args).fetchall()
+
+    def channels(self, fields, chamber=None, vfat=None, channel=None, anaType="scurve", kind="fit", since=None, until=None, last=None):
+        """Returns the per-channel fields of the matching scans as a structured
+        array with chamber, scandate, vfatN and vfatCH, ordered by scandate.
+        last keeps the last scandates of each chamber. Missing values are NaN
+        or -1."""
+        for name in fields:
+            if name not in channelFields:
+                raise ValueError("Unknown channel field %s, expected one of %s"%(name, channelFields))
+            pass
+        return self._select("channels", ["vfatN", "vfatCH"], fields, [("vfatN", vfat), ("vfatCH", channel)],
+                            chamber, anaType, kind, since, until, last)
+
+    def vfats(self, fields=vfatFields, chamber=None, vfat=None, since=None, until=None, last=None):
+        """Returns the per-VFAT fields (vt1, trimRange) of the matching
+        threshold scans, like channels"""
+        for name in fields:
+            if name not in vfatFields:
+                raise ValueError("Unknown VFAT field %s, expected one of %s"%(name, vfatFields))
+            pass
+        return self._select("vfats", ["vfatN"], fields, [("vfatN", vfat)],
+                            chamber, "threshold", "vfatConfig", since, until, last)
+
+    def _where(self, conditions, prefix=""):
+        clauses = [ "%s%s = ?"%(prefix, name) for name, value in conditions if value is not None ]
+        args = [ value for name, value in conditions if value is not None ]
+        if not clauses:
+            return "", args
+        return "WHERE " + " AND ".join(clauses), args
+
+    def _select(self, table, keys, fields, keyConditions, chamber, anaType, kind, since, until, last):
+        where, args = self._where([ ("chamber", chamber), ("anaType", anaType), ("kind", kind) ])
+        for clause, value in [ ("scandate >= ?", since), ("scandate <= ?", until) ]:
+            if value is not None:
+                where += (" AND " if where else "WHERE ") + clause
+                args.append(value)
+                pass
+            pass
+        scans = self.db.execute("SELECT id, chamber, scandate FROM scans %s ORDER BY scandate DESC"%(where), args).fetchall()
+        if last is not None:
+            #last counts scandates, not files
+            scandates = {}
+            kept = []
+            for scan, chamber, scandate in scans:
+                chamberScandates = scandates.setdefault(chamber, set())
+                if scandate not in chamberScandates and len(chamberScandates) >= last:
+                    continue
+                chamberScandates.add(scandate)
+                kept.append((scan, chamber, scandate))
+                pass
+            scans = kept
+            pass
+        #Scan ids come from the database, so they can be put in the query as is
+        scanIds = ",".join(str(scan) for scan, chamber, scandate in scans)
+        keyWhere, keyArgs = self._where(keyConditions)
+        query = "SELECT chamber, scandate, %s FROM %s WHERE scan IN (%s) %s ORDER BY scandate, chamber, %s"%(
+            ", ".join(keys + list(fields)), table, scanIds, keyWhere.replace("WHERE", "AND"), ", ".join(keys))
+        rows = self.db.execute(query, keyArgs).fetchall()
+
+        dtype = [ ('chamber', 'S32'), ('scandate', 'S32') ] + [ (name, 'i4') for name in keys ]
+        dtype += [ (name, chamberDataType[name] if name in chamberDataType.names else 'i4') for name in fields ]
+        dtype = np.dtype(dtype)
+        missing = tuple( np.nan if dtype[name].kind == 'f' else -1 for name in dtype.names )
+        return np.array([ tuple(missing[idx] if value is None else value for idx, value in enumerate(row)) for row in rows ],
+                        dtype=dtype)
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--db", type="string", dest="db", default="calibHistory.sqlite",
+                      help="SQLite database file", metavar="db")
+    parser.add_option("--ingest", action="store_true", dest="ingest",
+                      help="Load the analysis files under --dataPath not loaded yet", metavar="ingest")
+    parser.add_option("--dataPath", type="string", dest="dataPath", default=os.getenv('DATA_PATH'),
+                      help="Directory to load the analysis files from (default is $DATA_PATH)", metavar="dataPath")
+    parser.add_option("--force", action="store_true", dest="force",
+                      help="Reload files even if they are already loaded", metavar="force")
+    parser.add_option("--chamber", type="string", dest="chamber", default=None,
+                      help="Comma separated list of chambers to load, or the chamber to query", metavar="chamber")
+    parser.add_option("--anaType", type="string", dest="anaType", default=None,
+                      help="Comma separated list of analysis types to load, from {'scurve','trim','threshold'}, or the one to query (default is scurve)", metavar="anaType")
+    parser.add_option("--kind", type="string", dest="kind", default="fit",
+                      help="Kind of file to query, from {'fit','chConfig','chConfigMasksUpdated'}", metavar="kind")
+    parser.add_option("--vfat", type="int", dest="vfat", default=None,
+                      help="VFAT to query", metavar="vfat")
+    parser.add_option("--channel", type="int", dest="channel", default=None,
+                      help="Channel to query", metavar="channel")
+    parser.add_option("--fields", type="string", dest="fields", default="threshold,noise,mask,maskReason",
+                      help="Comma separated list of fields to query, vt1 and trimRange query the VFAT configurations", metavar="fields")
+    parser.add_option("--since", type="string", dest="since", default=None,
+                      help="Earliest scandate to query", metavar="since")
+    parser.add_option("--until", type="string", dest="until", default=None,
+                      help="Latest scandate to query", metavar="until")
+    parser.add_option("--last", type="int", dest="last", default=None,
+                      help="Query only the last scans of each chamber", metavar="last")
+    parser.add_option("--output", type="string", dest="output", default=None,
+                      help="Save the result of the query to this .npy file", metavar="output")
+
+    (options, args) = parser.parse_args()
+
+    history = CalibrationHistory(options.db)
+    if options.ingest:
+        if options.dataPath is None:
+            print "Please give --dataPath or set $DATA_PATH"
+            exit(1)
+            pass
+        nLoaded, nSkipped = history.ingest(options.dataPath,
+                                           options.chamber.split(',') if options.chamber else None,
+                                           options.anaType.split(',') if options.anaType else None,
+                                           options.force)
+        print "%i files loaded, %i already loaded"%(nLoaded, nSkipped)
+        pass
+    else:
+        fields = options.fields.split(',')
+        if all(name in vfatFields for name in fields):
+            result = history.vfats(fields, options.chamber, options.vfat, options.since, options.until, options.last)
+            pass
+        else:
+            result = history.channels(fields, options.chamber, options.vfat, options.channel, options.anaType or "scurve",
+                                      options.kind, options.since, options.until, options.last)
+            pass
+        print "\t".join(result.dtype.names)
+        for row in result:
+            print "\t".join(str(value) for value in row)
+            pass
+        if options.output is not None:
+            np.save(options.output, result)
+            pass
+        pass
+    history.close()
@@ -0,0 +1,171 @@
+#!/bin/env python
+"""
+Columnar copies of the trees of a scan file.
+
+Each numeric branch of a tree in scan.root is written once to
+scan.root.columns/<tree>.<branch>.npy, with a small JSON header
+scan.root.columns/<tree>.json holding the number of entries, the branch
+types and the size and modification time of scan.root. Later reads memory-map
+the branches they need instead of going through ROOT. A copy whose header no
+longer matches scan.root is ignored, and readers fall back to the ROOT file.
+
+Converting every tree of a file:
+
+    columnar.py -i SCurveData.root
+
+Reading, with the same result whether or not the columns exist:
+
+    data = readColumns('SCurveData.root', 'scurveTree', ['vfatN','vfatCH','Nhits'])
+    for event in treeEvents('SCurveData.root', 'scurveTree'):
+        print event.vfatN, event.vfatCH, event.Nhits
+"""
+
+import json
+import os
+import numpy as np
+from collections import namedtuple
+
+def columnDir(filename):
+    return filename + '.columns'
+
+def sourceSignature(filename):
+    """Size and modification time of filename, stored in the header"""
+    stat = os.stat(filename)
+    return {"size":stat.st_size, "mtime":stat.st_mtime}
+
+def readHeader(filename, treename):
+    """Returns the header of the columns of treename, or None if they are
+    missing or older than filename"""
+    headerFile = os.path.join(columnDir(filename), '%s.json'%(treename))
+    if not os.path.isfile(headerFile):
+        return None
+    with open(headerFile, 'r') as inF:
+        header = json.load(inF)
+    if header["source"] != sourceSignature(filename):
+        return None
+    header["branches"] = dict( (str(branch), dtype) for branch, dtype in header["branches"].iteritems() )
+    return header
+
+def convertTree(filename, treename, branches=None):
+    """Writes the columns of treename in filename, one branch at a time.
+    Branches root_numpy can not convert (e.g. histograms) are left out.
+    Returns the header."""
+    import root_numpy as rp
+
+    if branches is None:
+        branches = rp.list_branches(filename, treename)
+        pass
+    outDir = columnDir(filename)
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+        pass
+
+    header = {"tree":treename, "entries":None, "branches":{}, "source":sourceSignature(filename)}
+    for branch in branches:
+        try:
+            column = rp.root2array(filename, treename=treename, branches=[branch])[branch]
+        except (TypeError, ValueError):
+            print "Skipping branch %s of %s, it is not a numeric type"%(branch, treename)
+            continue
+        if column.dtype == object:
+            continue
+        np.save(os.path.join(outDir, '%s.%s.npy'%(treename, branch)), column)
+        header["entries"] = len(column)
+        header["branches"][branch] = column.dtype.str
+        pass
+
+    #Written last, so that an interrupted conversion leaves no valid header
+    with open(os.path.join(outDir, '%s.json'%(treename)), 'w') as outF:
+        json.dump(header, outF, indent=1, sort_keys=True)
+        pass
+    return header
+
+def listBranches(filename, treename):
+    """Returns the branch names of treename, from the columns if possible"""
+    header = readHeader(filename, treename)
+    if header is not None:
+        return sorted(header["branches"].keys())
+    import root_numpy as rp
+    return rp.list_branches(filename, treename)
+
+def readColumns(filename, treename, branches=None):
+    """Returns a dictionary of branch name to array for the branches of
+    treename. The arrays are memory-mapped from the columns when they exist
+    and hold every requested branch, otherwise they are read with root_numpy."""
+    header = readHeader(filename, treename)
+    if header is not None:
+        if branches is None:
+            branches = sorted(header["branches"].keys())
+            pass
+        if all(branch in header["branches"] for branch in branches):
+            return dict( (branch, np.load(os.path.join(columnDir(filename), '%s.%s.npy'%(treename, branch)), mmap_mode='r'))
+                         for branch in branches )
+        pass
+
+    import root_numpy as rp
+    data = rp.root2array(filename, treename=treename, branches=branches)
+    return dict( (branch, data[branch]) for branch in data.dtype.names )
+
+def treeEvents(filename, treename, branches=None, chunkSize=65536):
+    """Iterates over the entries of treename. With columns, each entry is a
+    namedtuple of Python values of the branches; without, the PyROOT tree
+    itself is iterated. Either way the branches are attributes of the event."""
+    header = readHeader(filename, treename)
+    if header is None or (branches is not None and not all(branch in header["branches"] for branch in branches)):
+        import ROOT as r
+        inF = r.TFile(filename)
+        for event in getattr(inF, treename):
+            yield event
+            pass
+        return
+
+    for event in columnEvents(readColumns(filename, treename, branches), treename, chunkSize):
+        yield event
+        pass
+    return
+
+def columnEvents(data, treename, chunkSize=65536):
+    """Iterates over the entries of data, a dictionary of branch name to
+    array as returned by readColumns, as namedtuples of Python values"""
+    names = sorted(data.keys())
+    if not names:
+        return
+    Event = namedtuple('%sEvent'%(treename), names)
+    for start in range(0, len(data[names[0]]), chunkSize):
+        #tolist gives Python values, as PyROOT does
+        columns = [ data[name][start:start+chunkSize].tolist() for name in names ]
+        for values in zip(*columns):
+            yield Event._make(values)
+            pass
+        pass
+    return
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("-i", "--infilename", type="string", dest="filename",
+                      help="Comma separated list of ROOT files to convert", metavar="filename")
+    parser.add_option("--tree", type="string", dest="tree", default=None,
+                      help="Comma separated list of trees to convert, default is all of them", metavar="tree")
+    parser.add_option("--force", action="store_true", dest="force",
+                      help="Convert even if the columns are up to date", metavar="force")
+
+    (options, args) = parser.parse_args()
+
+    import root_numpy as rp
+
+    for filename in options.filename.split(','):
+        if options.tree is None:
+            trees = rp.list_trees(filename)
+            pass
+        else:
+            trees = options.tree.split(',')
+            pass
+        for treename in trees:
+            if not options.force and readHeader(filename, treename) is not None:
+                print "%s of %s is up to date"%(treename, filename)
+                continue
+            header = convertTree(filename, treename)
+            print "Converted %i branches, %i entries of %s in %s"%(len(header["branches"]), header["entries"] or 0, treename, filename)
+            pass
+        pass
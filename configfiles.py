@@ -0,0 +1,113 @@
+"""
+Bulk reading and writing of the configuration files of the analyses.
+
+chConfig.txt, chConfig_MasksUpdated.txt and vfatConfig.txt are text files in
+the TTree::ReadFile format read by the DAQ: a header such as
+
+    vfatN/I:vfatCH/I:trimDAC/I:mask/I
+
+followed by one tab separated row per channel or VFAT. They are handled here as
+structured arrays with one field per column:
+
+    config = np.zeros(24*128, dtype=chConfigType)
+    ...
+    writeConfig('chConfig.txt', config, binary=True)
+    config = readConfig('chConfig.txt')
+
+The text is written in one piece and is byte-identical to the row by row
+output of the analyses. With binary, a compact copy (16 bit integers) is also
+written to chConfig.npy, which readConfig loads instead of parsing the text as
+long as it is not older than the text. readConfigs stacks many files, e.g. for
+trend studies, and with cache writes the binary copies it was missing.
+"""
+
+import os
+import numpy as np
+
+chConfigType = np.dtype([
+    ('vfatN',       'i4'),
+    ('vfatCH',      'i4'),
+    ('trimDAC',     'i4'),
+    ('mask',        'i4')
+    ])
+
+vfatConfigType = np.dtype([
+    ('vfatN',       'i4'),
+    ('vt1',         'i4'),
+    ('trimRange',   'i4')
+    ])
+
+#TTree::ReadFile type letter of each kind of field
+leafTypes = { 'i':'I', 'u':'I', 'b':'I', 'f':'F' }
+
+def binaryConfigName(filename):
+    """Returns the name of the binary copy of the text file filename"""
+    return os.path.splitext(filename)[0] + '.npy'
+
+def compactType(dtype):
+    """Returns the dtype of the binary copy: 16 bit integers and 32 bit floats"""
+    return np.dtype([ (name, 'f4' if dtype[name].kind == 'f' else 'i2') for name in dtype.names ])
+
+def configHeader(dtype):
+    return ':'.join('%s/%s'%(name, leafTypes[dtype[name].kind]) for name in dtype.names) + '\n'
+
+def formatConfigText(data):
+    """Returns the text of the configuration data, header included"""
+    data = data.ravel()
+    text = configHeader(data.dtype)
+    if len(data) == 0:
+        return text
+    rowFormat = '\t'.join('%f' if data.dtype[name].kind == 'f' else '%i' for name in data.dtype.names) + '\n'
+    values = np.column_stack([ data[name] for name in data.dtype.names ]).ravel().tolist()
+    #One formatting operation for the whole file
+    return text + (rowFormat * len(data))%tuple(values)
+
+def writeConfig(filename, data, binary=False):
+    """Writes the configuration data, a structured array with one field per
+    column, to the text file filename, and with binary its binary copy"""
+    with open(filename, 'w') as outF:
+        outF.write(formatConfigText(data))
+        pass
+    if binary:
+        np.save(binaryConfigName(filename), data.astype(compactType(data.dtype)))
+        pass
+    return
+
+def parseConfigText(text):
+    """Returns the structured array of the text of a configuration file"""
+    header, _, body = text.partition('\n')
+    columns = [ column.strip().split('/') for column in header.split(':') ]
+    dtype = np.dtype([ (name, 'f4' if leaf == 'F' else 'i4') for name, leaf in columns ])
+    values = np.array(body.split(), dtype=float).reshape(-1, len(columns))
+    data = np.zeros(len(values), dtype=dtype)
+    for idx, name in enumerate(dtype.names):
+        data[name] = values[:,idx]
+        pass
+    return data
+
+def readConfig(filename, cache=False):
+    """Returns the content of the configuration file filename as a structured
+    array, from its binary copy when it is up to date. With cache, the binary
+    copy is written if it was missing or out of date."""
+    binaryName = binaryConfigName(filename)
+    if os.path.isfile(binaryName) and os.path.getmtime(binaryName) >= os.path.getmtime(filename):
+        compact = np.load(binaryName)
+        return compact.astype([ (name, 'f4' if compact.dtype[name].kind == 'f' else 'i4') for name in compact.dtype.names ])
+    with open(filename, 'r') as inF:
+        data = parseConfigText(inF.read())
+        pass
+    if cache:
+        np.save(binaryName, data.astype(compactType(data.dtype)))
+        pass
+    return data
+
+def readConfigs(filenames, cache=False):
+    """Returns the configuration files filenames, which must have the same
+    columns and number of rows, as one array of shape (len(filenames), nRows)"""
+    return np.array([ readConfig(filename, cache) for filename in filenames ])
+
+def readScanInfo(filename):
+    """Returns the rows of the scanInfo.txt file of a trimming, whose columns
+    are separated by two spaces, as a 2D float array (the header is skipped).
+    Raises ValueError on a malformed field."""
+    return np.loadtxt(filename, delimiter='  ', skiprows=1, ndmin=2)
@@ -1,5 +1,7 @@
+import json
+import os
+import time
 import numpy as np
-import ROOT as r
 
 class DeadChannelFinder(object):
     def __init__(self):
@@ -9,9 +11,15 @@ class DeadChannelFinder(object):
         self.isDead[event.vfatN][event.vfatCH] = False
 
 class ScanDataFitter(DeadChannelFinder):
-    def __init__(self):
+    def __init__(self, fitWindow=None):
+        """By default each scurve is fitted over VCal 1-253. With fitWindow,
+        only over its transition (see transitionWindow) extended by fitWindow
+        VCal units on each side, and down to the pedestal points below it.
+        When the window starts above VCal 1 the scurve had no hits below it,
+        and the pedestal parameter is fixed to 0."""
         super(ScanDataFitter, self).__init__()
 
+        import ROOT as r
         from gempython.utils.nesteddict import nesteddict as ndict
         r.gStyle.SetOptStat(0)
 
@@ -33,10 +41,14 @@ class ScanDataFitter(DeadChannelFinder):
 
         self.fitValid = [ np.zeros(128, dtype=bool) for vfat in range(24) ]
         self.Nev = -1
+        self.scannedVCal = np.zeros(256, dtype=bool)
+        self.fitTF1 = None
+        self.fitWindow = fitWindow
 
     def feed(self, event):
         super(ScanDataFitter, self).feed(event)
         self.scanHistos[event.vfatN][event.vfatCH].Fill(event.vcal,event.Nhits)
+        self.scannedVCal[event.vcal] = True
         if(event.vcal > 250):
             self.scanCount[event.vfatN][event.vfatCH] += event.Nhits
         if self.Nev < 0:
@@ -45,61 +57,200 @@ class ScanDataFitter(DeadChannelFinder):
             assert self.Nev == event.Nev, 'Inconsistent S-curve tree'
 
     def readFile(self, treeFileName):
-        inF = r.TFile(treeFileName)
-        for event in inF.scurveTree :
+        from columnar import treeEvents
+        for event in treeEvents(treeFileName, 'scurveTree'):
             self.feed(event)
 
-    def fit(self):
-        r.gROOT.SetBatch(True)
-        r.gStyle.SetOptStat(0)
-
-        random = r.TRandom3()
-        random.SetSeed(0)
-        fitTF1 = r.TF1('myERF','%f*TMath::Erf((TMath::Max([2],x)-[0])/(TMath::Sqrt(2)*[1]))+%f'%(self.Nev/2.),1,253)
+    def fit(self, checkpoint=None, checkpointInterval=60., signature=None):
+        """Fits every channel and returns self.scanFits. With checkpoint, the
+        results of the VFATs done so far are saved to that file at most every
+        checkpointInterval seconds and once all are done, and a later call
+        with the same signature (identifying the input data) resumes after
+        the VFATs it holds. The results do not depend on where a run resumed."""
+        done = np.zeros(24, dtype=bool)
+        if checkpoint is not None:
+            done = self.loadCheckpoint(checkpoint, signature)
+            pass
+        lastCheckpoint = time.time()
         for vfat in range(0,24):
+            if done[vfat]:
+                print 'vfat %i restored from %s'%(vfat, checkpoint)
+                continue
             print 'fitting vfat %i'%vfat
             for ch in range(0,128):
-                if self.isDead[vfat][ch]:
-                    continue # Don't try to fit dead channels
-                fitChi2 = 0
-                MinChi2Temp = 99999999
-                stepN = 0
-                while(stepN < 15):
-                    rand = random.Gaus(10, 5)
-                    if (rand < 0.0 or rand > 100): continue
-                    fitTF1.SetParameter(0, 8+stepN*8)
-                    fitTF1.SetParameter(1,rand)
-                    fitTF1.SetParameter(2,8+stepN*8)
-                    fitTF1.SetParLimits(0, 0.01, 300.0)
-                    fitTF1.SetParLimits(1, 0.0, 100.0)
-                    fitTF1.SetParLimits(2, 0.0, 300.0)
-                    fitResult = self.scanHistos[vfat][ch].Fit('myERF','SQ')
-                    fitEmpty = fitResult.IsEmpty()
-                    if fitEmpty:
-                        # Don't try to fit empty data again
-                        break
-                    fitValid = fitResult.IsValid()
-                    if not fitValid:
-                        continue
-                    fitChi2 = fitTF1.GetChisquare()
-                    fitNDF = fitTF1.GetNDF()
-                    stepN +=1
-                    if (fitChi2 < MinChi2Temp and fitChi2 > 0.0):
-                        self.scanFits[0][vfat][ch] = fitTF1.GetParameter(0)
-                        self.scanFits[1][vfat][ch] = fitTF1.GetParameter(1)
-                        self.scanFits[2][vfat][ch] = fitTF1.GetParameter(2)
-                        self.scanFits[3][vfat][ch] = fitChi2
-                        self.scanFits[4][vfat][ch] = self.scanCount[vfat][ch]
-                        self.scanFits[5][vfat][ch] = fitNDF
-                        self.fitValid[vfat][ch] = True
-                        MinChi2Temp = fitChi2
-                        pass
-                    if (MinChi2Temp < 50): break
-                    pass
+                self.fitChannel(vfat, ch)
+                pass
+            done[vfat] = True
+            if checkpoint is not None and (time.time() - lastCheckpoint >= checkpointInterval or done.all()):
+                self.saveCheckpoint(checkpoint, signature, done)
+                lastCheckpoint = time.time()
                 pass
             pass
         return self.scanFits
 
+    def saveCheckpoint(self, filename, signature, done):
+        """Saves the fit results of the VFATs flagged in done to filename,
+        replacing it at once so that an interrupted save leaves the previous
+        checkpoint"""
+        with open(filename + '.tmp', 'wb') as outF:
+            np.savez(outF,
+                     signature=json.dumps(signature, sort_keys=True),
+                     done=done,
+                     scanFits=np.array([ [ self.scanFits[ipar][vfat] for vfat in range(0,24) ] for ipar in range(0,7) ], dtype=float),
+                     fitValid=np.array(self.fitValid),
+                     isDead=np.array(self.isDead))
+            pass
+        os.rename(filename + '.tmp', filename)
+
+    def loadCheckpoint(self, filename, signature):
+        """Restores the fit results of a checkpoint saved with the same
+        signature and returns the (24,) flags of the VFATs it holds"""
+        done = np.zeros(24, dtype=bool)
+        if not os.path.isfile(filename):
+            return done
+        try:
+            with np.load(filename) as inF:
+                if str(inF['signature']) != json.dumps(signature, sort_keys=True):
+                    print 'Ignoring %s, it was made from other data'%(filename)
+                    return done
+                done = inF['done']
+                scanFits = inF['scanFits']
+                fitValid = inF['fitValid']
+                isDead = inF['isDead']
+                pass
+        except (IOError, KeyError, ValueError) as e:
+            print 'Ignoring %s, it can not be read: %s'%(filename, e)
+            return np.zeros(24, dtype=bool)
+        for vfat in np.nonzero(done)[0]:
+            for ipar in range(0,6):
+                self.scanFits[ipar][vfat] = scanFits[ipar][vfat]
+                pass
+            self.scanFits[6][vfat] = scanFits[6][vfat].astype(bool)
+            self.fitValid[vfat] = fitValid[vfat]
+            self.isDead[vfat] = isDead[vfat]
+            pass
+        return done
+
+    def fitChannel(self, vfat, ch):
+        """Fits the scurve of one channel with up to 15 starting points,
+        keeping the fit of lowest chi2. A channel fitted before is refitted
+        from scratch, e.g. once more of its scurve has been fed."""
+        if self.isDead[vfat][ch]:
+            return # Don't try to fit dead channels
+        if self.fitTF1 is None:
+            import ROOT as r
+            r.gROOT.SetBatch(True)
+            r.gStyle.SetOptStat(0)
+
+            self.random = r.TRandom3()
+            self.fitTF1 = r.TF1('myERF','%f*TMath::Erf((TMath::Max([2],x)-[0])/(TMath::Sqrt(2)*[1]))+%f'%(self.Nev/2.,self.Nev/2.),1,253)
+            pass
+        #Each channel starts from the same state whatever was fitted before,
+        #so that a run resumed from a checkpoint gives the same results
+        random = self.random
+        random.SetSeed(int(1 + 128*vfat + ch))
+        fitTF1 = self.fitTF1
+        for ipar in range(0,3):
+            fitTF1.SetParError(ipar, 0)
+            pass
+        for ipar in range(0,6):
+            self.scanFits[ipar][vfat][ch] = 0
+            pass
+        self.fitValid[vfat][ch] = False
+        fitOption = 'SQ'
+        startValue, startStep = 8, 8
+        goodChi2 = 50.
+        fixPedestal = False
+        if not self.scannedVCal[250:].any():
+            #Scan still being taken (see anaLiveScurve): the chi2 of a fit
+            #scales with the number of points fitted, i.e. those with hits,
+            #as for fitWindow below, and a partial scurve would otherwise
+            #pass the cut of the full range with any threshold
+            hist = self.scanHistos[vfat][ch]
+            nPoints = sum( 1 for ibin in range(1, 254) if hist.GetBinContent(ibin) > 0 )
+            goodChi2 = 50. * nPoints / 252.
+            pass
+        if self.fitWindow is not None:
+            xMin, xMax = self.transitionWindow(vfat, ch)
+            fitTF1.SetRange(xMin, xMax)
+            fitOption = 'SQR'
+            #The starting points are spread over the window
+            startValue, startStep = xMin, (xMax - xMin) / 15.
+            #Any pedestal below the window gives the same curve in it, but the
+            #scanned point without hits below the rise says there is none
+            fixPedestal = xMin > 1
+            #The errors of the bins are their contents, so the chi2 of a fit
+            #scales with the number of points: a flat fit through a window of
+            #a few points would otherwise pass the cut of the full range
+            goodChi2 = 50. * (xMax - xMin) / 252.
+            pass
+
+        fitChi2 = 0
+        MinChi2Temp = 99999999
+        stepN = 0
+        while(stepN < 15):
+            rand = random.Gaus(10, 5)
+            if (rand < 0.0 or rand > 100): continue
+            fitTF1.SetParameter(0, startValue+stepN*startStep)
+            fitTF1.SetParameter(1,rand)
+            fitTF1.SetParLimits(0, 0.01, 300.0)
+            fitTF1.SetParLimits(1, 0.0, 100.0)
+            if fixPedestal:
+                fitTF1.FixParameter(2, 0.0)
+                pass
+            else:
+                fitTF1.SetParameter(2,startValue+stepN*startStep)
+                fitTF1.SetParLimits(2, 0.0, 300.0)
+                pass
+            fitResult = self.scanHistos[vfat][ch].Fit('myERF',fitOption)
+            fitEmpty = fitResult.IsEmpty()
+            if fitEmpty:
+                # Don't try to fit empty data again
+                break
+            fitValid = fitResult.IsValid()
+            if not fitValid:
+                continue
+            fitChi2 = fitTF1.GetChisquare()
+            fitNDF = fitTF1.GetNDF()
+            stepN +=1
+            if (fitChi2 < MinChi2Temp and fitChi2 > 0.0):
+                self.scanFits[0][vfat][ch] = fitTF1.GetParameter(0)
+                self.scanFits[1][vfat][ch] = fitTF1.GetParameter(1)
+                self.scanFits[2][vfat][ch] = fitTF1.GetParameter(2)
+                self.scanFits[3][vfat][ch] = fitChi2
+                self.scanFits[4][vfat][ch] = self.scanCount[vfat][ch]
+                self.scanFits[5][vfat][ch] = fitNDF
+                self.fitValid[vfat][ch] = True
+                MinChi2Temp = fitChi2
+                pass
+            if (MinChi2Temp < goodChi2): break
+            pass
+        return
+
+    def transitionWindow(self, vfat, ch, low=0.1, high=0.9):
+        """Returns the VCal range of the fit of a channel with fitWindow: from
+        the first point above low of the plateau to the first point above high
+        of it after that, extended by fitWindow on each side. The range starts
+        at the last scanned point without hits below the rise at the latest,
+        so that the points of a pedestal constrain the pedestal parameter as
+        in the full range fit (points without hits are not fitted). The full
+        range 1-253 is returned for scurves without such a rise, or whose
+        first point above low is already above high."""
+        hist = self.scanHistos[vfat][ch]
+        contents = np.array([ hist.GetBinContent(ibin) for ibin in range(1, hist.GetNbinsX()+1) ])
+        rising = np.nonzero(contents > low * self.Nev)[0]
+        if len(rising) == 0:
+            return 1, 253
+        plateau = np.nonzero(contents[rising[0]:] >= high * self.Nev)[0]
+        if len(plateau) == 0 or plateau[0] == 0:
+            return 1, 253
+        #Bin i holds VCal i
+        first = hist.GetBinCenter(int(rising[0]) + 1)
+        last = hist.GetBinCenter(int(rising[0] + plateau[0]) + 1)
+        empty = np.nonzero(self.scannedVCal[1:rising[0]+1] & (contents[:rising[0]] == 0))[0]
+        start = hist.GetBinCenter(int(empty[-1]) + 1) if len(empty) else 1
+        return max(1, min(start, first - self.fitWindow)), min(253, last + self.fitWindow)
+
 def fitScanData(treeFileName):
     fitter = ScanDataFitter()
     fitter.readFile(treeFileName)
@@ -0,0 +1,162 @@
+"""
+Combines the fit results of many trim scans into one table of
+(scan, vfat, channel, strip, trimDAC, noise, threshold) and makes noise vs
+trimDAC trend plots and fits from it, without re-reading the ROOT files.
+
+Building or extending the table, one file at a time:
+
+    python macros/noise_vs_trim_table.py --build -i scan1/SCurveFitData.root,scan2/SCurveFitData.root --table=noiseTrim.npz
+
+Trend plots of some strips and linear fits of every channel:
+
+    python macros/noise_vs_trim_table.py --table=noiseTrim.npz --list=0:12,3:64
+    python macros/noise_vs_trim_table.py --table=noiseTrim.npz --fitAll=noiseTrimFits.npz
+"""
+
+import os
+import numpy as np
+from macros.plotoptions import parser, channelList
+
+parser.add_option("--table", type="string", dest="table", default="noiseTrimTable.npz",
+                  help="Table to build or read", metavar="table")
+parser.add_option("--build", action="store_true", dest="build",
+                  help="Add the comma separated fit files given with -i to the table", metavar="build")
+parser.add_option("--fitAll", type="string", dest="fitAll", default=None,
+                  help="Write the linear noise vs trimDAC fit of every channel to this .npz file", metavar="fitAll")
+
+tableType = np.dtype([
+    ('scan',        'i4'),
+    ('vfatN',       'i4'),
+    ('vfatCH',      'i4'),
+    ('ROBstr',      'i4'),
+    ('trimDAC',     'i4'),
+    ('noise',       'f4'),
+    ('threshold',   'f4')
+    ])
+
+def loadTable(filename):
+    """Returns the table and the list of fit files of its scans, scan n
+    coming from files[n]"""
+    if not os.path.isfile(filename):
+        return np.zeros(0, dtype=tableType), []
+    with np.load(filename) as inF:
+        return inF['table'], list(inF['files'])
+
+def saveTable(filename, table, files):
+    np.savez(filename, table=table, files=np.array(files))
+    return
+
+def readScans(fit_filename, firstScan):
+    """Returns the rows of the scans in fit_filename, numbered from
+    firstScan, and the number of scans it holds (several with hadd)"""
+    from anautilities import occurrenceIndex
+    from columnar import readColumns
+
+    fitData = readColumns(fit_filename, 'scurveFitTree', list(tableType.names[1:]))
+    key = fitData['vfatN'] * 128 + fitData['vfatCH']
+
+    #The n-th entry of a channel belongs to the n-th scan of the file
+    occurrence = occurrenceIndex(key)
+
+    rows = np.zeros(len(key), dtype=tableType)
+    for name in tableType.names[1:]:
+        rows[name] = fitData[name]
+        pass
+    rows['scan'] = firstScan + occurrence
+    nScans = occurrence.max() + 1 if len(key) else 0
+    return rows, nScans
+
+def buildTable(table, files, fit_filenames):
+    """Adds the scans of the fit files not yet in the table, reading one file
+    at a time and only the needed branches"""
+    chunks = [table]
+    for fit_filename in fit_filenames:
+        if os.path.abspath(fit_filename) in files:
+            print "%s is already in the table, skipping"%(fit_filename)
+            continue
+        rows, nScans = readScans(fit_filename, len(files))
+        chunks.append(rows)
+        files += [ os.path.abspath(fit_filename) ] * nScans
+        print "Added %i scans from %s"%(nScans, fit_filename)
+        pass
+    return np.concatenate(chunks), files
+
+def fitChannels(table):
+    """Least squares fit of noise = slope * trimDAC + intercept for every
+    (vfat, channel) of the table at once. Returns (24,128) arrays of the
+    slope, the intercept and the number of scans, NaN where there are fewer
+    than two distinct trimDAC values."""
+    code = table['vfatN'] * 128 + table['vfatCH']
+    sums = [ np.bincount(code, weights, minlength=24*128)
+             for weights in [None, table['trimDAC'], table['noise'],
+                             table['trimDAC'].astype(float)**2, table['trimDAC'] * table['noise'].astype(float)] ]
+    n, sx, sy, sxx, sxy = sums
+    with np.errstate(divide='ignore', invalid='ignore'):
+        denominator = n * sxx - sx**2
+        slope = np.where(denominator > 0, (n * sxy - sx * sy) / denominator, np.nan)
+        intercept = (sy - slope * sx) / n
+        pass
+    return slope.reshape(24,128), intercept.reshape(24,128), n.reshape(24,128).astype(int)
+
+def plotTrends(table, channels, byChannel):
+    """Draws noise vs trimDAC over the scans of the table for each (vfat,
+    strip or channel) in channels, with its linear fit"""
+    import ROOT as r
+    r.gROOT.SetBatch(True)
+
+    key = 'vfatCH' if byChannel else 'ROBstr'
+    label = 'Channel' if byChannel else 'Strip'
+    canvas = r.TCanvas('canvas', 'canvas', 500, 500)
+    r.gStyle.SetOptStat(0)
+    r.gStyle.SetOptFit(1)
+    for VFAT, STRIP in channels:
+        rows = table[(table['vfatN'] == VFAT) & (table[key] == STRIP)]
+        if len(rows) == 0:
+            print "No scans found for VFAT %i %s %i"%(VFAT, label, STRIP)
+            continue
+        trend = r.TGraph(len(rows), rows['trimDAC'].astype('f8'), rows['noise'].astype('f8'))
+        trend.SetTitle('Noise vs trim for VFAT %i %s %i over %i scans; trimDAC [DAC units]; Noise [DAC units]'%(VFAT, label, STRIP, len(rows)))
+        trend.SetMarkerStyle(20)
+        trend.Draw('AP')
+        if len(np.unique(rows['trimDAC'])) > 1:
+            trend.Fit('pol1', 'Q')
+            pass
+        canvas.Update()
+        canvas.SaveAs('Noise_Trim_Trend_VFAT_%i_%s_%i.png'%(VFAT, label, STRIP))
+        pass
+    return
+
+if __name__ == '__main__':
+    (options, args) = parser.parse_args()
+
+    from anautilities import StageTimer
+    timer = StageTimer(options.timing)
+    timer.start('read')
+    table, files = loadTable(options.table)
+    if options.build:
+        nRows = len(table)
+        table, files = buildTable(table, files, options.filename.split(','))
+        timer.count(len(table) - nRows)
+        saveTable(options.table, table, files)
+        print "%s: %i rows from %i scans"%(options.table, len(table), len(files))
+        pass
+    if options.fitAll is not None:
+        timer.start('fit')
+        timer.count(len(table))
+        slope, intercept, nScans = fitChannels(table)
+        np.savez(options.fitAll, slope=slope, intercept=intercept, nScans=nScans)
+        print "Median slope %f, median intercept %f [DAC units]"%(np.nanmedian(slope), np.nanmedian(intercept))
+        pass
+    if options.channelList is not None or options.vfat is not None:
+        timer.start('render')
+        if options.channelList is None and options.strip is None:
+            #Every strip of the VFAT
+            channels = [ (options.vfat, strip) for strip in range(0,128) ]
+            pass
+        else:
+            channels = channelList(options)
+            pass
+        plotTrends(table, channels, options.channels)
+        pass
+    timer.dump()
+    pass
@@ -1,31 +1,49 @@
-def overlay_fit(VFAT, CH, data_filename, fit_filename):
+def overlay_fits(channels, data_filename, fit_filename):
+    """Overlays the fit on the scurve of each (VFAT, CH) in channels, reading
+    only the entries of these channels"""
     import ROOT as r
+    from treeindex import TreeIndex, iterIndexed
 
     inF     = r.TFile(data_filename)
-    fitF   = r.TFile(fit_filename)
-    Scurve = r.TH1D('Scurve','Scurve for VFAT %i channel %i;VCal [DAC units]'%(VFAT, CH),255,-0.5,254.5)
+    fitF    = r.TFile(fit_filename)
+    Scurves = [ r.TH1D('Scurve_%i_%i'%(VFAT, CH),'Scurve for VFAT %i channel %i;VCal [DAC units]'%(VFAT, CH),255,-0.5,254.5)
+                for VFAT, CH in channels ]
 
-    for event in inF.scurveTree:
-        if (event.vfatN == VFAT) and (event.vfatCH == CH):
-            Scurve.Fill(event.vcal, event.Nhits)
-            pass
+    dataIndex = TreeIndex(data_filename, "scurveTree")
+    for idx, event in iterIndexed(inF.scurveTree, dataIndex, channels):
+        Scurves[idx].Fill(event.vcal, event.Nhits)
         pass
-    for event in fitF.scurveFitTree:
-        if (event.vfatN == VFAT) and (event.vfatCH == CH):
-            param0 = event.threshold
-            param1 = event.noise
-            param2 = event.pedestal
-            pass
+
+    #With several scans in the fit file the last one is used
+    params = [ None for channel in channels ]
+    fitTree = fitF.scurveFitTree
+    fitTree.SetBranchStatus('*', 0)
+    for branch in ['vfatN', 'vfatCH', 'threshold', 'noise', 'pedestal']:
+        fitTree.SetBranchStatus(branch, 1)
+        pass
+    fitIndex = TreeIndex(fit_filename, "scurveFitTree")
+    for idx, event in iterIndexed(fitTree, fitIndex, channels):
+        params[idx] = (event.threshold, event.noise, event.pedestal)
         pass
+
     fitTF1 =  r.TF1('myERF','500*TMath::Erf((TMath::Max([2],x)-[0])/(TMath::Sqrt(2)*[1]))+500',1,253)
-    fitTF1.SetParameter(0, param0)
-    fitTF1.SetParameter(1, param1)
-    fitTF1.SetParameter(2, param2)
     canvas = r.TCanvas('canvas', 'canvas', 500, 500)
-    Scurve.Draw()
-    fitTF1.Draw('SAME')
-    canvas.Update()
-    canvas.SaveAs('Fit_Overlay_VFAT%i_Channel%i.png'%(VFAT, CH))
-    Chi2 = fitTF1.GetChisquare()
-    print Chi2
+    for (VFAT, CH), Scurve, param in zip(channels, Scurves, params):
+        if param is None:
+            print "No fit found for VFAT %i channel %i"%(VFAT, CH)
+            continue
+        for ipar, value in enumerate(param):
+            fitTF1.SetParameter(ipar, value)
+            pass
+        Scurve.Draw()
+        fitTF1.Draw('SAME')
+        canvas.Update()
+        canvas.SaveAs('Fit_Overlay_VFAT%i_Channel%i.png'%(VFAT, CH))
+        Chi2 = fitTF1.GetChisquare()
+        print Chi2
+        pass
+    return
+
+def overlay_fit(VFAT, CH, data_filename, fit_filename):
+    overlay_fits([(VFAT, CH)], data_filename, fit_filename)
     return
@@ -1,33 +1,64 @@
-from macros.plotoptions import parser
+from macros.plotoptions import parser, channelList
 
 (options, args) = parser.parse_args()
 
-def plot_vfat_summary(VFAT, STRIP, fit_filename):
+from anautilities import StageTimer
+timer = StageTimer(options.timing)
+
+def plot_vfat_summaries(channels, fit_filename):
+    """Plots noise vs trimDAC over the scans of the fit file for each
+    (VFAT, STRIP) in channels, in a single pass over the file"""
     import ROOT as r
+    from treeindex import TreeIndex, iterIndexed
 
-    fitF = r.TFile(fit_filename)
+    timer.start('read')
     if options.channels:
-        vNoise = r.TH2D('vNoise', 'Noise vs trim for VFAT %i Channel %i; trimDAC [DAC units]; Noise [DAC units]'%(VFAT, STRIP), 32, -0.5, 31.5, 60, -0.5, 59.5)
+        index = TreeIndex(fit_filename, 'scurveFitTree', 'vfatCH')
         pass
     else:
-        vNoise = r.TH2D('vNoise', 'Noise vs trim for VFAT %i Strip %i; trimDAC [DAC units]; Noise [DAC units]'%(VFAT, STRIP), 32, -0.5, 31.5, 60, -0.5, 59.5)
+        index = TreeIndex(fit_filename, 'scurveFitTree', 'ROBstr')
         pass
-    vNoise.GetYaxis().SetTitleOffset(1.5)
-    for event in fitF.scurveFitTree:
-        if (event.vfatN == VFAT) and ((event.vfatstrip == STRIP and not options.channels) or (event.vfatCH == STRIP and options.channels)):
-            vNoise.Fill(event.trimDAC, event.noise)
+    vNoises = []
+    for VFAT, STRIP in channels:
+        if options.channels:
+            vNoise = r.TH2D('vNoise_%i_%i'%(VFAT, STRIP), 'Noise vs trim for VFAT %i Channel %i; trimDAC [DAC units]; Noise [DAC units]'%(VFAT, STRIP), 32, -0.5, 31.5, 60, -0.5, 59.5)
             pass
+        else:
+            vNoise = r.TH2D('vNoise_%i_%i'%(VFAT, STRIP), 'Noise vs trim for VFAT %i Strip %i; trimDAC [DAC units]; Noise [DAC units]'%(VFAT, STRIP), 32, -0.5, 31.5, 60, -0.5, 59.5)
+            pass
+        vNoise.GetYaxis().SetTitleOffset(1.5)
+        vNoises.append(vNoise)
         pass
+
+    #One entry per scan in the file
+    fitF = r.TFile(fit_filename)
+    fitTree = fitF.scurveFitTree
+    fitTree.SetBranchStatus('*', 0)
+    for branch in ['vfatN', 'vfatCH', 'ROBstr', 'trimDAC', 'noise']:
+        fitTree.SetBranchStatus(branch, 1)
+        pass
+    for idx, event in timer.counted(iterIndexed(fitTree, index, channels)):
+        vNoises[idx].Fill(event.trimDAC, event.noise)
+        pass
+
+    timer.start('render')
     canvas = r.TCanvas('canvas', 'canvas', 500, 500)
     r.gStyle.SetOptStat(0)
-    vNoise.Draw('colz')
-    canvas.Update()
-    if options.channels:
-        canvas.SaveAs('Noise_Trim_VFAT_%i_Channel_%i.png'%(VFAT, STRIP))
-        pass
-    else:
-        canvas.SaveAs('Noise_Trim_VFAT_%i_Strip_%i.png'%(VFAT, STRIP))
+    for (VFAT, STRIP), vNoise in zip(channels, vNoises):
+        vNoise.Draw('colz')
+        canvas.Update()
+        if options.channels:
+            canvas.SaveAs('Noise_Trim_VFAT_%i_Channel_%i.png'%(VFAT, STRIP))
+            pass
+        else:
+            canvas.SaveAs('Noise_Trim_VFAT_%i_Strip_%i.png'%(VFAT, STRIP))
+            pass
         pass
     return
 
-plot_vfat_summary(options.vfat, options.strip, options.filename)
+def plot_vfat_summary(VFAT, STRIP, fit_filename):
+    plot_vfat_summaries([(VFAT, STRIP)], fit_filename)
+    return
+
+plot_vfat_summaries(channelList(options), options.filename)
+timer.dump()
@@ -1,4 +1,4 @@
-from macros.plotoptions import parser
+from macros.plotoptions import parser, channelList
 
 parser.add_option("-o","--overlay", action="store_true", dest="overlay_fit",
                   help="Make overlay of fit result on scurve", metavar="overlay_fit")
@@ -8,49 +8,74 @@ parser.add_option("-o","--overlay", action="store_true", dest="overlay_fit",
 filename = options.filename
 overlay_fit = options.overlay_fit
 channel_yes = options.channels
-vfat = options.vfat
-strip = options.strip
+if options.channelList is None and options.strip is None:
+    #Every strip of the VFAT
+    channels = [ (options.vfat, strip) for strip in range(0,128) ]
+    pass
+else:
+    channels = channelList(options)
+    pass
 
 import ROOT as r
+from collections import OrderedDict
+from treeindex import TreeIndex, iterIndexed
+from anautilities import StageTimer
 r.gStyle.SetOptStat(0)
 
-thr     = []
-Scurves = []
+timer = StageTimer(options.timing)
+timer.start('read')
 fitF = r.TFile(filename)
-for event in fitF.scurveFitTree:
-    if (event.vthr) not in thr:
-        thr.append(event.vthr)
-        pass
+fitTree = fitF.scurveFitTree
+fitTree.SetBranchStatus('*', 0)
+for branch in ['vfatN', 'vfatCH', 'ROBstr', 'vthr', 'scurve_h*']:
+    fitTree.SetBranchStatus(branch, 1)
+    pass
+if channel_yes:
+    index = TreeIndex(filename, 'scurveFitTree', 'vfatCH')
+    pass
+else:
+    index = TreeIndex(filename, 'scurveFitTree', 'ROBstr')
     pass
-print thr
 
+#Scurves of each channel grouped by vthr, in one pass over the entries of the channels
+Scurves = [ OrderedDict() for channel in channels ]
+for idx, event in timer.counted(iterIndexed(fitTree, index, channels)):
+    hist = event.scurve_h.Clone('Scurve_%i_%i_%i'%(channels[idx] + (event.vthr, )))
+    hist.SetDirectory(0)
+    Scurves[idx].setdefault(event.vthr, []).append(hist)
+    pass
+
+timer.start('render')
 canvas = r.TCanvas('canvas', 'canvas', 500, 500)
 canvas.cd()
-i = 0
-for thresh in thr:
-    for event in fitF.scurveFitTree:
-        if (event.vthr == thresh) and (event.vfatN == vfat) and (event.vfatstrip == strip):
-            Scurves.append((event.scurve_h).Clone())
+for (vfat, strip), byThresh in zip(channels, Scurves):
+    if not byThresh:
+        print "No scurve found for VFAT %i %s %i"%(vfat, 'channel' if channel_yes else 'strip', strip)
+        continue
+    print byThresh.keys()
+    leg = r.TLegend(0.1, 0.6, 0.3, 0.8)
+    i = 0
+    for thresh, hists in byThresh.iteritems():
+        for hist in hists:
+            hist.SetTitle("")
+            hist.SetLineColor((i%9) + 1)
+            if i == 0:
+                hist.Draw()
+                pass
+            else:
+                hist.Draw('SAME')
+                pass
+            i+=1
+            leg.AddEntry(hist, "Scurve for vthr%i"%thresh)
             pass
         pass
-    pass
-
-leg = r.TLegend(0.1, 0.6, 0.3, 0.8)
-
-for hist in Scurves:
-    hist.SetTitle("")
-    hist.SetLineColor((i%9) + 1)
-    if i == 0:
-        hist.Draw()
-        hist.Set
-        i+=1
+    leg.Draw('SAME')
+    canvas.Update()
+    if channel_yes:
+        canvas.SaveAs('Scurve_vs_Thresh_VFAT_%i_Channel_%i.png'%(vfat, strip))
         pass
     else:
-        hist.Draw('SAME')
-        i+=1
+        canvas.SaveAs('Scurve_vs_Thresh_VFAT_%i_Strip_%i.png'%(vfat, strip))
         pass
-    leg.AddEntry(hist, "Scurve for vthr%i"%thr[i-1])
     pass
-leg.Draw('SAME')
-canvas.Update()
-canvas.SaveAs('Scurve_vs_Thresh_VFAT_%i_Strip_%i.png'%(vfat, strip))
+timer.dump()
@@ -1,4 +1,4 @@
-from macros.plotoptions import parser
+from macros.plotoptions import parser, channelList
 
 parser.add_option("-o","--overlay", action="store_true", dest="overlay_fit",
                   help="Make overlay of fit result on scurve", metavar="overlay_fit")
@@ -8,53 +8,74 @@ parser.add_option("-o","--overlay", action="store_true", dest="overlay_fit",
 filename = options.filename
 overlay_fit = options.overlay_fit
 channel_yes = options.channels
-vfat  = options.vfat
-strip = options.strip
 
-def plot_scurve(VFAT, CH, fit_filename, overlay_fit, channel_yes, nInjections=500):
+from anautilities import StageTimer
+timer = StageTimer(options.timing)
+
+def plot_scurves(channels, fit_filename, overlay_fit, channel_yes, nInjections=500):
+    """Plots the scurve of each (VFAT, CH) in channels, CH being a channel
+    if channel_yes and a strip otherwise, in a single pass over the file"""
     import ROOT as r
+    from treeindex import TreeIndex, iterIndexed
+
+    timer.start('read')
     fitF = r.TFile(fit_filename)
-    Scurve = TH1D()
-    for event in fitF.scurveFitTree:
-        if (event.vfatN == VFAT) and ((event.vfatCH == CH and channel_yes) or (event.vfatstrip == CH and not channel_yes)):
-            Scurve = ((fitF.scurveFitTree.scurve_h).Clone())
-            if overlay_fit:
-                param0 = event.threshold
-                param1 = event.noise
-                param2 = event.pedestal
-                pass
-            pass
+    if channel_yes:
+        index = TreeIndex(fit_filename, 'scurveFitTree', 'vfatCH')
         pass
-    if overlay_fit:
-        fitTF1 =  r.TF1('myERF','%i*TMath::Erf((TMath::Max([2],x)-[0])/(TMath::Sqrt(2)*[1]))+%i'%nInjections,1,253)
-        fitTF1.SetParameter(0, param0)
-        fitTF1.SetParameter(1, param1)
-        fitTF1.SetParameter(2, param2)
+    else:
+        index = TreeIndex(fit_filename, 'scurveFitTree', 'ROBstr')
         pass
-    canvas = r.TCanvas('canvas', 'canvas', 500, 500)
-    r.gStyle.SetOptStat(0)
-    Scurve.Draw()
-    if overlay_fit:
-        fitTF1.Draw('SAME')
+    #With several scans in the fit file the last one is used
+    Scurves = [ None for channel in channels ]
+    params = [ None for channel in channels ]
+    for idx, event in timer.counted(iterIndexed(fitF.scurveFitTree, index, channels)):
+        Scurves[idx] = event.scurve_h.Clone('Scurve_%i_%i'%channels[idx])
+        Scurves[idx].SetDirectory(0)
+        params[idx] = (event.threshold, event.noise, event.pedestal)
         pass
-    canvas.Update()
+
+    timer.start('render')
     if overlay_fit:
-        r.gStyle.SetOptStat(111)
-        print param0, param1, param2
-        if channel_yes:
-            canvas.SaveAs('Fit_Overlay_VFAT%i_Channel%i.png'%(VFAT, CH))
-            pass
-        else:
-            canvas.SaveAs('Fit_Overlay_VFAT%i_Strip%i.png'%(VFAT, CH))
-            pass
-    else:
-        if channel_yes:
-            canvas.SaveAs('Scurve_VFAT%i_Channel%i.png'%(VFAT, CH))
+        fitTF1 =  r.TF1('myERF','%i*TMath::Erf((TMath::Max([2],x)-[0])/(TMath::Sqrt(2)*[1]))+%i'%(nInjections,nInjections),1,253)
+        pass
+    canvas = r.TCanvas('canvas', 'canvas', 500, 500)
+    for (VFAT, CH), Scurve, param in zip(channels, Scurves, params):
+        if Scurve is None:
+            print "No scurve found for VFAT %i %s %i"%(VFAT, 'channel' if channel_yes else 'strip', CH)
+            continue
+        r.gStyle.SetOptStat(0)
+        Scurve.Draw()
+        if overlay_fit:
+            for ipar, value in enumerate(param):
+                fitTF1.SetParameter(ipar, value)
+                pass
+            fitTF1.Draw('SAME')
             pass
+        canvas.Update()
+        if overlay_fit:
+            r.gStyle.SetOptStat(111)
+            print param[0], param[1], param[2]
+            if channel_yes:
+                canvas.SaveAs('Fit_Overlay_VFAT%i_Channel%i.png'%(VFAT, CH))
+                pass
+            else:
+                canvas.SaveAs('Fit_Overlay_VFAT%i_Strip%i.png'%(VFAT, CH))
+                pass
         else:
-            canvas.SaveAs('Scurve_VFAT%i_Strip%i.png'%(VFAT, CH))
+            if channel_yes:
+                canvas.SaveAs('Scurve_VFAT%i_Channel%i.png'%(VFAT, CH))
+                pass
+            else:
+                canvas.SaveAs('Scurve_VFAT%i_Strip%i.png'%(VFAT, CH))
+                pass
             pass
         pass
     return
 
-plot_scurve(vfat, strip, filename, overlay_fit, channel_yes)
+def plot_scurve(VFAT, CH, fit_filename, overlay_fit, channel_yes, nInjections=500):
+    plot_scurves([(VFAT, CH)], fit_filename, overlay_fit, channel_yes, nInjections)
+    return
+
+plot_scurves(channelList(options), filename, overlay_fit, channel_yes)
+timer.dump()
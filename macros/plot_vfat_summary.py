@@ -1,37 +1,73 @@
 from macros.plotoptions import parser
 
+parser.add_option("-a","--allVFATs", action="store_true", dest="allVFATs",
+                  help="Make the summary of all 24 VFATs from a single read of the file", metavar="allVFATs")
+
 (options, args) = parser.parse_args()
 
-def plot_vfat_summary(VFAT, fit_filename):
+from anautilities import StageTimer
+timer = StageTimer(options.timing)
+
+def vfat_summary_arrays(vfats, fit_filename):
+    """Returns the scurves of the VFATs as a (len(vfats), 128, 256) array
+    indexed by (vfat, strip or channel, VCal), summed over the scans"""
     import ROOT as r
-    fitF = r.TFile(fit_filename)
-    Scurve = r.TH1D()
+    import numpy as np
+    import root_numpy as rp
+    from treeindex import TreeIndex, iterIndexed
+
+    timer.start('read')
     if options.channels:
-        vSum = r.TH2D('vSum', 'vSum for VFAT %i; Channels; VCal [DAC units]'%VFAT, 128, -0.5, 127.5, 256, -0.5, 255.5)
+        index = TreeIndex(fit_filename, 'scurveFitTree', 'vfatCH')
         pass
     else:
-        vSum = Tr.H2D('vSum', 'vSum for VFAT %i; Strips; VCal [DAC units]'%VFAT, 128, -0.5, 127.5, 256, -0.5, 255.5)
+        index = TreeIndex(fit_filename, 'scurveFitTree', 'ROBstr')
         pass
-    vSum.GetYaxis().SetTitleOffset(1.5)
-    for event in fitF.scurveFitTree:
-        if (event.vfatN == VFAT):
-            Scurve = ((event.scurve_h).Clone())
-            for x in range(0, 256):
-                y = Scurve.FindBin(x)
-                if options.channels:
-                    vSum.Fill(event.vfatCH, x, Scurve.GetBinContent(y))
-                    pass
-                else:
-                    vSum.Fill(event.vfatstrip, x, Scurve.GetBinContent(y))
-                    pass
-                pass
+    fitF = r.TFile(fit_filename)
+    summary = np.zeros((len(vfats), 128, 256))
+    pairs = [ (vfat, strip) for vfat in vfats for strip in range(0,128) ]
+    vcalBins = None
+    for idx, event in timer.counted(iterIndexed(fitF.scurveFitTree, index, pairs)):
+        if vcalBins is None:
+            #Bin of the scurve holding each VCal value, the same for every channel
+            vcalBins = np.array([ event.scurve_h.FindBin(x) for x in range(0, 256) ])
             pass
+        contents = rp.hist2array(event.scurve_h, include_overflow=True)
+        summary[divmod(idx, 128)] += contents[vcalBins]
         pass
+    return summary
+
+def plot_vfat_summaries(vfats, fit_filename):
+    import ROOT as r
+    import root_numpy as rp
+
+    summary = vfat_summary_arrays(vfats, fit_filename)
+    timer.start('render')
     canvas = r.TCanvas('canvas', 'canvas', 500, 500)
     r.gStyle.SetOptStat(0)
-    vSum.Draw('colz')
-    canvas.Update()
-    canvas.SaveAs('Summary_VFAT_%i.png'%VFAT)
+    for VFAT, vfatSummary in zip(vfats, summary):
+        if options.channels:
+            vSum = r.TH2D('vSum%i'%VFAT, 'vSum for VFAT %i; Channels; VCal [DAC units]'%VFAT, 128, -0.5, 127.5, 256, -0.5, 255.5)
+            pass
+        else:
+            vSum = r.TH2D('vSum%i'%VFAT, 'vSum for VFAT %i; Strips; VCal [DAC units]'%VFAT, 128, -0.5, 127.5, 256, -0.5, 255.5)
+            pass
+        vSum.GetYaxis().SetTitleOffset(1.5)
+        rp.array2hist(vfatSummary, vSum)
+        vSum.Draw('colz')
+        canvas.Update()
+        canvas.SaveAs('Summary_VFAT_%i.png'%VFAT)
+        pass
+    return
+
+def plot_vfat_summary(VFAT, fit_filename):
+    plot_vfat_summaries([VFAT], fit_filename)
     return
 
-plot_vfat_summary(options.vfat, options.filename)
+if options.allVFATs:
+    plot_vfat_summaries(range(0,24), options.filename)
+    pass
+else:
+    plot_vfat_summary(options.vfat, options.filename)
+    pass
+timer.dump()
@@ -9,3 +9,13 @@ parser.add_option("-s", "--strip", type="int", dest="strip",
                   help="Specify strip or channel to plot", metavar="strip")
 parser.add_option("-v", "--vfat", type="int", dest="vfat",
                   help="Specify VFAT to plot", metavar="vfat")
+parser.add_option("--timing", type="string", dest="timing", default=None,
+                  help="Write the wall/CPU time, entries and memory of each stage as JSON to this file (default is $GEM_ANA_STAGE_TIMING)", metavar="timing")
+parser.add_option("--list", type="string", dest="channelList",
+                  help="Comma separated list of vfat:strip (or vfat:channel) pairs to plot in one pass, e.g. 0:12,3:64", metavar="channelList")
+
+def channelList(options):
+    """Returns the (vfat, strip) pairs to plot, from --list or else from --vfat and --strip"""
+    if options.channelList is None:
+        return [(options.vfat, options.strip)]
+    return [ tuple(int(value) for value in pair.split(':')) for pair in options.channelList.split(',') ]
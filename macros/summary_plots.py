@@ -1,5 +1,4 @@
 import os
-from gempython.utils.nesteddict import nesteddict as ndict
 from macros.plotoptions import parser
 
 parser.add_option("-a","--all", action="store_true", dest="all_plots",
@@ -8,113 +7,119 @@ parser.add_option("-f","--fit", action="store_true", dest="fit_plots",
                   help="Make fit parameter plots", metavar="fit_plots")
 parser.add_option("-x","--chi2", action="store_true", dest="chi2_plots",
                   help="Make Chi2 plots", metavar="chi2_plots")
+parser.add_option("-n","--nprocs", type="int", dest="nprocs", default=6,
+                  help="Number of processes rendering the canvases, 1 renders them in this process", metavar="nprocs")
 
 (options, args) = parser.parse_args()
-filename = options.filename[:-5]
+#Several fit files may be given as a comma separated list
+filenames = [ name[:-5] for name in options.filename.split(',') ]
 
 import ROOT as r
+import numpy as np
+import root_numpy as rp
+from columnar import readColumns
+from anautilities import StageTimer
 
 r.gROOT.SetBatch(True)
-inF = r.TFile(filename+'.root')
+#Histograms of different files share their names
+r.TH1.AddDirectory(False)
 
-vSum   = ndict()
-vNoise = ndict()
-vThreshold = ndict()
-vChi2      = ndict()
-vComparison = ndict()
-vNoiseTrim  = ndict()
-vPedestal   = ndict()
+fitBranches = ['vfatN','threshold','noise','pedestal','chi2','trimDAC']
 
-for vfat in range(0,24):
-    vNoise[vfat] = r.TH1D('Noise%i'%vfat,'Noise%i;Noise [DAC units]'%vfat,35,-0.5,34.5)
-    vPedestal[vfat] = r.TH1D('Pedestal%i'%vfat,'Pedestal%i;Pedestal [DAC units]'%vfat,256,-0.5,255.5)
-    vThreshold[vfat] = r.TH1D('Threshold%i'%vfat,'Threshold%i;Threshold [DAC units]'%vfat,60,-0.5,299.5)
-    vChi2[vfat] = r.TH1D('ChiSquared%i'%vfat,'ChiSquared%i;Chi2'%vfat,100,-0.5,999.5)
-    vComparison[vfat] = r.TH2D('vComparison%i'%vfat,'Fit Summary %i;Threshold [DAC units];Noise [DAC units]'%vfat,60,-0.5,299.5,70,-0.5,34.5)
-    vNoiseTrim[vfat] = r.TH2D('vNoiseTrim%i'%vfat,'Noise vs. Trim Summary %i;Trim [DAC units];Noise [DAC units]'%vfat,32,-0.5,31.5,70,-0.5,34.5)
-    vComparison[vfat].GetYaxis().SetTitleOffset(1.5)
-    vNoiseTrim[vfat].GetYaxis().SetTitleOffset(1.5)
-    pass
-
-for event in inF.scurveFitTree:
-    strip = event.ROBstr
-    param0 = event.threshold
-    param1 = event.noise
-    param2 = event.pedestal
-    vThreshold[event.vfatN].Fill(param0)
-    vNoise[event.vfatN].Fill(param1)
-    vPedestal[event.vfatN].Fill(param2)
-    vChi2[event.vfatN].Fill(event.chi2)
-    vComparison[event.vfatN].Fill(param0, param1)
-    vNoiseTrim[event.vfatN].Fill(event.trimDAC, param1)
-    pass
+def fitSummaryHistograms(fit_filename):
+    """Returns the per-VFAT histograms of the fit results in fit_filename,
+    read in bulk from the fit branches or their columns (scurve_h is
+    never read)"""
+    fitData = readColumns(fit_filename, 'scurveFitTree', fitBranches)
+    timer.count(len(fitData['vfatN']))
 
-if options.fit_plots or options.all_plots:
-    r.gStyle.SetOptStat(111100)
-    canv_comp = r.TCanvas('canv_comp','canv_comp',500*8,500*3)
-    canv_comp.Divide(8,3)
+    hists = dict( (family, []) for family in ['vNoise','vPedestal','vThreshold','vChi2','vComparison','vNoiseTrim'] )
     for vfat in range(0,24):
-        canv_comp.cd(vfat+1)
-        r.gStyle.SetOptStat(111100)
-        vComparison[vfat].Draw('colz')
-        canv_comp.Update()
-        pass
-    canv_comp.SaveAs(filename+'_FitSummary.png')
+        isVFAT = fitData['vfatN'] == vfat
+        vfatData = dict( (branch, column[isVFAT]) for branch, column in fitData.iteritems() )
 
-    r.gStyle.SetOptStat(111100)
-    canv_trim = r.TCanvas('canv_trim','canv_trim',500*8,500*3)
-    canv_trim.Divide(8,3)
-    for vfat in range(0,24):
-        canv_trim.cd(vfat+1)
-        r.gStyle.SetOptStat(111100)
-        vNoiseTrim[vfat].Draw('colz')
-        canv_trim.Update()
-        pass
-    canv_trim.SaveAs(filename+'_TrimNoiseSummary.png')
+        vNoise = r.TH1D('Noise%i'%vfat,'Noise%i;Noise [DAC units]'%vfat,35,-0.5,34.5)
+        vPedestal = r.TH1D('Pedestal%i'%vfat,'Pedestal%i;Pedestal [DAC units]'%vfat,256,-0.5,255.5)
+        vThreshold = r.TH1D('Threshold%i'%vfat,'Threshold%i;Threshold [DAC units]'%vfat,60,-0.5,299.5)
+        vChi2 = r.TH1D('ChiSquared%i'%vfat,'ChiSquared%i;Chi2'%vfat,100,-0.5,999.5)
+        vComparison = r.TH2D('vComparison%i'%vfat,'Fit Summary %i;Threshold [DAC units];Noise [DAC units]'%vfat,60,-0.5,299.5,70,-0.5,34.5)
+        vNoiseTrim = r.TH2D('vNoiseTrim%i'%vfat,'Noise vs. Trim Summary %i;Trim [DAC units];Noise [DAC units]'%vfat,32,-0.5,31.5,70,-0.5,34.5)
+        vComparison.GetYaxis().SetTitleOffset(1.5)
+        vNoiseTrim.GetYaxis().SetTitleOffset(1.5)
 
-    canv_thresh = r.TCanvas('canv_thresh','canv_thresh',500*8,500*3)
-    canv_thresh.Divide(8,3)
-    for vfat in range(0,24):
-        canv_thresh.cd(vfat+1)
-        r.gStyle.SetOptStat(111100)
-        vThreshold[vfat].Draw()
-        r.gPad.SetLogy()
-        canv_thresh.Update()
+        rp.fill_hist(vNoise, vfatData['noise'])
+        rp.fill_hist(vPedestal, vfatData['pedestal'])
+        rp.fill_hist(vThreshold, vfatData['threshold'])
+        rp.fill_hist(vChi2, vfatData['chi2'])
+        rp.fill_hist(vComparison, np.column_stack((vfatData['threshold'], vfatData['noise'])))
+        rp.fill_hist(vNoiseTrim, np.column_stack((vfatData['trimDAC'], vfatData['noise'])))
+
+        hists['vNoise'].append(vNoise)
+        hists['vPedestal'].append(vPedestal)
+        hists['vThreshold'].append(vThreshold)
+        hists['vChi2'].append(vChi2)
+        hists['vComparison'].append(vComparison)
+        hists['vNoiseTrim'].append(vNoiseTrim)
         pass
-    canv_thresh.SaveAs(filename+'_FitThreshSummary.png')
+    return hists
 
-    canv_Pedestal = r.TCanvas('canv_Pedestal','canv_Pedestal',500*8,500*3)
-    canv_Pedestal.Divide(8,3)
-    for vfat in range(0,24):
-        canv_Pedestal.cd(vfat+1)
-        r.gStyle.SetOptStat(111100)
-        vPedestal[vfat].Draw()
-        r.gPad.SetLogy()
-        canv_Pedestal.Update()
+#Canvases as (histogram family, output suffix, draw option, log y, stat option)
+canvasSpecs = []
+if options.fit_plots or options.all_plots:
+    canvasSpecs += [
+        ('vComparison', '_FitSummary.png', 'colz', False, 111100),
+        ('vNoiseTrim', '_TrimNoiseSummary.png', 'colz', False, 111100),
+        ('vThreshold', '_FitThreshSummary.png', '', True, 111100),
+        ('vPedestal', '_FitPedestalSummary.png', '', True, 111100),
+        ('vNoise', '_FitNoiseSummary.png', '', True, 111100)
+        ]
+    pass
+if options.chi2_plots or options.all_plots:
+    if options.fit_plots or options.all_plots:
+        canvasSpecs.append(('vChi2', '_FitChi2Summary.png', '', True, 111100))
         pass
-    canv_Pedestal.SaveAs(filename+'_FitPedestalSummary.png')
+    else:
+        canvasSpecs.append(('vChi2', '_FitChi2Summary.png', '', True, None))
+        pass
+    pass
 
-    canv_noise = r.TCanvas('canv_noise','canv_noise',500*8,500*3)
-    canv_noise.Divide(8,3)
+#Filled before the rendering processes are forked, which inherit them
+timer = StageTimer(options.timing)
+timer.start('read')
+histograms = dict( (filename, fitSummaryHistograms(filename+'.root')) for filename in filenames )
+
+def renderCanvas(job):
+    """Draws the 24 histograms of a family on one 8x3 canvas and saves it"""
+    filename, (family, suffix, drawOption, logy, optStat) = job
+    canv = r.TCanvas('canv_%s'%family,'canv_%s'%family,500*8,500*3)
+    canv.Divide(8,3)
     for vfat in range(0,24):
-        canv_noise.cd(vfat+1)
-        vNoise[vfat].Draw()
-        r.gPad.SetLogy()
-        canv_noise.Update()
+        canv.cd(vfat+1)
+        if optStat is not None:
+            r.gStyle.SetOptStat(optStat)
+            pass
+        histograms[filename][family][vfat].Draw(drawOption)
+        if logy:
+            r.gPad.SetLogy()
+            pass
+        canv.Update()
         pass
-    canv_noise.SetLogy()
-    canv_noise.SaveAs(filename+'_FitNoiseSummary.png')
+    canv.SaveAs(filename+suffix)
+    return
+
+timer.start('render')
+jobs = [ (filename, spec) for filename in filenames for spec in canvasSpecs ]
+timer.count(len(jobs))
+if options.nprocs > 1 and len(jobs) > 1:
+    from multiprocessing import Pool
+    pool = Pool(min(options.nprocs, len(jobs)))
+    pool.map(renderCanvas, jobs)
+    pool.close()
+    pool.join()
     pass
-if options.chi2_plots or options.all_plots:
-    canv_Chi2 = r.TCanvas('canv_Chi2','canv_Chi2',500*8,500*3)
-    canv_Chi2.Divide(8,3)
-    canv_Chi2.SetLogy()
-    for vfat in range(0,24):
-        canv_Chi2.cd(vfat+1)
-        vChi2[vfat].Draw()
-        r.gPad.SetLogy()
-        canv_Chi2.Update()
+else:
+    for job in jobs:
+        renderCanvas(job)
         pass
-    canv_Chi2.SetLogy()
-    canv_Chi2.SaveAs(filename+'_FitChi2Summary.png')
     pass
+timer.dump()
@@ -1,22 +1,56 @@
 #These are functions which provide the mappings between strips and channels in the V2b electronics
 #All directions are in the frame with the narrow end of the detector to the left
 # By: Cameron Bravo (c.bravo@cern.ch)
-from array import array
+import numpy as np
 
-def StripToPan(GEBtype,vfat,strip):
-    GEBslot = {}
-    ROBslot = {}
-    for slot in range(0,24):
-        ROBslot[slot] = 'left'
-        if(GEBtype == 'long' and (slot == 0 or slot == 1 or slot == 16 or slot == 17) ): ROBslot[slot] = 'right'
-        if(GEBtype == 'short' and (slot == 0 or slot == 1 or slot == 16 or slot == 17 or slot%8 == 4 or slot%8 == 6) ): ROBslot[slot] = 'right'
-        GEBslot[slot] = 'up'
-        if(vfat/8 == 2): GEBslot[slot] = 'down'
-    panPin = 0
-    if(ROBslot[vfat] == 'left'): panPin = (1 - strip/64)*(strip) + (strip/64)*(127 - strip%64)
-    else: panPin = (1 - strip/64)*(63 - strip) + (strip/64)*(strip)
+def isRightROBSlot(GEBtype, slot):
+    """Returns True if the readout board connector of slot is on the right"""
+    if(GEBtype == 'long' and (slot == 0 or slot == 1 or slot == 16 or slot == 17) ): return True
+    if(GEBtype == 'short' and (slot == 0 or slot == 1 or slot == 16 or slot == 17 or slot%8 == 4 or slot%8 == 6) ): return True
+    return False
+
+def buildStripToPanTable(GEBtype):
+    """Returns the (vfat, strip) -> Panasonic pin table of GEBtype"""
+    strip = np.arange(128)
+    leftPan = np.where(strip < 64, strip, 127 - strip%64)
+    rightPan = np.where(strip < 64, 63 - strip, strip)
+
+    table = np.empty((24,128), dtype=int)
+    for vfat in range(0,24):
+        if isRightROBSlot(GEBtype, vfat): table[vfat] = rightPan
+        else: table[vfat] = leftPan
+    return table
+
+def invertTable(table):
+    """Returns the inverse of a (vfat, x) -> y table, i.e. (vfat, y) -> x"""
+    inverse = np.empty_like(table)
+    inverse[np.arange(len(table)).reshape(-1,1), table] = np.arange(table.shape[1])
+    return inverse
 
-    return panPin
+#Tables are built once per GEB type, see getStripToPanTable
+stripToPanTables = {}
+panToStripTables = {}
 
+def getStripToPanTable(GEBtype):
+    if GEBtype not in stripToPanTables:
+        stripToPanTables[GEBtype] = buildStripToPanTable(GEBtype)
+        panToStripTables[GEBtype] = invertTable(stripToPanTables[GEBtype])
+    return stripToPanTables[GEBtype]
 
+def getPanToStripTable(GEBtype):
+    getStripToPanTable(GEBtype)
+    return panToStripTables[GEBtype]
+
+def lookup(table, vfat, index):
+    """Returns table[vfat, index], as an int for scalar arguments. vfat and
+    index may also be NumPy arrays, which are broadcast against each other."""
+    result = table[vfat, index]
+    if np.ndim(result) == 0:
+        return int(result)
+    return result
+
+def StripToPan(GEBtype,vfat,strip):
+    return lookup(getStripToPanTable(GEBtype), vfat, strip)
 
+def PanToStrip(GEBtype,vfat,panPin):
+    return lookup(getPanToStripTable(GEBtype), vfat, panPin)
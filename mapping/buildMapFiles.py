@@ -1,4 +1,5 @@
 import os
+import numpy as np
 from mapping.channelMaps import *
 from mapping.PanChannelMaps import *
 
@@ -8,15 +9,14 @@ envCheck('GEM_PLOTTING_PROJECT')
 mapPath  = "%s/mapping"%(os.getenv('GEM_PLOTTING_PROJECT'))
 
 chamberType = ['long','short']
+vfat, strip = np.indices((24,128))
 for cT in chamberType:
-    outF = open('%s/%sChannelMap.txt'%(mapPath,cT),'w')
-    outF.write('vfat/I:strip/I:channel/I:PanPin/I\n')
-    for vfat in range(0,24):
-        for strip in range(0,128):
-            channel = stripToChannel(cT,vfat,strip)
-            panpin = StripToPan(cT, vfat, strip)
-            outF.write('%i\t%i\t%i\t%i\n'%(vfat,strip,channel+1,panpin))
-            pass
-        pass
-    outF.close()
+    #One row per (vfat, strip), in vfat then strip order
+    columns = [vfat, strip, getStripToChannelTable(cT) + 1, getStripToPanTable(cT)]
+    rows = np.column_stack([ column.ravel() for column in columns ])
+    np.savetxt('%s/%sChannelMap.txt'%(mapPath,cT), rows, fmt='%i', delimiter='\t',
+               header='vfat/I:strip/I:channel/I:PanPin/I', comments='')
     pass
+
+from mapping.mapFiles import writeBinaryMap
+writeBinaryMap(mapPath, chamberType)
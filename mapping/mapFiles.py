@@ -0,0 +1,97 @@
+#Reading and writing of the channel map files made by buildMapFiles.py
+#The binary map holds, for each GEB type, (vfat, channel) -> strip/PanPin and
+#(vfat, strip) -> channel arrays, together with a checksum of the code that
+#generated them. It is used whenever it matches the current code, otherwise
+#the text maps are parsed.
+import hashlib
+import os
+import numpy as np
+
+mapSources = ['channelMaps.py', 'PanChannelMaps.py', 'mapFiles.py']
+
+def mapSourceChecksum():
+    """Returns the sha1 of the code the maps are generated from"""
+    sha1 = hashlib.sha1()
+    mapDir = os.path.dirname(os.path.abspath(__file__))
+    for source in mapSources:
+        with open(os.path.join(mapDir, source), 'rb') as sourceFile:
+            sha1.update(sourceFile.read())
+            pass
+        pass
+    return sha1.hexdigest()
+
+def defaultMapPath():
+    return "%s/mapping"%(os.getenv('GEM_PLOTTING_PROJECT'))
+
+def mapArrays(stripToChan, stripToPan):
+    """Returns the dictionary of lookup arrays from the (vfat, strip) ->
+    channel and (vfat, strip) -> PanPin tables"""
+    vfat, strip = np.indices(stripToChan.shape)
+    chanToStrip = np.empty_like(stripToChan)
+    chanToStrip[vfat, stripToChan] = strip
+    chanToPanPin = np.empty_like(stripToPan)
+    chanToPanPin[vfat, stripToChan] = stripToPan
+    panPinToChan = np.empty_like(stripToChan)
+    panPinToChan[vfat, stripToPan] = stripToChan
+    return {
+        'chanToStrip':chanToStrip,
+        'chanToPanPin':chanToPanPin,
+        'stripToChan':stripToChan,
+        'panPinToChan':panPinToChan
+        }
+
+def writeBinaryMap(mapPath, GEBtypes=('long','short')):
+    """Writes the binary map of GEBtypes to mapPath/channelMap.npz"""
+    from mapping.channelMaps import getStripToChannelTable
+    from mapping.PanChannelMaps import getStripToPanTable
+
+    arrays = {'checksum':np.array(mapSourceChecksum())}
+    for GEBtype in GEBtypes:
+        tables = mapArrays(getStripToChannelTable(GEBtype), getStripToPanTable(GEBtype))
+        for name, table in tables.iteritems():
+            arrays['%s_%s'%(GEBtype, name)] = table.astype('i4')
+            pass
+        pass
+    np.savez('%s/channelMap.npz'%(mapPath), **arrays)
+    return
+
+def readBinaryMap(GEBtype, mapPath):
+    """Returns the lookup arrays of GEBtype from the binary map, or None if it
+    is missing, stale or does not hold GEBtype"""
+    filename = '%s/channelMap.npz'%(mapPath)
+    if not os.path.isfile(filename):
+        return None
+    with np.load(filename) as arrays:
+        if str(arrays['checksum']) != mapSourceChecksum():
+            print "Binary channel map %s is out of date, please rerun buildMapFiles.py"%(filename)
+            return None
+        names = [ '%s_%s'%(GEBtype, name) for name in ['chanToStrip','chanToPanPin','stripToChan','panPinToChan'] ]
+        if not all(name in arrays.files for name in names):
+            return None
+        return dict( (name.split('_',1)[1], arrays[name]) for name in names )
+
+def readTextMap(GEBtype, mapPath):
+    """Returns the lookup arrays of GEBtype parsed from its text map"""
+    mapping = np.loadtxt('%s/%sChannelMap.txt'%(mapPath, GEBtype), dtype=int, skiprows=1, ndmin=2)
+    vfat, strip, channel, panPin = mapping.T
+    stripToChan = np.zeros((24,128), dtype=int)
+    stripToChan[vfat, strip] = channel - 1
+    stripToPan = np.zeros((24,128), dtype=int)
+    stripToPan[vfat, strip] = panPin
+    return mapArrays(stripToChan, stripToPan)
+
+def loadChannelMap(GEBtype, mapPath=None):
+    """Returns a dictionary of (24,128) lookup arrays for GEBtype:
+        chanToStrip:  (vfat, channel) -> readout strip
+        chanToPanPin: (vfat, channel) -> Panasonic connector pin
+        stripToChan:  (vfat, strip)   -> channel
+        panPinToChan: (vfat, PanPin)  -> channel
+    The binary map is used if it is up to date, otherwise the text map."""
+    if mapPath is None:
+        mapPath = defaultMapPath()
+        pass
+    arrays = readBinaryMap(GEBtype, mapPath)
+    if arrays is None:
+        arrays = readTextMap(GEBtype, mapPath)
+        pass
+    return arrays
@@ -0,0 +1,209 @@
+#!/bin/env python
+"""
+Streaming, mergeable quantile sketches for long-term reference distributions.
+
+A TDigest summarizes any number of values with a few hundred weighted
+centroids. It can be updated scan by scan, merged with other digests and saved
+to disk, and gives approximate quantiles, median, MAD and IQR. Use it with the
+isOutlier*Reference functions of anautilities to flag channels against a
+reference built from many scans.
+
+Updating a reference file from fit results:
+
+    quantilesketch.py -i SCurveFitData.root --reference=reference.npz --branches=noise,threshold --selection="mask==0"
+"""
+
+import numpy as np
+
+class TDigest(object):
+    """Approximate distribution of a stream of values, see Dunning & Ertl,
+    "Computing extremely accurate quantiles using t-digests". Centroids are
+    grouped with the arcsine scale function, so the tails are kept at a finer
+    resolution than the bulk. Larger compression values give more centroids
+    and better accuracy. NaN and infinite values are ignored."""
+
+    def __init__(self, compression=200.):
+        self.compression = float(compression)
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.min = np.inf
+        self.max = -np.inf
+
+    @property
+    def count(self):
+        """Total weight of the values seen so far"""
+        return self.weights.sum()
+
+    def update(self, values, weights=None):
+        """Adds values (any shape), optionally with weights"""
+        values = np.asarray(values, dtype=float).ravel()
+        if weights is None:
+            weights = np.ones(len(values))
+        else:
+            weights = np.asarray(weights, dtype=float).ravel()
+        good = np.isfinite(values)
+        if not np.any(good):
+            return
+        values = values[good]
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self._compress(values, weights[good])
+
+    def merge(self, other):
+        """Adds the content of the digest other to this one"""
+        if len(other.means) == 0:
+            return
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress(other.means, other.weights)
+
+    def _compress(self, means, weights):
+        means = np.concatenate((self.means, means))
+        weights = np.concatenate((self.weights, weights))
+        order = np.argsort(means, kind='mergesort')
+        means = means[order]
+        weights = weights[order]
+
+        # Centroids whose mid-point falls in the same unit interval of the
+        # scale function k(q) are merged
+        cumWeights = np.cumsum(weights)
+        qMid = (cumWeights - 0.5 * weights) / cumWeights[-1]
+        k = self.compression / (2 * np.pi) * np.arcsin(2 * qMid - 1)
+        group = np.floor(k - k[0]).astype(int)
+        groupWeights = np.bincount(group, weights)
+        groupSums = np.bincount(group, weights * means)
+        filled = groupWeights > 0
+        self.weights = groupWeights[filled]
+        self.means = groupSums[filled] / self.weights
+
+    def _positions(self):
+        """Centroid means and their cumulative-weight positions, with the
+        minimum and maximum at both ends"""
+        cumWeights = np.cumsum(self.weights)
+        positions = np.concatenate(([0.], cumWeights - 0.5 * self.weights, [cumWeights[-1]]))
+        means = np.concatenate(([self.min], self.means, [self.max]))
+        return means, positions
+
+    def quantile(self, q):
+        """Returns the approximate q-quantile(s), q in [0,1]"""
+        if len(self.means) == 0:
+            return np.nan * np.asarray(q, dtype=float)
+        means, positions = self._positions()
+        return np.interp(np.asarray(q, dtype=float) * positions[-1], positions, means)
+
+    def cdf(self, x):
+        """Returns the approximate fraction of values below x"""
+        if len(self.means) == 0:
+            return np.nan * np.asarray(x, dtype=float)
+        means, positions = self._positions()
+        return np.interp(x, means, positions) / positions[-1]
+
+    def median(self):
+        return float(self.quantile(0.5))
+
+    def mad(self):
+        """Median absolute deviation from the median, i.e. the distance d such
+        that half of the values lie within median +/- d"""
+        if len(self.means) == 0:
+            return np.nan
+        median = self.median()
+        distances = np.unique(np.abs(np.concatenate((self.means, [self.min, self.max])) - median))
+        contained = self.cdf(median + distances) - self.cdf(median - distances)
+        return float(np.interp(0.5, contained, distances))
+
+    def iqr(self):
+        q1, q3 = self.quantile([0.25, 0.75])
+        return q3 - q1
+
+    def toArrays(self, prefix=''):
+        """Returns the digest as a dictionary of arrays, see saveSketches"""
+        return {
+            prefix + 'means':self.means,
+            prefix + 'weights':self.weights,
+            prefix + 'params':np.array([self.compression, self.min, self.max])
+            }
+
+    @classmethod
+    def fromArrays(cls, arrays, prefix=''):
+        """Inverse of toArrays"""
+        compression, vMin, vMax = arrays[prefix + 'params']
+        digest = cls(compression)
+        digest.means = np.array(arrays[prefix + 'means'], dtype=float)
+        digest.weights = np.array(arrays[prefix + 'weights'], dtype=float)
+        digest.min = vMin
+        digest.max = vMax
+        return digest
+
+def saveSketches(filename, sketches):
+    """Saves a dictionary of named TDigest objects to the .npz file filename"""
+    arrays = {}
+    for name, sketch in sketches.iteritems():
+        arrays.update(sketch.toArrays('%s__'%name))
+        pass
+    np.savez(filename, **arrays)
+    return
+
+def loadSketches(filename):
+    """Loads the dictionary of named TDigest objects saved by saveSketches"""
+    sketches = {}
+    with np.load(filename) as arrays:
+        for key in arrays.files:
+            if key.endswith('__params'):
+                name = key[:-len('__params')]
+                sketches[name] = TDigest.fromArrays(arrays, '%s__'%name)
+                pass
+            pass
+        pass
+    return sketches
+
+if __name__ == '__main__':
+    import os
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("-i", "--infilename", type="string", dest="filename",
+                      help="Comma separated list of input ROOT files", metavar="filename")
+    parser.add_option("--reference", type="string", dest="reference", default="reference.npz",
+                      help="Reference file to create or update", metavar="reference")
+    parser.add_option("--tree", type="string", dest="tree", default="scurveFitTree",
+                      help="Name of the input tree", metavar="tree")
+    parser.add_option("--branches", type="string", dest="branches", default="noise,threshold",
+                      help="Comma separated list of branches to accumulate", metavar="branches")
+    parser.add_option("--selection", type="string", dest="selection", default=None,
+                      help="Selection applied to the entries, e.g. 'mask==0'", metavar="selection")
+    parser.add_option("--compression", type="float", dest="compression", default=200.,
+                      help="Compression of new sketches", metavar="compression")
+
+    (options, args) = parser.parse_args()
+
+    import root_numpy as rp
+    from columnar import readColumns
+
+    branches = options.branches.split(',')
+    sketches = {}
+    if os.path.isfile(options.reference):
+        sketches = loadSketches(options.reference)
+        pass
+    for branch in branches:
+        if branch not in sketches:
+            sketches[branch] = TDigest(options.compression)
+            pass
+        pass
+
+    for filename in options.filename.split(','):
+        if options.selection is None:
+            data = readColumns(filename, options.tree, branches)
+            pass
+        else:
+            data = rp.root2array(filename, treename=options.tree, branches=branches, selection=options.selection)
+            pass
+        for branch in branches:
+            sketches[branch].update(data[branch])
+            pass
+        print "Added %i entries from %s"%(len(data[branches[0]]), filename)
+        pass
+
+    saveSketches(options.reference, sketches)
+    for branch in branches:
+        sketch = sketches[branch]
+        print "%s: %i entries, median %f, MAD %f, IQR %f"%(branch, sketch.count, sketch.median(), sketch.mad(), sketch.iqr())
+        pass
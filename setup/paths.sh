@@ -47,7 +47,7 @@ export PYTHONPATH=$PYTHONPATH:$GEM_PLOTTING_PROJECT
 
 # Making detector channel maps
 echo "Checking Detector Channel Maps"
-if [ ! -f $GEM_PLOTTING_PROJECT/mapping/longChannelMap.txt ]; then
+if [ ! -f $GEM_PLOTTING_PROJECT/mapping/longChannelMap.txt ] || [ ! -f $GEM_PLOTTING_PROJECT/mapping/channelMap.npz ]; then
     echo "No channel maps found, making"
     python $GEM_PLOTTING_PROJECT/mapping/buildMapFiles.py 
 fi
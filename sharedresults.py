@@ -0,0 +1,60 @@
+"""
+Result arrays shared by the workers of a multiprocessing Pool and their parent.
+
+Large per-channel results (fit parameters, masks, ...) are not pickled back
+through the Pool: the parent allocates one slot per job in shared memory
+before creating the Pool, the forked workers inherit it, and each job is only
+given its slot number. A worker copies its results into its slot and the
+parent reads all of them as one NumPy array, without copying:
+
+    results = SharedResults(len(jobs))
+    pool = Pool(12)
+    records = pool.map(work, enumerate(jobs)) # work calls results.store(slot, data)
+    data = results.array()[results.filled()]
+
+The slots hold arrays of chamberDataType of shape (24,128) by default, any
+dtype and shape can be given. The buffers only reach the workers forked after
+the SharedResults was created, which is how Pool starts them on Linux.
+"""
+
+import numpy as np
+
+class SharedResults(object):
+    def __init__(self, nSlots, dtype=None, shape=(24,128)):
+        from multiprocessing.sharedctypes import RawArray
+
+        if dtype is None:
+            from anautilities import chamberDataType
+            dtype = chamberDataType
+            pass
+        self.nSlots = nSlots
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.slotLength = int(np.prod(self.shape))
+        #RawArray is zeroed and has no lock, each slot has a single writer
+        self.buffer = RawArray('b', max(1, nSlots * self.slotLength * self.dtype.itemsize))
+        self.isFilled = RawArray('b', max(1, nSlots))
+
+    def slot(self, slot):
+        """Returns the array of the slot, a view of the shared buffer"""
+        if slot < 0 or slot >= self.nSlots:
+            raise IndexError('Slot %i out of range (%i slots)'%(slot, self.nSlots))
+        return np.frombuffer(self.buffer, dtype=self.dtype, count=self.slotLength,
+                             offset=slot * self.slotLength * self.dtype.itemsize).reshape(self.shape)
+
+    def store(self, slot, data):
+        """Copies data, which must have the shape of a slot and the same fields,
+        into the slot and flags it as filled"""
+        self.slot(slot)[...] = data
+        self.isFilled[slot] = 1
+        return
+
+    def array(self):
+        """Returns the array of shape (nSlots,) + shape of all the slots, a view
+        of the shared buffer"""
+        return np.frombuffer(self.buffer, dtype=self.dtype,
+                             count=self.nSlots * self.slotLength).reshape((self.nSlots,) + self.shape)
+
+    def filled(self):
+        """Returns the (nSlots,) boolean array of the slots stored to"""
+        return np.frombuffer(self.isFilled, dtype=np.int8, count=self.nSlots) != 0
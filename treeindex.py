@@ -0,0 +1,76 @@
+"""
+Random access to the entries of a channel in scurveTree, scurveFitTree and
+other trees with one entry per (vfatN, channel) and, possibly, per scan point.
+
+A TreeIndex maps (vfatN, key) to the entry numbers holding it, key being
+vfatCH, ROBstr or panPin. It is built from the two index branches only and
+cached in a sidecar file next to the ROOT file, so later uses only load it.
+Example usage:
+
+    index = TreeIndex('SCurveFitData.root', 'scurveFitTree', 'ROBstr')
+    for idx, event in iterIndexed(fitF.scurveFitTree, index, [(0,12), (3,64)]):
+        print idx, event.threshold
+"""
+
+import os
+import numpy as np
+
+class TreeIndex(object):
+    """Entry numbers of treename in filename grouped by (vfatN, key)"""
+
+    def __init__(self, filename, treename="scurveFitTree", key="vfatCH", cache=True):
+        self.filename = filename
+        self.treename = treename
+        self.key = key
+        self.sidecar = "%s.%s_%s.idx.npz"%(filename, treename, key)
+        source = self.sourceSignature()
+
+        if cache and os.path.isfile(self.sidecar):
+            with np.load(self.sidecar) as arrays:
+                if np.array_equal(arrays['source'], source):
+                    self.order = arrays['order']
+                    self.starts = arrays['starts']
+                    return
+        self.build()
+        if cache:
+            try:
+                np.savez(self.sidecar, order=self.order, starts=self.starts, source=source)
+            except (IOError, OSError):
+                # e.g. a read-only data area, the index is then rebuilt next time
+                pass
+
+    def sourceSignature(self):
+        """Size and modification time of the ROOT file, a changed file
+        invalidates the sidecar"""
+        stat = os.stat(self.filename)
+        return np.array([stat.st_size, stat.st_mtime])
+
+    def build(self):
+        from columnar import readColumns
+
+        entries = readColumns(self.filename, self.treename, ['vfatN', self.key])
+        code = entries['vfatN'].astype(int) * 128 + entries[self.key]
+        self.order = np.argsort(code, kind='mergesort')
+        nCodes = code.max() + 1 if len(code) else 0
+        self.starts = np.searchsorted(code[self.order], np.arange(nCodes + 1))
+
+    def entries(self, vfat, key):
+        """Returns the entry numbers of (vfat, key), in increasing order"""
+        code = vfat * 128 + key
+        if code < 0 or code + 1 >= len(self.starts):
+            return self.order[:0]
+        return self.order[self.starts[code]:self.starts[code + 1]]
+
+    def select(self, pairs):
+        """Returns the (entry, position in pairs) of every entry of the
+        (vfat, key) pairs, sorted by entry so that they are read in a single
+        pass over the tree"""
+        selected = [ (entry, idx) for idx, (vfat, key) in enumerate(pairs) for entry in self.entries(vfat, key) ]
+        return sorted(selected)
+
+def iterIndexed(tree, index, pairs):
+    """Loads the entries of the (vfat, key) pairs of tree one after the
+    other, yielding the position of the pair in pairs and the tree"""
+    for entry, idx in index.select(pairs):
+        tree.GetEntry(int(entry))
+        yield idx, tree